@@ -2,14 +2,17 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-07-14 17:58:13
 LastEditors: longsion
-LastEditTime: 2025-03-05 18:29:29
+LastEditTime: 2025-03-21 16:52:40
 '''
 
+from itertools import chain
+
 from app.config import config
-from app.objects.vector import TextWithoutVecEntity, PersonalTextWithoutVecEntity, VdbTypeEnum
-from app.utils.logger import log_msg
+from app.objects.vector import TextWithoutVecEntity, PersonalTextWithoutVecEntity, VdbTypeEnum, VectorEntity, PersonalVectorEntity
+from app.utils.logger import log_msg, logger
 from app.utils.utils import batch_generator
 from app.services.embedding import acge_embedding_multi_by_entities, acge_embedding_multi_by_personal_entities
+from app.services.embedding_store import get_embedding_store
 
 import pypeln as pl
 
@@ -20,6 +23,65 @@ ZILLIZ_BATCH_SIZE = int(config["zilliz"]['batch_size'])
 ZILLIZ_PARALLELS = int(config["zilliz"]['parallels'])
 
 
+def embedding_with_store(doc_texts: list, embedding_func, vector_cls):
+    """
+    description: 计算文本向量，先查全局 文本->向量 存储，相同文本(包括同一批次内重复的文本)只请求一次 embedding 服务
+    param {*} doc_texts: TextWithoutVecEntity / PersonalTextWithoutVecEntity
+    param {*} embedding_func: 批量请求 embedding 服务，返回与输入顺序一致的向量 entity
+    param {*} vector_cls: VectorEntity / PersonalVectorEntity
+    return {*} 向量 entity 迭代器，顺序与输入不保证一致
+    """
+    store = get_embedding_store()
+    if store is None:
+        return (
+            batch_generator(doc_texts, EMBEDDING_BATCH_SIZE)
+            | pl.thread.map(embedding_func, workers=EMBEDDING_PARALLELS, maxsize=EMBEDDING_PARALLELS)
+            | pl.sync.flat_map(lambda x: x)
+        )
+
+    def with_vector(text_entity, vector):
+        return vector_cls(**text_entity.model_dump(exclude={"text"}), vector=vector)
+
+    groups: dict[str, list] = {}
+    for text_entity in doc_texts:
+        groups.setdefault(store.key(text_entity.text), []).append(text_entity)
+
+    stored = store.get_many(list(groups.keys()))
+    to_embed = [group[0] for key, group in groups.items() if key not in stored]
+    logger.info(f"embedding store, total: {len(doc_texts)}, unique: {len(groups)}, hit: {len(stored)}, to embed: {len(to_embed)}")
+
+    def embedding_and_store(batch):
+        keys = [store.key(text_entity.text) for text_entity in batch]
+        vector_entities = embedding_func(batch)
+        store.put_many({key: vector_entity.vector for key, vector_entity in zip(keys, vector_entities)})
+        return [
+            vector_entity if i == 0 else with_vector(text_entity, vector_entity.vector)
+            for key, vector_entity in zip(keys, vector_entities)
+            for i, text_entity in enumerate(groups[key])
+        ]
+
+    stored_entities = (
+        with_vector(text_entity, stored[key])
+        for key, group in groups.items() if key in stored
+        for text_entity in group
+    )
+    embedded_entities = (
+        batch_generator(to_embed, EMBEDDING_BATCH_SIZE)
+        | pl.thread.map(embedding_and_store, workers=EMBEDDING_PARALLELS, maxsize=EMBEDDING_PARALLELS)
+        | pl.sync.flat_map(lambda x: x)
+    )
+    return chain(stored_entities, embedded_entities)
+
+
+@log_msg
+def embedding_texts(doc_texts: list[TextWithoutVecEntity]) -> list[VectorEntity]:
+    """
+    description: 只计算向量不写入向量库，es 向量模式下由 chatdoc 将向量与切片一起写入
+    return {*} 向量 entity 列表，顺序与输入不保证一致
+    """
+    return list(embedding_with_store(doc_texts, acge_embedding_multi_by_entities, VectorEntity))
+
+
 @log_msg
 def embedding_and_upload(doc_texts: list[TextWithoutVecEntity]):
 
@@ -31,15 +93,7 @@ def embedding_and_upload(doc_texts: list[TextWithoutVecEntity]):
         from app.services.es_embeddings import insert_entities
 
     batch_generator(
-        (
-            batch_generator(doc_texts, EMBEDDING_BATCH_SIZE)
-            | pl.thread.map(
-                acge_embedding_multi_by_entities,
-                workers=EMBEDDING_PARALLELS,
-                maxsize=EMBEDDING_PARALLELS,
-            )
-            | pl.sync.flat_map(lambda x: x)
-        ),
+        embedding_with_store(doc_texts, acge_embedding_multi_by_entities, VectorEntity),
         ZILLIZ_BATCH_SIZE
     ) | pl.thread.map(insert_entities, workers=ZILLIZ_PARALLELS, maxsize=ZILLIZ_PARALLELS) | list
 
@@ -58,15 +112,7 @@ def embedding_and_upload_personal(doc_texts: list[PersonalTextWithoutVecEntity])
         from app.services.es_embeddings import insert_personal_entities
 
     batch_generator(
-        (
-            batch_generator(doc_texts, EMBEDDING_BATCH_SIZE)
-            | pl.thread.map(
-                acge_embedding_multi_by_personal_entities,
-                workers=EMBEDDING_PARALLELS,
-                maxsize=EMBEDDING_PARALLELS,
-            )
-            | pl.sync.flat_map(lambda x: x)
-        ),
+        embedding_with_store(doc_texts, acge_embedding_multi_by_personal_entities, PersonalVectorEntity),
         ZILLIZ_BATCH_SIZE
     ) | pl.thread.map(insert_personal_entities, workers=ZILLIZ_PARALLELS, maxsize=ZILLIZ_PARALLELS) | list
 
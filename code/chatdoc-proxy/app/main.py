@@ -5,7 +5,7 @@ LastEditors: longsion
 LastEditTime: 2025-03-09 09:31:28
 '''
 from fastapi import FastAPI, Request
-from app.controller.embedding_and_upload import embedding_and_upload, embedding_and_upload_personal
+from app.controller.embedding_and_upload import embedding_and_upload, embedding_and_upload_personal, embedding_texts
 from app.services.pdf_to_word import pdf_to_word
 from app.services.embedding import parallel_query
 from app.services.es import global_es
@@ -101,6 +101,12 @@ async def upload_vdb(vector_params: list[TextWithoutVecEntity]):
     return "ok"
 
 
+@app.post("/vector/embedding")
+async def embedding_vdb(vector_params: list[TextWithoutVecEntity]):
+    # 只计算向量并返回，由调用方与切片一起写入 ES
+    return [entity.model_dump() for entity in embedding_texts(vector_params)]
+
+
 @app.post("/vector/upload_personal")
 async def upload_personal_vdb(vector_params: list[PersonalTextWithoutVecEntity]):
     embedding_and_upload_personal(vector_params)
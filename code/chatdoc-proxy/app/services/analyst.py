@@ -2,14 +2,15 @@
 
 from collections import Counter
 from datetime import datetime
-from functools import cache
 import re
 import requests
-from difflib import get_close_matches
 
 from app.config import config
+from app.services.company_index import match_company_aliases
 from app.services.es import ESFileObject, global_es
+from app.utils.fuzzy_match import get_close_matches
 from app.utils.logger import log_msg
+from app.utils.lru_cache import lru_cache_function
 from app.utils.thread_with_return_value import ThreadWithReturnValue
 from app.utils.utils import ensure_list, retry_exponential_backoff
 
@@ -45,10 +46,14 @@ FR_KEYWORDS = dict(
 )
 
 
+ANALYST_QUERY_CACHE_SIZE = int((config.get("cache") or {}).get("analyst_query_max_size", 4096))
+ANALYST_QUERY_CACHE_TTL = int((config.get("cache") or {}).get("analyst_query_ttl", 3600))
+
 filter_words = ["信息", "科技", "有限", "公司", "股份", "电气", "电器", "保险", "控股", "集团", "制药", "智能", "证券", "有限公司", "科技股份", "网络", "网络科技", "数据", "报告", "年报", "季报", "一季报", "半年报", "三季报", "年度报告", "招股书", "pdf"]
 
 
-@cache
+# 有界缓存，过期后重新解析，公司索引更新后可生效
+@lru_cache_function(max_size=ANALYST_QUERY_CACHE_SIZE, expiration=ANALYST_QUERY_CACHE_TTL, concurrent=True)
 @log_msg
 def analyst_query(query: str):
     if not query:
@@ -58,7 +63,9 @@ def analyst_query(query: str):
     t.start()
 
     # 并行处理
-    match_companies, alias_name_mapper = search_company_bm25(query)
+    match_companies, alias_name_mapper = match_company_aliases(query)
+    if not match_companies:
+        match_companies, alias_name_mapper = search_company_bm25(query)
     extract_years, extract_companys, extract_keywords = t.join()
     regular_extract_years = year_regular(query, extract_years)  # query中的时间信息进行拆解
 
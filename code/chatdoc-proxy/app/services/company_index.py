@@ -0,0 +1,124 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-04-01 16:10:25
+LastEditors: longsion
+LastEditTime: 2025-04-01 17:21:40
+
+进程内公司名/别名索引：analyst_query 定位问题中的公司不再逐次查询 ES，与 chatdoc pkg/es/entity_index.py 保持一致
+- 全量加载公司索引的名称、简称、别名构建 Aho-Corasick 自动机，扫描一遍问题即可找到出现的公司
+- 超过 entity_index_refresh_sec 后在后台重建；首次构建完成前及未命中时由调用方回退到 ES 查询
+'''
+
+import threading
+import time
+from typing import Optional
+
+from app.config import config
+from app.services.es import global_es
+from app.utils.aho_corasick import AhoCorasick
+from app.utils.logger import logger
+from app.utils.utils import ensure_list
+
+ENTITY_INDEX_REFRESH_SEC = int((config.get("cache") or {}).get("entity_index_refresh_sec", 300))
+SCAN_PAGE_SIZE = 5000
+MIN_WORD_LEN = 2
+COMPANY_SUFFIXES = ["集团股份有限公司", "股份有限公司", "有限责任公司", "集团有限公司", "有限公司", "股份公司", "集团", "公司"]
+
+
+def company_short_name(name: str) -> str:
+    for suffix in COMPANY_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def _scan_companies() -> list[dict]:
+    companies, search_after = [], None
+    while True:
+        body = {
+            "_source": ["eid", "name", "alias", "uuid"],
+            "size": SCAN_PAGE_SIZE,
+            "sort": [{"uuid": "asc"}],
+            "query": {"match_all": {}},
+        }
+        if search_after:
+            body["search_after"] = search_after
+        hits = global_es.search_with_hits(config['es']['index_company'], body)
+        companies.extend(hit["_source"] for hit in hits)
+        if len(hits) < SCAN_PAGE_SIZE:
+            return companies
+        search_after = hits[-1]["sort"]
+
+
+class CompanyIndex(object):
+
+    def __init__(self):
+        # 整体替换，读取时无需加锁
+        self.automaton: Optional[AhoCorasick] = None
+        self.built_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get(self) -> Optional[AhoCorasick]:
+        if not ENTITY_INDEX_REFRESH_SEC:
+            return None
+        if self.automaton is None or time.time() - self.built_at > ENTITY_INDEX_REFRESH_SEC:
+            self._refresh_in_background()
+        return self.automaton
+
+    def refresh(self):
+        start_time = time.time()
+        companies = _scan_companies()
+        automaton = AhoCorasick()
+        for company in companies:
+            name = company.get("name") or ""
+            words = {name, company_short_name(name)} | set(ensure_list(company.get("alias") or []))
+            for word in words:
+                if word and len(word) >= MIN_WORD_LEN:
+                    automaton.add(word, name)
+        automaton.build()
+
+        self.automaton = automaton
+        self.built_at = time.time()
+        logger.info(f"company index refreshed, companies: {len(companies)}, cost: {1000*(time.time() - start_time):.1f}ms")
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"company index refresh error: {e}")
+                # 失败后等下一个刷新周期再重试
+                self.built_at = time.time()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=_run, daemon=True).start()
+
+
+company_index = CompanyIndex()
+
+
+def match_company_aliases(query: str) -> tuple[list[str], dict[str, str]]:
+    """
+    问题中出现的公司名/简称/别名(不重叠的最长匹配)及其到公司全称的映射，返回格式同 search_company_bm25；索引未就绪或未命中时返回空
+    """
+    automaton = company_index.get()
+    if automaton is None or not query:
+        return [], {}
+
+    matches = sorted(automaton.iter(query), key=lambda match: (match[0], -len(match[1])))
+    aliases, alias_name_mapper, end = [], {}, 0
+    for start, word, name in matches:
+        if start < end:
+            continue
+        if word not in alias_name_mapper:
+            aliases.append(word)
+            alias_name_mapper[word] = name
+        end = start + len(word)
+    return aliases, alias_name_mapper
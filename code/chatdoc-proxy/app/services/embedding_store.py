@@ -0,0 +1,162 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-21 10:12:36
+LastEditors: longsion
+LastEditTime: 2025-03-21 16:40:18
+'''
+
+import abc
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Optional
+
+import numpy as np
+
+from app.config import config, BASE_DIR
+from app.utils.logger import logger
+
+STORE_BACKEND = str(config["embedding"].get("store_backend") or "").lower()
+STORE_NAMESPACE = config["embedding"].get("store_namespace", "acge_embedding")
+STORE_TTL = int(config["embedding"].get("store_ttl", 0) or 0)
+STORE_QUERY_SIZE = 500
+
+
+class EmbeddingStore(abc.ABC):
+    """
+    全局 文本 -> 向量 存储，key 为 namespace、向量维度、精度与文本的 sha1
+    - 年报/招股书中的免责声明、表头、审计意见等在不同文件中大量重复，相同文本只需计算一次 embedding
+    - 向量按 float32 存储(向量库本身即 float32)
+    - 存储不可用时只打日志，按未命中处理，不影响入库
+    """
+
+    def __init__(self, namespace: str = STORE_NAMESPACE):
+        self.namespace = namespace
+
+    def key(self, text: str, dimension=1024, digit=8) -> str:
+        return hashlib.sha1(f"{self.namespace}|{dimension}|{digit}|{text}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def encode(vector: list[float]) -> bytes:
+        return np.asarray(vector, dtype=np.float32).tobytes()
+
+    @staticmethod
+    def decode(value: bytes) -> list[float]:
+        return np.frombuffer(value, dtype=np.float32).tolist()
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        if not keys:
+            return {}
+        try:
+            return {key: self.decode(value) for key, value in self._get_many(keys).items()}
+        except Exception as e:
+            logger.warning(f"embedding store get failed: {e}")
+            return {}
+
+    def put_many(self, vectors: dict[str, list[float]]):
+        if not vectors:
+            return
+        try:
+            self._put_many({key: self.encode(vector) for key, vector in vectors.items()})
+        except Exception as e:
+            logger.warning(f"embedding store put failed: {e}")
+
+    @abc.abstractmethod
+    def _get_many(self, keys: list[str]) -> dict[str, bytes]:
+        ...
+
+    @abc.abstractmethod
+    def _put_many(self, values: dict[str, bytes]):
+        ...
+
+
+class DiskEmbeddingStore(EmbeddingStore):
+    """
+    本地磁盘存储(sqlite, WAL 模式)，单机部署或多个 worker 共享同一文件
+    """
+
+    def __init__(self, path: str, namespace: str = STORE_NAMESPACE):
+        super().__init__(namespace)
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn().execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _get_many(self, keys: list[str]) -> dict[str, bytes]:
+        conn, result = self._conn(), {}
+        for i in range(0, len(keys), STORE_QUERY_SIZE):
+            chunk = keys[i: i + STORE_QUERY_SIZE]
+            rows = conn.execute(f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            result.update(rows.fetchall())
+        return result
+
+    def _put_many(self, values: dict[str, bytes]):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN")
+            conn.executemany("INSERT OR IGNORE INTO embeddings (key, vector) VALUES (?, ?)", values.items())
+
+
+class RedisEmbeddingStore(EmbeddingStore):
+    """
+    Redis 存储，多机部署时共享；store_ttl > 0 时按 ttl 过期
+    """
+
+    def __init__(self, url: str, namespace: str = STORE_NAMESPACE, ttl: int = STORE_TTL):
+        import redis
+
+        super().__init__(namespace)
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def _redis_key(self, key: str) -> str:
+        return f"embedding_store:{key}"
+
+    def _get_many(self, keys: list[str]) -> dict[str, bytes]:
+        result = {}
+        for i in range(0, len(keys), STORE_QUERY_SIZE):
+            chunk = keys[i: i + STORE_QUERY_SIZE]
+            values = self.client.mget([self._redis_key(key) for key in chunk])
+            result.update({key: value for key, value in zip(chunk, values) if value is not None})
+        return result
+
+    def _put_many(self, values: dict[str, bytes]):
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipeline.set(self._redis_key(key), value, ex=self.ttl or None, nx=True)
+        pipeline.execute()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_embedding_store() -> Optional[EmbeddingStore]:
+    """
+    embedding.store_backend: disk / redis，为空时关闭
+    """
+    global _store
+    if _store is not None or not STORE_BACKEND:
+        return _store
+
+    with _store_lock:
+        if _store is None:
+            if STORE_BACKEND == "redis":
+                _store = RedisEmbeddingStore(config["embedding"]["store_redis_url"])
+            elif STORE_BACKEND == "disk":
+                path = config["embedding"].get("store_path") or "{BASE_DIR}/data/embedding_store.db"
+                _store = DiskEmbeddingStore(path.format(BASE_DIR=BASE_DIR))
+            else:
+                raise ValueError(f"unknown embedding store backend: {STORE_BACKEND}")
+            logger.info(f"embedding store: {STORE_BACKEND}, namespace: {STORE_NAMESPACE}")
+    return _store
@@ -11,6 +11,7 @@ from requests.auth import HTTPBasicAuth
 import time
 from app.utils.logger import log_msg, logger
 from app.config import config
+from app.services.vector_first_pass import embedding_fields
 
 
 class EsBaseItem(BaseModel):
@@ -78,45 +79,59 @@ class ES:
         self.username = config["es"].get("username")
         self.password = config["es"].get("password")
 
-    def bulk_update_embeddings(self, index , items):
+    def bulk_update_embeddings(self, index, items):
         """批量更新多个文档的向量字段
 
+        切片写入时 _id 即 uuid，先按 _id 直接更新；_id 不是 uuid 的存量切片(返回 404)再按 uuid 查询 _id 后更新
+
         Args:
             index: ES索引名称
             items: 列表，每项包含 uuid 和 embedding，格式如：
                   [{"uuid": "doc1_uuid", "embedding": [...]}, ...]
         """
+        embeddings = {item["uuid"]: embedding_fields("acge_embedding", item["embedding"]) for item in items}
+
+        missing_uuids = self._bulk_update_by_ids(index, {uuid: (uuid, fields) for uuid, fields in embeddings.items()})
+        if missing_uuids is None:
+            return False
+        if not missing_uuids:
+            return True
+
+        uuid_to_id = self._search_ids_by_uuids(index, missing_uuids)
+        for uuid in missing_uuids:
+            if uuid not in uuid_to_id:
+                logger.warning(f"未找到uuid对应的文档: {uuid}")
 
-        should_conditions = [{"term": {"uuid": item["uuid"]}} for item in items]
+        if not uuid_to_id:
+            logger.error("没有找到任何可更新的文档")
+            return False
+
+        return self._bulk_update_by_ids(index, {uuid: (doc_id, embeddings[uuid]) for uuid, doc_id in uuid_to_id.items()}) == []
 
+    def _search_ids_by_uuids(self, index, uuids: list[str]) -> dict[str, str]:
         search_body = {
             "query": {
                 "bool": {
-                    "should": should_conditions,
-                    "minimum_should_match": 1
+                    "filter": [{"terms": {"uuid": uuids}}]
                 }
             },
             "_source": ["uuid"],  # 只需要返回uuid字段
-            "size": len(items)
+            "size": len(uuids)
         }
-
-        # 获取文档列表
         docs = self.search_with_hits(index, search_body)
-
-        # print("search result of uuids: ", should_conditions, docs)
-        print("search result of uuids: ", should_conditions, "docs length: ", len(docs))
+        logger.info(f"search ids of uuids: {len(uuids)}, docs length: {len(docs)}")
 
         # 构建uuid到_id的映射
-        uuid_to_id = {doc["_source"]["uuid"]: doc["_id"] for doc in docs}
-
-        # 构建bulk更新请求
-        bulk_data = []
-        for item in items:
-            doc_id = uuid_to_id.get(item["uuid"])
-            if not doc_id:
-                logger.warning(f"未找到uuid对应的文档: {item['uuid']}")
-                continue
+        return {doc["_source"]["uuid"]: doc["_id"] for doc in docs}
 
+    def _bulk_update_by_ids(self, index, updates: dict[str, tuple[str, dict]]):
+        """
+        按 _id 批量更新向量
+        :param updates: uuid -> (_id, 向量字段)
+        :return: 文档不存在(404)的 uuid 列表；请求失败或有其他错误时返回 None
+        """
+        bulk_data, uuids = [], []
+        for uuid, (doc_id, fields) in updates.items():
             # 添加更新操作的元数据和数据
             bulk_data.append(json.dumps({
                 "update": {
@@ -125,14 +140,9 @@ class ES:
                 }
             }))
             bulk_data.append(json.dumps({
-                "doc": {
-                    "acge_embedding": item["embedding"]
-                }
+                "doc": fields
             }))
-
-        if not bulk_data:
-            logger.error("没有找到任何可更新的文档")
-            return False
+            uuids.append(uuid)
 
         bulk_body = "\n".join(bulk_data) + "\n"
         try:
@@ -148,16 +158,24 @@ class ES:
 
             if resp.status_code != 200:
                 logger.error(f"批量更新文档向量失败: {resp.text}")
-                return False
+                return None
 
             # 检查更新结果
             result = resp.json()
-            if result.get("errors", False):
-                failed_docs = [item["update"]["_id"] for item in result["items"] if item["update"]["status"] != 200]
+            if not result.get("errors", False):
+                return []
+
+            missing_uuids, failed_docs = [], []
+            for uuid, item in zip(uuids, result["items"]):
+                status = item["update"]["status"]
+                if status == 404:
+                    missing_uuids.append(uuid)
+                elif status != 200:
+                    failed_docs.append(item["update"]["_id"])
+            if failed_docs:
                 logger.error(f"部分文档更新失败: {failed_docs}")
-                return False
-
-            return True
+                return None
+            return missing_uuids
 
         except Exception as e:
             logger.error(f"批量更新文档向量异常: {str(e)}")
@@ -11,6 +11,7 @@ from app.utils.rrf import RRF
 from app.utils.thread_with_return_value import ThreadWithReturnValue
 from pydantic import BaseModel
 from app.services.es import global_es
+from app.services.vector_first_pass import first_pass_enabled, first_pass_search_body
 from app.services.embedding import embedding_with_cache
 from app.utils.logger import logger
 from app.config import config
@@ -31,6 +32,17 @@ def retrieval_embeddings_by_es(index, embedding_field_name, question_embedding:
         embedding_name: 查询问题匹配的ES数据库的表名的索引
     Returns:
     """
+    if first_pass_enabled():
+        query = first_pass_search_body(embedding_field_name, question_embedding, size, op_fields, must_conditions)
+        return [
+            {
+                "score": hit["_score"],
+                "_id": hit["_id"],
+                **hit["_source"]
+            }
+            for hit in global_es.search_with_hits(index, query)
+        ]
+
     source_string = f"""
                     if (!doc.containsKey('{embedding_field_name}') || doc['{embedding_field_name}'].empty) {{
                         return 0; 
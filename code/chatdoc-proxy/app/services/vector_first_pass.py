@@ -0,0 +1,89 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-28 11:30:52
+LastEditors: longsion
+LastEditTime: 2025-03-28 17:52:06
+
+一阶段向量检索 + 全精度重排(vector.es_first_pass)，与 chatdoc pkg/es/vector_first_pass.py 保持一致
+- 写入向量时同时写入截断到前 es_first_pass_dims 维并归一化的 {field}_fp
+- 检索时按 {field}_fp 召回 es_rescore_factor 倍候选，再按全精度向量点积重排
+'''
+
+import math
+
+from app.config import config
+
+FIRST_PASS_SUFFIX = "_fp"
+FIRST_PASS_DIMS = int(config["vector"].get("es_first_pass_dims", 256))
+RESCORE_FACTOR = max(int(config["vector"].get("es_rescore_factor", 4)), 1)
+
+# 与 retrieval_embeddings_by_es 的打分一致：点积，小于 0 记 0
+DOT_PRODUCT_SCRIPT = """
+if (!doc.containsKey(params.field) || doc[params.field].empty) {
+    return 0;
+}
+double dp = dotProduct(params.queryVector, params.field);
+return dp < 0 ? 0 : dp;
+"""
+
+
+def first_pass_enabled() -> bool:
+    return config["vector"]["model"] == 'es' and str(config["vector"].get("es_first_pass", False)).lower() in ('1', 'true')
+
+
+def first_pass_field(field: str) -> str:
+    return f"{field}{FIRST_PASS_SUFFIX}"
+
+
+def truncate_vector(vector: list[float], dims: int = FIRST_PASS_DIMS) -> list[float]:
+    """
+    matryoshka 向量截断到前 dims 维并重新归一化
+    """
+    vector = vector[:dims]
+    norm = math.sqrt(sum(x * x for x in vector))
+    return [x / norm for x in vector] if norm > 0 else list(vector)
+
+
+def embedding_fields(field: str, vector: list[float]) -> dict:
+    """
+    写入文档的 embedding 字段，开启一阶段检索时带上截断后的向量
+    """
+    if not first_pass_enabled():
+        return {field: vector}
+    return {field: vector, first_pass_field(field): truncate_vector(vector)}
+
+
+def first_pass_search_body(field: str, question_embedding: list[float], size: int, op_fields: list = [], must_conditions: list = []) -> dict:
+    """
+    截断向量上 script_score 召回 size * es_rescore_factor 个候选，再按全精度向量点积重排取 size 个
+    """
+    def _script_score(script_field: str, query_vector: list[float]) -> dict:
+        return {
+            "script_score": {
+                "query": {"match_all": {}},
+                "script": {
+                    "source": DOT_PRODUCT_SCRIPT,
+                    "params": {"field": script_field, "queryVector": query_vector},
+                }
+            }
+        }
+
+    return {
+        "_source": op_fields,
+        "size": size,
+        "query": {
+            "bool": {
+                "must": [_script_score(first_pass_field(field), truncate_vector(question_embedding))],
+                "filter": list(must_conditions),
+            }
+        },
+        "rescore": {
+            "window_size": size * RESCORE_FACTOR,
+            "query": {
+                "rescore_query": _script_score(field, question_embedding),
+                # 只保留全精度得分
+                "query_weight": 0,
+                "rescore_query_weight": 1,
+            }
+        }
+    }
@@ -0,0 +1,74 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-04-01 16:02:11
+LastEditors: longsion
+LastEditTime: 2025-04-01 16:02:11
+
+Aho-Corasick 多模式匹配(与 chatdoc pkg/utils/aho_corasick.py 保持一致)：一次扫描文本即可找出所有出现的模式串，耗时与文本长度(及命中数)线性相关，与模式数量无关
+'''
+
+from collections import deque
+from typing import Any, Iterator
+
+
+class AhoCorasick(object):
+    """
+    >>> ac = AhoCorasick()
+    >>> ac.add("合合", 1)
+    >>> ac.add("合合信息", 2)
+    >>> ac.build()
+    >>> list(ac.iter("合合信息的营收"))
+    [(0, '合合', 1), (0, '合合信息', 2)]
+    """
+
+    def __init__(self):
+        # 节点 i 的子节点(字符 -> 节点)、失配指针、以该节点结尾的 (模式串, 值)
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._output: list[list[tuple[str, Any]]] = [[]]
+        self._built = False
+
+    def add(self, word: str, value: Any = None):
+        assert not self._built, "automaton already built"
+        if not word:
+            return
+        node = 0
+        for char in word:
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = nxt
+        self._output[node].append((word, value))
+
+    def build(self):
+        """
+        BFS 计算失配指针(根的子节点失配到根)，并把失配链上的输出合并到当前节点，匹配时无需再沿失配链回溯收集输出
+        """
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+        self._built = True
+
+    def iter(self, text: str) -> Iterator[tuple[int, str, Any]]:
+        """
+        依次返回 (起始位置, 模式串, 值)，同一结束位置上长模式串在前
+        """
+        assert self._built, "automaton not built"
+        node = 0
+        for end, char in enumerate(text):
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            for word, value in self._output[node]:
+                yield end - len(word) + 1, word, value
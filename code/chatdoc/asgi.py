@@ -0,0 +1,192 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-17 10:12:40
+LastEditors: longsion
+LastEditTime: 2025-03-17 18:05:21
+
+ASGI 问答服务入口：uvicorn asgi:app --host 0.0.0.0 --port 5000
+- 只提供 /api/v1/*/infer，文档解析/删除仍由 main.py(gunicorn) 提供
+- 问答流水线(检索/重排/截断等阻塞阶段)在有界线程池 infer_executor 中执行
+- SSE 流式答案逐块在 stream_executor 中处理，单个流不再独占一个 worker
+- 大模型支持异步流式(目前为 deepseek)时在事件循环中等待大模型输出，等待期间不占用 stream_executor 的线程，
+  并发流数不再受 stream_workers 限制；其他模型等待时仍占用一个线程
+'''
+
+import asyncio
+import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from opentelemetry import context as otel_context
+from opentelemetry.trace import get_current_span
+
+from pkg.config import config
+from pkg.llm.async_stream import STREAM_END, AwaitNext
+from pkg.utils.jaeger import tracer
+from pkg.utils.logger import logger
+from pkg.utils.thread_with_return_value import ThreadContext, set_thread_context
+
+from pre_import import *
+
+
+asgi_config = config.get("asgi") or {}
+
+# 阻塞的问答流水线
+infer_executor = ThreadPoolExecutor(max_workers=int(asgi_config.get("infer_workers", 64)), thread_name_prefix="asgi_infer")
+# 流式答案逐块拉取，每次只占用线程等待一个 chunk
+stream_executor = ThreadPoolExecutor(max_workers=int(asgi_config.get("stream_workers", 256)), thread_name_prefix="asgi_stream")
+# 同时处于流水线阶段的请求数上限，超出的请求在事件循环中排队等待，而不是堆积线程
+_infer_semaphore: asyncio.Semaphore = None
+
+SSE_HEADERS = {"Connection": "keep-alive", "Cache-Control": "no-cache"}
+_STREAM_END = object()
+
+app = FastAPI()
+
+
+def return_data(code, data):
+    if code == 500:
+        data = {
+            "err": data
+        }
+    return JSONResponse({
+        "code": code,
+        "data": data
+    })
+
+
+def get_infer_semaphore() -> asyncio.Semaphore:
+    # 需在事件循环内创建(python3.9 的 Semaphore 创建时即绑定 loop)
+    global _infer_semaphore
+    if _infer_semaphore is None:
+        _infer_semaphore = asyncio.Semaphore(int(asgi_config.get("max_pending_infer", 256)))
+    return _infer_semaphore
+
+
+def _run_infer(span_name: str, process, params):
+    """
+    在 infer_executor 中执行问答流水线，返回 (context, thread_context, span_ctx)
+    thread_context / span_ctx 用于后续流式拉取时恢复链路上下文
+    """
+    with tracer.start_as_current_span(span_name):
+        thread_context = ThreadContext(
+            trace_id=f"{get_current_span().context.trace_id:0x}",
+            extra=dict(async_stream=bool(asgi_config.get("async_llm_stream", True))),
+        )
+        set_thread_context(thread_context)
+        span_ctx = otel_context.get_current()
+        return process(params), thread_context, span_ctx
+
+
+async def _aiter_stream(iterator, thread_context: ThreadContext, span_ctx):
+    # 客户端断开时置位，拉取线程在两个 chunk 之间检查，不再继续拉取
+    cancelled = threading.Event()
+    pending: Future = None
+    # 正在等待的大模型异步流
+    llm_stream = None
+
+    def _next(value=None, error: Exception = None):
+        set_thread_context(thread_context)
+        token = otel_context.attach(span_ctx)
+        try:
+            if cancelled.is_set():
+                return _STREAM_END
+            # 把事件循环中取回的大模型 chunk(或异常)交回生成器
+            if error is not None:
+                return iterator.throw(error)
+            if value is not None:
+                return iterator.send(value)
+            return next(iterator, _STREAM_END)
+        except StopIteration:
+            return _STREAM_END
+        finally:
+            otel_context.detach(token)
+
+    def _close():
+        # 关闭生成器，释放大模型的流式连接；只能在生成器不在执行时调用，否则抛 ValueError
+        try:
+            iterator.close()
+        except AttributeError:
+            pass
+        except Exception as e:
+            logger.warning(f"close answer stream error: {e}")
+
+    try:
+        value, error = None, None
+        while True:
+            pending = stream_executor.submit(_next, value, error)
+            chunk = await asyncio.wrap_future(pending)
+            value, error = None, None
+            if chunk is _STREAM_END:
+                break
+            if isinstance(chunk, AwaitNext):
+                # 在事件循环中等待大模型输出，不占用线程
+                llm_stream = chunk.stream
+                try:
+                    value = await llm_stream.next()
+                except Exception as e:
+                    error = e
+                if value is STREAM_END:
+                    llm_stream = None
+                continue
+            yield chunk
+    finally:
+        cancelled.set()
+        if llm_stream is not None:
+            # 断开时大模型流可能停在两个 chunk 之间，后台关闭以释放连接
+            asyncio.ensure_future(llm_stream.aclose())
+        if pending is None or pending.done():
+            stream_executor.submit(_close)
+        else:
+            # 拉取线程仍在处理当前 chunk，返回后再关闭
+            pending.add_done_callback(lambda _future: _close())
+
+
+async def _infer(request: Request, span_name: str, process, params_cls, catch_exception: bool = True):
+    params = params_cls(**json.loads(await request.body()))
+    params.compliance_check = False
+    logger.info(f"{span_name} params: {params.model_dump_json()}")
+
+    async with get_infer_semaphore():
+        try:
+            result, thread_context, span_ctx = await asyncio.get_running_loop().run_in_executor(
+                infer_executor, _run_infer, span_name, process, params
+            )
+        except Exception as e:
+            if not catch_exception:
+                raise
+            return return_data(500, str(e))
+
+    logger.info(f"resp trace_id: {result.trace_id}")
+    if result.answer_response_iter:
+        return StreamingResponse(_aiter_stream(result.answer_response_iter, thread_context, span_ctx),
+                                 status_code=200, media_type="text/event-stream", headers=SSE_HEADERS)
+
+    return return_data(200, result.answer_response.model_dump())
+
+
+@app.post("/api/v1/analyst/infer")
+@app.get("/api/v1/analyst/infer")
+async def infer_analyst(request: Request):
+    from pkg.analyst import process, Params
+    return await _infer(request, "analyst infer", process, Params, catch_exception=False)
+
+
+@app.post("/api/v1/personal/infer")
+@app.get("/api/v1/personal/infer")
+async def infer_personal(request: Request):
+    from pkg.personal import process, Params
+    return await _infer(request, "personal infer", process, Params)
+
+
+@app.post("/api/v1/global/infer")
+async def infer_global(request: Request):
+    from pkg.global_ import process, Params
+    return await _infer(request, "global infer", process, Params)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=5000)
@@ -0,0 +1,43 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-19 15:02:17
+LastEditors: longsion
+LastEditTime: 2025-03-19 18:40:06
+
+文档解析任务 worker：python doc_worker.py [--queues analyst,personal] [--concurrency 3]
+- config.yaml 中 job_queue.enabled 开启后，/api/v1/*/parse 只负责入队，由本进程消费
+- 可按负载在多台机器上启动多个进程，进程重启后未完成的任务从 checkpoint 继续
+'''
+
+import argparse
+
+from pkg.config import config
+from pkg.redis.job_queue import JobWorker, job_queue_config
+from pkg.utils.logger import logger
+
+from pre_import import *
+
+
+def main():
+    from pkg.doc.process import job_queue as analyst_queue, process_job as process_analyst_job, on_job_failed as on_analyst_job_failed
+    from pkg.personal_doc.process import job_queue as personal_queue, process_job as process_personal_job, on_job_failed as on_personal_job_failed
+
+    handlers = {
+        "analyst": (analyst_queue, process_analyst_job, on_analyst_job_failed),
+        "personal": (personal_queue, process_personal_job, on_personal_job_failed),
+    }
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--queues", default=",".join(handlers.keys()), help="消费的队列，按顺序轮询")
+    parser.add_argument("--concurrency", type=int, default=int(job_queue_config.get("worker_concurrency", config["threadpool"]["doc_process_worker"])))
+    args = parser.parse_args()
+
+    queue_names = [name.strip() for name in args.queues.split(",") if name.strip()]
+    worker = JobWorker({handlers[name][0]: handlers[name][1:] for name in queue_names}, concurrency=args.concurrency)
+
+    logger.info(f"doc worker start, queues: {queue_names}, concurrency: {args.concurrency}")
+    worker.run_forever()
+
+
+if __name__ == '__main__':
+    main()
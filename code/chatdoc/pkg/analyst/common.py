@@ -10,7 +10,7 @@ import copy
 from pkg.es.es_doc_fragment import DocFragmentES, DocFragmentModel
 from pkg.es.es_doc_item import DocItemModel, DocItemES
 from pkg.es.es_doc_table import DocTableModel
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.stage_dag import stage_pool
 from pkg.utils.transform import html2markdown
 from pkg.utils import duplicates_list
 
@@ -33,12 +33,11 @@ def fillin_doc_items_cache(doc_item_cache, uuid_ori_id_tuples: list[tuple[str, s
         to_request_list = list(to_request_dict.keys())
         threads = []
         for i in range(0, len(to_request_list), max_batch_size):
-            t = ThreadWithReturnValue(target=DocItemES().get_by_uuid_ori_tuples, kwargs=dict(pairs=to_request_list[i:i + max_batch_size]))
-            t.start()
+            t = stage_pool.submit(DocItemES().get_by_uuid_ori_tuples, pairs=to_request_list[i:i + max_batch_size])
             threads.append(t)
 
         for t in threads:
-            doc_items = t.join()
+            doc_items = t.result()
             for doc_item in doc_items:
                 for ori_id in doc_item.ori_id:
                     hashkey = f"{doc_item.uuid}|{ori_id}"
@@ -93,6 +92,10 @@ def get_fragment_ori_ids(fragment: DocFragmentModel, fragment_cache: dict[str, D
     if fragment.leaf:
         return fragment.ori_id
 
+    # 入库时已预计算
+    if fragment.tree_ori_ids:
+        return fragment.tree_ori_ids
+
     ori_ids = copy.copy(fragment.ori_id)
 
     children_ori_ids = [
@@ -117,6 +120,10 @@ def get_fragment_ori_text(fragment: DocFragmentModel, fragment_cache: dict[str,
     description: 通过缓存获取 fragment的text， 补充填满【fragment_cache中包含该节点的所有子孙节点的Fragment】，doc_items_cache中也包含了【ori_id的缓存】
     return {*}
     '''
+    # 入库时已预计算
+    if fragment.tree_text:
+        return fragment.tree_text
+
     if not fragment.ori_id:
         return ""
 
@@ -144,6 +151,10 @@ def get_fragment_all_texts(fragment: DocFragmentModel, fragment_cache: dict[str,
     description: 通过缓存获取 fragment的text列表， 补充填满【fragment_cache中包含该节点的所有子孙节点的Fragment】，doc_items_cache中也包含了【ori_id的缓存】
     return {*}
     '''
+    # 入库时已预计算
+    if fragment.tree_all_texts:
+        return fragment.tree_all_texts
+
     if not fragment.ori_id:
         return []
 
@@ -8,16 +8,19 @@ import os.path
 from pkg.analyst.objects import Context, QuestionAnalysisResult
 from pkg.es.es_file import ESFileObject, FileES
 from pkg.es.es_company import CompanyES
+from pkg.es import entity_index
 from pkg.query_analysis import query_extract_uie
 from pkg.storage import Storage
 from pkg.utils import compress, decompress, ensure_list, has_intersection_list
 from pkg.utils.decorators import register_span_func
-from pkg.utils.jaeger import TracedThreadPoolExecutor
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.fragment_tree import fragment_tree_cache, fragment_tree_version
+from pkg.utils.stage_dag import stage_pool
 from pkg.config import config
-from difflib import get_close_matches, SequenceMatcher
+from difflib import SequenceMatcher
+from pkg.utils.fuzzy_match import get_close_matches
 from pkg.redis.redis import redis_store
 
+from concurrent.futures import wait
 from datetime import datetime
 import re
 
@@ -65,11 +68,10 @@ def preprocess_question(context: Context) -> Context:
     # question 校验
     question = replace_query(ori_question)
     if question:
-        _extract_info_t = ThreadWithReturnValue(target=get_extract_info, args=(question,))
-        _extract_info_t.start()
+        _extract_info_t = stage_pool.submit(get_extract_info, question)
 
         all_files = get_files_by_uuid(context.params.document_uuids)
-        extract_info = _extract_info_t.join()
+        extract_info = _extract_info_t.result()
     else:
         all_files = []
         extract_info = {}
@@ -89,7 +91,7 @@ def preprocess_question(context: Context) -> Context:
     context.question_analysis = analysis_result
 
     # extract commpany mapper
-    company_entities = CompanyES().search_company_by_eids_or_uids(list(set([_file.company for _file in all_files if _file.company])))
+    company_entities = entity_index.search_company_by_eids_or_uids(list(set([_file.company for _file in all_files if _file.company])))
     context.company_mapper.update({
         company.eid: company for company in company_entities
     })
@@ -256,7 +258,7 @@ def file_match(question, file_metas: list[ESFileObject], question_years, regular
     if company_eids:
         extract_company_names.extend(
             [
-                company.name for company in CompanyES().search_company_by_eids_or_uids(company_eids)
+                company.name for company in entity_index.search_company_by_eids_or_uids(company_eids)
             ]
         )
 
@@ -276,10 +278,9 @@ def file_match(question, file_metas: list[ESFileObject], question_years, regular
         # 构建线程列表
         threads = []
         for _extract_info in _extract_infos:
-            t = ThreadWithReturnValue(target=search_engine, args=(_extract_info, matches, 0.4, ))
-            t.start()
+            t = stage_pool.submit(search_engine, _extract_info, matches, 0.4)
             threads.append(t)
-        results = [t.join() for t in threads]
+        results = [t.result() for t in threads]
         for result in results:
             file_matches.extend(result)
 
@@ -395,11 +396,11 @@ def company_regular(question, companys):
     regular_companys = [
         regular_company
         for company in companys
-        for regular_company in CompanyES().search_company(company, size=1)
+        for regular_company in (entity_index.resolve_company(company) or CompanyES().search_company(company, size=1))
     ]
 
     if not regular_companys:
-        regular_companys = CompanyES().search_company(question, size=1)
+        regular_companys = entity_index.resolve_company(question) or CompanyES().search_company(question, size=1)
 
     regular_companys = list({obj.uuid: obj for obj in regular_companys}.values())
 
@@ -416,6 +417,11 @@ def get_files_by_uuid(uuids, with_doc_fragments_json=True):
 
 
 def attach_file_fragments_json(files: list[ESFileObject]):
+    # 进程内已缓存当前版本切片树的文件无需再拉取
+    files = [file for file in files if not fragment_tree_cache.contains(file.uuid, fragment_tree_version(file))]
+    if not files:
+        return
+
     uuids = [file.uuid for file in files]
     cache_keys = [f"fragment-{u}" for u in uuids]
     cached_results = redis_store.mget(cache_keys)
@@ -440,10 +446,7 @@ def attach_file_fragments_json(files: list[ESFileObject]):
             _file.doc_fragments_json = decompress(fragment_gz)
             redis_store.set(f"fragment-{_file.uuid}", fragment_gz)
 
-    with TracedThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(_attach_file_fragments_json, _file) for _file in uncached_files]
-        for _ in futures:
-            pass
+    wait([stage_pool.submit(_attach_file_fragments_json, _file) for _file in uncached_files])
 
 
 def get_extract_info(question):
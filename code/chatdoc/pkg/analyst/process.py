@@ -10,7 +10,8 @@ from pkg.analyst.objects import Params, Context, Response
 from pkg.utils.decorators import register_span_func
 from pkg.config import config
 from pkg.utils.logger import logger
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.stage_dag import Stage, StageDAG, get_stage_deadline
+from pkg.llm.async_stream import STREAM_END, as_chunk_stream, next_chunk
 from pkg.llm.util import check_repetition, get_stream_json, remove_repetition, set_stream_json, stream_fixes_suffix
 
 from opentelemetry import context as otel_context
@@ -39,15 +40,21 @@ def process(params: Params) -> Context:
     # 赋予trace_id
     context.trace_id = f"{get_current_span().context.trace_id:0x}"
 
-    # 并行合规检测
-    compliance_t = ThreadWithReturnValue(target=compliance_question, args=(context,), parent_span_context=span_ctx)
-    compliance_t.start()
+    # 合规检测与问题预处理并行，均完成后再进行召回
+    dag = StageDAG([
+        Stage("compliance_question", compliance_question),
+        Stage("preprocess_question", preprocess_question),
+        Stage("retrieve_small", retrieve_small, deps=["compliance_question", "preprocess_question"]),
+        # 问题与召回rerank
+        Stage("rerank_by_question", rerank_by_question, deps=["retrieve_small"]),
+        Stage("small2big", small2big, deps=["rerank_by_question"]),
+        # 组合&&截断
+        Stage("truncation", truncation, deps=["small2big"]),
+    ], stop_when=lambda context, done: context.question_compliance is False or (
+        {"compliance_question", "preprocess_question"} <= done and not context.files
+    ))
+    context = dag.run(context, deadline=get_stage_deadline())
 
-    # 预处理问题，分析问题，确定AgentType
-    context = preprocess_question(context)
-
-    # 预处理与合并检测并行
-    context = compliance_t.join()
     if context.question_compliance is False:
         context.answer_response = Response(answer=config["compliance"]["warning_text"], question_compliance=False, trace_id=context.trace_id, durations=context.durations)
         return context
@@ -56,23 +63,6 @@ def process(params: Params) -> Context:
         context.answer_response = Response(answer="未定位到相关文件，请检查问题或重新输入", question_compliance=True, trace_id=context.trace_id, durations=context.durations)
         return context
 
-    # if 2 <= len(context.files) <= 5:
-    #     # 并行召回
-    #     context = retrieve_parallel(context)
-    # else:
-    #     # 召回small片段
-    #     context = retrieve_small(context)
-    context = retrieve_small(context)
-
-    # 问题与召回rerank
-    context = rerank_by_question(context)
-
-    # small2big
-    context = small2big(context)
-
-    # 组合&&截断
-    context = truncation(context)
-
     # if no chat
     if context.params.no_chat:
         context.answer_response = gen_response_by_context(context)
@@ -130,7 +120,12 @@ def process(params: Params) -> Context:
     def _after_generation():
         nonlocal context
         answer_text = ""
-        for x in context.stream_iter:
+        stream_iter = as_chunk_stream(context.stream_iter)
+        while True:
+            # asgi 异步流式时 yield 出等待标记，由事件循环取回大模型的下一个 chunk
+            x = yield from next_chunk(stream_iter)
+            if x is STREAM_END:
+                break
             if not answer_text:
                 first_ts = time.time()
                 context.durations.update(
@@ -4,17 +4,18 @@ Date: 2024-05-27 17:50:27
 LastEditors: longsion
 LastEditTime: 2024-10-16 14:16:58
 '''
-import json
 
 import requests
 from pkg.analyst.common import fillin_doc_items_cache, fillin_fragment_children_cache
 from pkg.analyst.objects import Context
+from pkg.analyst.preprocess_question import attach_file_fragments_json
 from pkg.embedding.acge_embedding import get_similar_top_n
 from pkg.es.es_doc_table import DocTableES, DocTableModel
 from pkg.es.es_doc_fragment import DocFragmentES, DocFragmentModel
 from pkg.utils import edit_distance
 from pkg.utils.decorators import register_span_func
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.fragment_tree import fragment_tree_cache
+from pkg.utils.stage_dag import stage_pool
 from pkg.structure_static import match_fixed_tables, three_table_key_list
 from pkg.config import config
 from pkg.utils.logger import logger
@@ -42,7 +43,6 @@ def func_span(context: Context):
 @register_span_func(func_name="并行召回", span_export_func=func_span)
 def retrieve_parallel(context: Context) -> Context:
     document_uuids = [file.uuid for file in context.files]
-    fill_fragments_cache(context)
 
     context.rerank_retrieve_before_qa = []
 
@@ -76,6 +76,9 @@ def retrieve_parallel(context: Context) -> Context:
         context.normal_table_retrieve_small.extend(normal_table_retrieve_small)
         context.fragment_retrieve_small.extend(fragment_retrieve_small)
 
+    # 只对召回命中的文件从切片树缓存中填充 fragment cache
+    fill_fragments_cache(context, file_uuids={fragment.file_uuid for fragment in context.fragment_retrieve_small})
+
     # 填充子切片cache及ori_item的cache，方便后续步骤使用
     table_ori_ids = [
         (table_item.uuid, ori_id) for table_item in context.normal_table_retrieve_small + context.fixed_table_retrieve_small for ori_id in table_item.ori_id
@@ -100,17 +103,17 @@ def retrieve_parallel(context: Context) -> Context:
     # return context
 
 
-def fill_fragments_cache(context: Context):
-    # 从doc_fragments_json中更新 context.fragment_cache
+def fill_fragments_cache(context: Context, file_uuids: set[str] = None):
+    '''
+    description: 从进程内切片树缓存更新 context.fragment_cache，file_uuids 不为空时只填充召回命中的文件
+    return {*}
+    '''
     for file in context.files:
-        if file.doc_fragments_json:
-            doc_fragments = json.loads(file.doc_fragments_json)
-            if isinstance(doc_fragments, list):
-                # without embeddings
-                doc_fragments = [
-                    DocFragmentModel(**fragment, file_uuid=file.uuid) for fragment in doc_fragments
-                ]
-                context.fragment_cache.update({doc_fragment.uuid: doc_fragment for doc_fragment in doc_fragments})
+        if file_uuids is not None and file.uuid not in file_uuids:
+            continue
+        tree = fragment_tree_cache.load(file, fetch=lambda _file: attach_file_fragments_json([_file]))
+        if tree is not None:
+            context.fragment_cache.update(tree.models(DocFragmentModel))
 
 
 def retrieve_small_by_document(context: Context, uuid: str):
@@ -123,14 +126,12 @@ def retrieve_small_by_document(context: Context, uuid: str):
     # 文件三大表召回到了之后之后其他的召回就省略掉
     document_uuids = list(set(document_uuids) - set(fixed_table_file_uuids))
     if document_uuids:
-        _normal_table_retrieve_t = ThreadWithReturnValue(target=retrieve_by_table, args=(context, document_uuids))
-        _normal_table_retrieve_t.start()
+        _normal_table_retrieve_t = stage_pool.submit(retrieve_by_table, context, document_uuids)
 
-        _paragraph_retrieve_t = ThreadWithReturnValue(target=retrieve_by_paragraph, args=(context, document_uuids))
-        _paragraph_retrieve_t.start()
+        _paragraph_retrieve_t = stage_pool.submit(retrieve_by_paragraph, context, document_uuids)
 
-        normal_table_retrieve_small = _normal_table_retrieve_t.join()
-        fragment_retrieve_small = _paragraph_retrieve_t.join()
+        normal_table_retrieve_small = _normal_table_retrieve_t.result()
+        fragment_retrieve_small = _paragraph_retrieve_t.result()
 
     else:
         normal_table_retrieve_small = []
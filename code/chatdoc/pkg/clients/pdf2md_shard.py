@@ -0,0 +1,165 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-23 10:41:27
+LastEditors: longsion
+LastEditTime: 2025-03-23 18:05:52
+
+pdf2md 分片解析：本地按页拆分 PDF，分片并发请求 pdf2md，再将 detail / pages / metrics / catalog 按页序拼接为与整份解析一致的结果
+'''
+
+import io
+import time
+from collections import defaultdict
+
+from pkg.clients.textin_ocr import TextinOcr
+from pkg.config import config
+from pkg.utils import xjson
+from pkg.utils.logger import logger
+from pkg.utils.stage_dag import ContextPool
+
+SHARD_PAGES = int(config["pdf2md"].get("shard_pages", 0) or 0)
+SHARD_MIN_PAGES = int(config["pdf2md"].get("shard_min_pages", 0) or 0)
+
+# 进程级共享，多个文件同时解析时总并发仍有上限(池满时在调用线程中执行)
+shard_pool = ContextPool(max_workers=int(config["pdf2md"].get("shard_parallels", 4)), thread_name_prefix="pdf2md_shard")
+
+
+def recognize_pdf2md_json(data: bytes) -> dict:
+    """
+    调用 pdf2md 并返回解析后的 json，页数超过 shard_min_pages 的 PDF 分片并发解析
+    任一分片 code != 200 时返回该分片结果，由调用方处理
+    """
+    shards = split_pdf(data)
+    if not shards:
+        return _recognize(data)
+
+    st = time.time()
+    futures = [shard_pool.submit(_recognize, shard, dict(page_start=0, page_count=page_count)) for _, page_count, shard in shards]
+    results = [future.result() for future in futures]
+    for result in results:
+        if result.get("code") != 200:
+            return result
+
+    logger.info(f"pdf2md shard parse cost: {1000*(time.time() - st):.1f}ms, shards: {len(shards)}")
+    return merge_pdf2md_results([(page_offset, result) for (page_offset, _, _), result in zip(shards, results)])
+
+
+def _recognize(data: bytes, options: dict = None) -> dict:
+    response = TextinOcr().recognize_pdf2md(image=data, options=options)
+    response.raise_for_status()
+    return xjson.loads(response.content)
+
+
+def split_pdf(data: bytes, shard_pages: int = SHARD_PAGES, min_pages: int = SHARD_MIN_PAGES) -> list[tuple[int, int, bytes]]:
+    """
+    按 shard_pages 页拆分 PDF，返回 [(页偏移, 页数, 子文档)]
+    只解析 options 中 page_start / page_count 范围内的页；非 PDF、加密、页数不足或拆分失败时返回空列表，按整份解析
+    """
+    if not shard_pages or not data.startswith(b"%PDF"):
+        return []
+
+    try:
+        from pypdf import PdfReader, PdfWriter
+
+        reader = PdfReader(io.BytesIO(data))
+        if reader.is_encrypted:
+            return []
+
+        options = TextinOcr().options
+        start = options["page_start"]
+        end = min(len(reader.pages), start + options["page_count"])
+        if end - start <= max(shard_pages, min_pages):
+            return []
+
+        shards = []
+        for shard_start in range(start, end, shard_pages):
+            shard_end = min(shard_start + shard_pages, end)
+            writer = PdfWriter()
+            for page_idx in range(shard_start, shard_end):
+                writer.add_page(reader.pages[page_idx])
+            buffer = io.BytesIO()
+            writer.write(buffer)
+            shards.append((shard_start - start, shard_end - shard_start, buffer.getvalue()))
+        return shards
+    except Exception as e:
+        logger.warning(f"pdf2md split pdf failed, parse whole document: {e}")
+        return []
+
+
+def merge_pdf2md_results(results: list[tuple[int, dict]]) -> dict:
+    """
+    按页序拼接分片结果
+    - detail / pages / metrics / catalog.toc 的 page_id 加上分片页偏移
+    - paragraph_id 为全文连续编号时顺延，为页内编号时保持不变
+    - markdown 依次拼接，页数类计数(*_number / *_count)求和
+    :param results: [(页偏移, 分片结果)]，按页偏移升序
+    """
+    paragraph_id_per_page = _paragraph_id_per_page([result["result"].get("detail") or [] for _, result in results])
+
+    merged = {**results[0][1], "result": dict(results[0][1]["result"])}
+    merged_result = merged["result"]
+    detail, pages, metrics, toc, markdowns = [], [], [], [], []
+    counts = defaultdict(int)
+    paragraph_offset = 0
+
+    for page_offset, result in results:
+        shard_result = result["result"]
+
+        shard_detail = shard_result.get("detail") or []
+        for item in shard_detail:
+            _shift_page_id(item, page_offset)
+            if not paragraph_id_per_page and "paragraph_id" in item:
+                item["paragraph_id"] += paragraph_offset
+        if not paragraph_id_per_page:
+            paragraph_offset = max([item["paragraph_id"] + 1 for item in shard_detail if "paragraph_id" in item] + [paragraph_offset])
+        detail.extend(shard_detail)
+
+        for page in shard_result.get("pages") or []:
+            pages.append(_shift_page_id(page, page_offset))
+        for metric in result.get("metrics") or []:
+            metrics.append(_shift_page_id(metric, page_offset))
+        for item in (shard_result.get("catalog") or {}).get("toc") or []:
+            toc.append(_shift_page_id(item, page_offset))
+
+        if shard_result.get("markdown"):
+            markdowns.append(shard_result["markdown"])
+
+        for key, value in shard_result.items():
+            if (key.endswith("_number") or key.endswith("_count")) and isinstance(value, int):
+                counts[key] += value
+
+    merged_result.update(detail=detail, pages=pages, markdown="\n\n".join(markdowns), **counts)
+    if "catalog" in merged_result:
+        merged_result["catalog"] = {**merged_result["catalog"], "toc": toc}
+    merged["metrics"] = metrics
+    return merged
+
+
+def _shift_page_id(item: dict, page_offset: int) -> dict:
+    if isinstance(item.get("page_id"), int):
+        item["page_id"] += page_offset
+    return item
+
+
+def _paragraph_id_per_page(details: list[list[dict]]) -> bool:
+    """
+    paragraph_id 是否为页内编号：分片内除首个有段落的页外，页内最小 paragraph_id 为 0 即页内编号，大于 0 即全文编号
+    没有段落的页不参与判断；所有分片都不足两页有段落、无法判断时按页内编号处理，不改写 paragraph_id，(page_id, paragraph_id) 依然唯一
+    """
+    global_numbered = False
+    for detail in details:
+        min_ids = {}
+        for item in detail:
+            if "paragraph_id" in item and "page_id" in item:
+                min_ids[item["page_id"]] = min(min_ids.get(item["page_id"], item["paragraph_id"]), item["paragraph_id"])
+        if not min_ids:
+            continue
+
+        first_page_id = min(min_ids)
+        for page_id, min_id in min_ids.items():
+            if page_id == first_page_id:
+                continue
+            if min_id == 0:
+                return True
+            global_numbered = True
+    return not global_numbered
@@ -2,7 +2,7 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-10-12 10:13:59
 LastEditors: longsion
-LastEditTime: 2025-03-09 08:13:19
+LastEditTime: 2025-03-23 17:12:40
 '''
 import requests
 from pkg.config import config
@@ -30,10 +30,10 @@ class TextinOcr(object):
             'parse_mode': config["pdf2md"]["options_parse_mode"] or 'auto',
         }
 
-    def recognize_pdf2md(self, image):
+    def recognize_pdf2md(self, image, options: dict = None):
         """
         pdf to markdown
-        :param options: request params
+        :param options: 覆盖默认的 request params(如分片解析时的 page_start / page_count)
         :param image: file bytes
         :return: response
 
@@ -57,4 +57,4 @@ class TextinOcr(object):
             'x-ti-secret-code': self._app_secret
         }
 
-        return requests.post(self.url, data=image, headers=headers, params=self.options)
+        return requests.post(self.url, data=image, headers=headers, params={**self.options, **(options or {})})
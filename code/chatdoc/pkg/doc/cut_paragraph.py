@@ -2,15 +2,24 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-16 14:42:21
 LastEditors: longsion
-LastEditTime: 2024-07-16 23:18:55
+LastEditTime: 2025-03-22 15:36:08
 '''
 
 from pkg.utils.decorators import register_span_func
-from pkg.utils.transform import is_financial_string, markdown2list, uneven_list_to_markdown_table
-from .objects import Context, DocTreeNode, Fragment
+from pkg.utils import duplicates_list
+from pkg.utils.incremental_index import assign_content_ids, incremental_index_enabled
+from pkg.utils.process_pool import run_cpu_task
+from pkg.utils.transform import html2markdown, is_financial_string, markdown2list, uneven_list_to_markdown_table
+from pkg.utils.table_engine import MarkdownTableLength
+from .objects import Context, DocOriItem, DocTreeNode, Fragment
 import uuid
+from typing import Iterable, Iterator
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+# 入库时预计算子树字段的节点上限(tree_token_length)，控制切片树 json 的大小；
+# small2big 的 2000 只判断召回叶子自身的 tree_token_length，不限制父节点，父节点超过此上限时问答侧走递归拼接
+MATERIALIZE_MAX_TREE_TOKENS = 2000
+
 
 @register_span_func(func_name="段落切片", span_export_func=lambda context: dict(
     params=context.params.model_dump(),
@@ -23,11 +32,37 @@ def cut_paragraph_fragment(context: Context) -> Context:
     段落切片数据上报
     row_texts: 段落切片逻辑
     """
-    context.doc_fragments = create_fragments(context.doc_tree.tree[0])
+    # 纯 CPU 计算，开启进程池时在子进程中执行
+    context.doc_fragments = run_cpu_task(
+        build_fragments, context.doc_tree.tree[0], context.doc_ori_items,
+        content_id_scope=context.params.uuid if incremental_index_enabled() else "",
+    )
 
     return context
 
 
+def build_fragments(root: DocTreeNode, doc_ori_items: list[DocOriItem], content_id_scope: str = "") -> list[Fragment]:
+    """
+    生成切片并预先计算子树字段
+    :param content_id_scope: 不为空时(增量入库)切片 id 由内容生成，重新解析时未变化的切片 id 不变
+    """
+    fragments = create_fragments(root)
+    if content_id_scope:
+        assign_content_ids(content_id_scope, fragments)
+    materialize_fragment_trees(fragments, doc_ori_items)
+    return fragments
+
+
+def cut_paragraph_fragment_stream(context: Context) -> Iterator[Fragment]:
+    """
+    流式段落切片：按后序(子节点先于父节点)逐个产出切片，同时计算子树字段并追加到 context.doc_fragments
+    增量入库需要全量切片生成 id 并做对比，不走流式
+    """
+    for fragment in iter_materialized_fragments(iter_fragments(context.doc_tree.tree[0]), context.doc_ori_items):
+        context.doc_fragments.append(fragment)
+        yield fragment
+
+
 def create_fragments(node: DocTreeNode, parent_uuid: str = "", level: int = 1, titles=[]) -> list[Fragment]:
     """
     递归地将DocTreeNode转换为Fragment列表。
@@ -37,7 +72,13 @@ def create_fragments(node: DocTreeNode, parent_uuid: str = "", level: int = 1, t
     :param level: 当前节点在树中的层级，默认为1。
     :return: 由当前节点及其子节点生成的Fragment列表。
     """
-    fragments = []
+    return list(iter_fragments(node, parent_uuid, level, titles))
+
+
+def iter_fragments(node: DocTreeNode, parent_uuid: str = "", level: int = 1, titles=[]) -> Iterator[Fragment]:
+    """
+    create_fragments 的生成器版本，按后序产出切片：子节点先于父节点，父节点产出时 children_fragment_uuids / tree_token_length 已完整
+    """
     content = "\n".join(node.content)
 
     # 处理带有子节点的Heading节点【目录除外】
@@ -56,19 +97,20 @@ def create_fragments(node: DocTreeNode, parent_uuid: str = "", level: int = 1, t
         child_level = level + 1
         child_titles = titles if node.label.upper() == "ROOT" else titles + [content]
         for child in node.children:
-            child_fragments = create_fragments(child, fragment.uuid, child_level, child_titles)
             # 包含了所有子树的节点
-            fragments.extend(child_fragments)
-            # 仅获取第一层的子节点uuid
-            fragment.children_fragment_uuids.extend([f.uuid for f in child_fragments if f.parent_frament_uuid == fragment.uuid])
-            fragment.tree_token_length += sum(f.tree_token_length for f in child_fragments if f.parent_frament_uuid == fragment.uuid)
+            for child_fragment in iter_fragments(child, fragment.uuid, child_level, child_titles):
+                # 仅获取第一层的子节点uuid
+                if child_fragment.parent_frament_uuid == fragment.uuid:
+                    fragment.children_fragment_uuids.append(child_fragment.uuid)
+                    fragment.tree_token_length += child_fragment.tree_token_length
+                yield child_fragment
 
-        fragments.append(fragment)
+        yield fragment
 
     elif node.label.lower() == "text":   # 处理叶子节点text
 
         chunks, offsets = split_with_offsets(content, chunk_size=500, chunk_overlap=20)
-        fragments.extend(
+        yield from (
             Fragment(
                 uuid=str(uuid.uuid4()),  # 生成唯一uuid
                 ori_id=node.ori_id,
@@ -93,7 +135,7 @@ def create_fragments(node: DocTreeNode, parent_uuid: str = "", level: int = 1, t
     elif node.label.lower() == "table":  # 处理叶子节点table
 
         sub_tables = split_table_by_token_limit(content, token_limit=1000)
-        fragments.extend(
+        yield from (
             Fragment(
                 uuid=str(uuid.uuid4()),  # 生成唯一uuid
                 ori_id=node.ori_id,
@@ -116,7 +158,69 @@ def create_fragments(node: DocTreeNode, parent_uuid: str = "", level: int = 1, t
             ) for _idx, (_title_row_idx, _start_row_idx, _end_row_idx, _markdown_str) in enumerate(sub_tables)
         )
 
-    return fragments
+
+def materialize_fragment_trees(fragments: list[Fragment], doc_ori_items: list[DocOriItem]):
+    """
+    入库时预先计算切片子树的 ori_ids / 原文 / 原文列表，问答时直接读取，避免每次递归拼接及 html2markdown
+    计算逻辑与问答侧 common.get_fragment_ori_ids / get_fragment_ori_text / get_fragment_all_texts 保持一致
+    叶子文本切片直接按 ori_id 取原文即可，不做预计算；ROOT、子树超过 MATERIALIZE_MAX_TREE_TOKENS 以及缺少原文的节点及其祖先不做预计算，问答时走原有的递归逻辑
+
+    :param fragments: create_fragments 的结果(后序，子节点总在父节点之前)
+    :param doc_ori_items: ori_id 对应的原文
+    """
+    for _ in iter_materialized_fragments(fragments, doc_ori_items):
+        pass
+
+
+def iter_materialized_fragments(fragments: Iterable[Fragment], doc_ori_items: list[DocOriItem]) -> Iterator[Fragment]:
+    """
+    逐个计算切片子树字段并产出，fragments 需为后序
+    """
+    ori_contents = {ori_id: item.content for item in doc_ori_items for ori_id in item.ori_id if isinstance(item.content, str)}
+    fragment_map = {}
+
+    for fragment in fragments:
+        fragment_map[fragment.uuid] = fragment
+        _materialize_fragment_tree(fragment, fragment_map, ori_contents)
+        yield fragment
+
+
+def _materialize_fragment_tree(fragment: Fragment, fragment_map: dict[str, Fragment], ori_contents: dict[str, str]):
+
+    def leaf_text(fragment: Fragment):
+        content = ori_contents[fragment.ori_id[0]]
+        return html2markdown(content) if content.startswith("<table border=") else content
+
+    if not fragment.ori_id or fragment.ori_id[0] not in ori_contents:
+        return
+
+    if fragment.leaf:
+        if ori_contents[fragment.ori_id[0]].startswith("<table border="):
+            fragment.tree_text = leaf_text(fragment)
+            fragment.tree_all_texts = [fragment.tree_text]
+        return
+
+    # 只预计算子树较小的节点，ROOT 及大章节的全文会使切片树 json 随层数成倍膨胀，问答时按需递归拼接
+    if fragment.type == "root" or fragment.tree_token_length >= MATERIALIZE_MAX_TREE_TOKENS:
+        return
+
+    children = [fragment_map[child_uuid] for child_uuid in fragment.children_fragment_uuids]
+    if any(not child.ori_id or child.ori_id[0] not in ori_contents or (not child.leaf and not child.tree_ori_ids) for child in children):
+        return
+
+    children_ori_ids = duplicates_list([child.ori_id if child.leaf else child.tree_ori_ids for child in children], lambda x: "|".join(x))
+    ori_ids = list(set(fragment.ori_id + [ori_id for child_ori_ids in children_ori_ids for ori_id in child_ori_ids]))
+    ori_ids.sort(key=lambda x: tuple([int(_x) for _x in x.split(",")]))
+
+    child_texts = duplicates_list([child.tree_text or leaf_text(child) for child in children])
+    children_all_texts = duplicates_list([
+        text for child in children for text in (child.tree_all_texts or [leaf_text(child)])
+    ])
+
+    content = ori_contents[fragment.ori_id[0]]
+    fragment.tree_ori_ids = ori_ids
+    fragment.tree_text = "#" * (fragment.level + 1) + " " + content + "\n" + "\n".join(child_texts)
+    fragment.tree_all_texts = [content] + children_all_texts
 
 
 def split_with_offsets(text, chunk_size, chunk_overlap):
@@ -153,10 +257,12 @@ def split_table_by_token_limit(table_markdown: str, token_limit: int = 1000):
 
         if not sub_table:
             sub_table = [title_row, row]
+            sub_table_length = MarkdownTableLength(fill_value="-").add(title_row).add(row)
             start_row_idx = row_id
             continue
 
-        if len(uneven_list_to_markdown_table(sub_table + [row], fill_value="-")) > token_limit:
+        # 增量计算加入该行后的 markdown 长度，不再每行重新生成整张子表
+        if sub_table_length.length(row) > token_limit:
             markdown_str = uneven_list_to_markdown_table(sub_table, fill_value="-")
             sub_tables.append(
                 (title_row_idx, start_row_idx, row_id - 1, markdown_str)
@@ -165,6 +271,7 @@ def split_table_by_token_limit(table_markdown: str, token_limit: int = 1000):
 
         else:
             sub_table.append(row)
+            sub_table_length.add(row)
 
     if sub_table:
         sub_tables.append(
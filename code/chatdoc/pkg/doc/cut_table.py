@@ -2,16 +2,19 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-15 14:32:13
 LastEditors: longsion
-LastEditTime: 2024-10-18 15:01:18
+LastEditTime: 2025-03-25 17:33:09
 '''
 
 
 import time
 from .objects import Context, DocOriItem, DocOriItemType, DocTableRowItem, DocTableType
 from pkg.utils.decorators import register_span_func
-from pkg.utils.transform import markdown2list, list2markdown, is_financial_string, financial_string_to_number
+from pkg.utils.transform import markdown2list, list2markdown
+from pkg.utils.table_engine import parse_financial_number
 from pkg.structure_static import three_table_set
+from pkg.utils.incremental_index import content_doc_ids, incremental_index_enabled
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.process_pool import run_cpu_task
 from pkg.utils.logger import logger
 
 import re
@@ -31,39 +34,41 @@ def cut_table_fragment(context: Context) -> Context:
 
     all_tables = [doc_ori_item for doc_ori_item in context.doc_ori_items if doc_ori_item.type == DocOriItemType.TABLE]
 
-    for table in all_tables:
+    # 纯 CPU 计算，开启进程池时在子进程中执行
+    context.doc_table_row_items.extend(run_cpu_task(extract_table_rows, all_tables))
+
+    # multi_embedding and upload to es
+    thread = ThreadWithReturnValue(target=embedding_and_upload, args=(context.doc_table_row_items, context.params.uuid, context.generation))
+    thread.start()
+    context.threads.append(thread)
+
+    return context
+
+
+def extract_table_rows(tables: list[DocOriItem]) -> list[DocTableRowItem]:
+    """
+    表格拆解为行数据
+    """
+    row_items = []
+    for table in tables:
         table_title = table.titles[-1] if table.titles else ""
         table_title = re.sub(r'[第一二三四五六七八九十零壹贰叁肆伍陆柒捌玖拾章节、（）()0123456789. ]', '', table_title)
         # 三大表
         if table_title in three_table_set:
-            row_items = extract_row_data_from_three_table(table)
+            row_items.extend(extract_row_data_from_three_table(table))
         # 普通表
         else:
-            row_items = extract_row_data_from_normal_table(table)
+            row_items.extend(extract_row_data_from_normal_table(table))
 
-        context.doc_table_row_items.extend(row_items)
+    return row_items
 
-    # multi_embedding and upload to es
-    thread = ThreadWithReturnValue(target=embedding_and_upload, args=(context.doc_table_row_items, context.params.uuid))
-    thread.start()
-    context.threads.append(thread)
-
-    return context
 
-
-def embedding_and_upload(doc_table_row_items: list[DocTableRowItem], file_uuid: str):
+def embedding_and_upload(doc_table_row_items: list[DocTableRowItem], file_uuid: str, generation: str = ""):
     from pkg.es.es_doc_table import DocTableES, DocTableModel
 
     start_time = time.time()
 
-    # 删除老切片
-    DocTableES().delete_by_file_uuid(file_uuid, wait_delete=True)
-
-    if not doc_table_row_items:
-        logger.warning(f"File cut has 0 table, file_uuid: {file_uuid}")
-        return True
-
-    success = DocTableES().insert_doc_tables([
+    doc_tables = [
         DocTableModel(
             uuid=file_uuid,
             title=item.title,
@@ -72,12 +77,36 @@ def embedding_and_upload(doc_table_row_items: list[DocTableRowItem], file_uuid:
             row_id=item.row_id,
             keywords=item.keywords,
             ebed_text=item.row_ebed_str,
+            generation=generation,
         )
         for item in doc_table_row_items
-    ])
+    ]
+
+    if incremental_index_enabled():
+        # 增量入库：ES _id 由行内容生成，只删除已不存在的行、插入新增的行
+        doc_ids = content_doc_ids(file_uuid, [doc_table.model_dump(exclude={"generation"}) for doc_table in doc_tables])
+        existing_ids = set(DocTableES().get_ids_by_file_uuid(file_uuid))
+        added = [(doc_id, doc_table) for doc_id, doc_table in zip(doc_ids, doc_tables) if doc_id not in existing_ids]
+        removed_ids = list(existing_ids - set(doc_ids))
+
+        success = DocTableES().delete_by_ids(removed_ids) and DocTableES().insert_doc_tables(
+            [doc_table for _, doc_table in added], doc_ids=[doc_id for doc_id, _ in added])
+        logger.info(f"Table Incremental Update Es, file_uuid: {file_uuid}, success: {success}, added: {len(added)}, removed: {len(removed_ids)}, "
+                    f"unchanged: {len(doc_tables) - len(added)}, Elapsed: {1000*(time.time() - start_time):.1f}ms")
+        return success
+
+    if not generation:
+        # 删除老切片；按 generation 入库时旧数据在切换后回收
+        DocTableES().delete_by_file_uuid(file_uuid, wait_delete=True)
+
+    if not doc_table_row_items:
+        logger.warning(f"File cut has 0 table, file_uuid: {file_uuid}")
+        return True
+
+    success = DocTableES().insert_doc_tables(doc_tables)
 
     if not success:
-        logger.error(f"Table Update Es Not Success, file_uuid: {file_uuid}, exception: {e}")
+        logger.error(f"Table Update Es Not Success, file_uuid: {file_uuid}")
     else:
         logger.info(f"Table Update Es All Successed, file_uuid: {file_uuid},  docs: {len(doc_table_row_items)}, Elapsed: {1000*(time.time() - start_time):.1f}ms")
 
@@ -117,6 +146,8 @@ def extract_row_data_from_three_table(table: DocOriItem) -> list[DocTableRowItem
                 continue
 
         row_texts = []
+        # 每个单元格只解析一次数值，非数值为 None
+        row_numbers = [parse_financial_number(cell_data) for cell_data in row_data]
 
         # 默认：title列为第1列
         row_title = row_data[0]
@@ -126,8 +157,8 @@ def extract_row_data_from_three_table(table: DocOriItem) -> list[DocTableRowItem
             if not col_title:
                 continue
 
-            if is_financial_string(cell_data):
-                cell_number = financial_string_to_number(cell_data)
+            cell_number = row_numbers[col_idx]
+            if cell_number is not None:
                 row_texts.append(f"{col_title}的{row_title}是{cell_number}元")
 
             else:
@@ -146,7 +177,7 @@ def extract_row_data_from_three_table(table: DocOriItem) -> list[DocTableRowItem
                 type=DocTableType.THREE_TABLE,
                 row_id=row_idx,
                 keywords=list(filter(lambda x: x,
-                                     [_clean_text(keyword) for keyword in list(filter(lambda x: not is_financial_string(x), row_data))]
+                                     [_clean_text(keyword) for keyword, number in zip(row_data, row_numbers) if number is None]
                                      )),
                 row_ebed_str=f"## {table_title} \n" + "\n".join([_clean_text(row_text) for row_text in row_texts])
             )
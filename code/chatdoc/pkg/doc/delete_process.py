@@ -15,10 +15,19 @@ def process(params: DeleteParams) -> bool:
     from pkg.es.es_doc_table import DocTableES
     from pkg.es.es_doc_item import DocItemES
     from pkg.es.es_file import FileES
+    from pkg.es.generation import generation_enabled, retire_files
     from pkg.vdb import delete_vdb_uuids
+    from pkg.utils.fragment_tree import fragment_tree_cache
 
     # 删除文件：需要删除个人知识库ES中的内容，也需要删除向量库中的内容
 
+    if generation_enabled():
+        # 切换到空的 generation，查询立即不可见，ES 数据后台删除，无需等待删除完成
+        retire_files(params.uuids)
+        result = delete_vdb_uuids(params.uuids)
+        fragment_tree_cache.invalidate(params.uuids)
+        return result
+
     es_threads = []
     for func in [DocFragmentES().delete_by_file_uuids,
                  DocTableES().delete_by_file_uuids,
@@ -30,6 +39,7 @@ def process(params: DeleteParams) -> bool:
 
     # 删除向量库的向量
     result = delete_vdb_uuids(params.uuids)
+    fragment_tree_cache.invalidate(params.uuids)
 
     for t in es_threads:
         result = result and (t.join() is None)
@@ -17,6 +17,7 @@ from pkg.es.es_file import ESFileObject, FileES
 from pkg.openkie import ie_vllm
 from pkg.config import config
 from pkg.redis.redis import redis_store
+from pkg.utils.fragment_tree import fragment_tree_cache
 
 FinancialFileTypes = [
     FileTypeEnum.ZhaoGuShuoMingShu,
@@ -65,7 +66,9 @@ def extract_file_meta(context: Context) -> Context:
     context.file_meta.knowledge_id = context.params.knowledge_id
     context.file_meta.ori_type = context.params.ori_type
 
-    FileES().delete_by_file_uuid(context.params.uuid, wait_delete=True)
+    if not context.generation:
+        # 按 generation 入库时旧文件信息在切换后回收
+        FileES().delete_by_file_uuid(context.params.uuid, wait_delete=True)
 
     context.es_file_entity = ESFileObject(
         uuid=context.params.uuid,
@@ -84,11 +87,14 @@ def extract_file_meta(context: Context) -> Context:
         summary=context.file_meta.summary,
         doc_fragments_json=xjson.dumps(gen_doc_fragments_json(context)),  # , ensure_ascii=False
         tree_summaries=context.file_meta.tree_summaries,
+        generation=context.generation,
     )
 
-    upload_doc_parse_thread = ThreadWithReturnValue(target=upload_doc_fragments_json, args=(context.es_file_entity.doc_fragments_json, context.params.uuid))
-    upload_doc_parse_thread.start()
-    context.threads.append(upload_doc_parse_thread)
+    if not context.generation:
+        # 按 generation 入库时切片树与切片一起在切换时更新
+        upload_doc_parse_thread = ThreadWithReturnValue(target=upload_doc_fragments_json, args=(context.es_file_entity.doc_fragments_json, context.params.uuid))
+        upload_doc_parse_thread.start()
+        context.threads.append(upload_doc_parse_thread)
 
     return context
 
@@ -97,6 +103,8 @@ def upload_doc_fragments_json(doc_fragments_json: str, uuid: str):
     stream = compress(doc_fragments_json)
     redis_store.set(f"fragment-{uuid}", stream)
     Storage.upload(f"fragments-{uuid}.gz", stream)
+    # 重新解析后旧的切片树失效，其他进程依赖 upload_time 版本号判断
+    fragment_tree_cache.invalidate([uuid])
 
 
 def extract_file_type(context: Context) -> FileTypeEnum:
@@ -15,7 +15,7 @@ from pkg.config import BASE_DIR, config
 from pkg.doc.doc_parse import local_or_remote_exist as local_or_remote_exist_doc_parse, upload_doc_parser
 from pkg.doc.catalog import local_or_remote_exist as local_or_remote_exist_catalog, upload_catalog
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
-from pkg.clients.textin_ocr import TextinOcr
+from pkg.clients.pdf2md_shard import recognize_pdf2md_json
 from pkg.utils.logger import logger
 
 
@@ -61,9 +61,8 @@ def request_parser(context: Context):
     with open(filepath, 'rb') as f:
         data = f.read()
     st = time.time()
-    response = TextinOcr().recognize_pdf2md(image=data)
-    response.raise_for_status()
-    res_json_all = xjson.loads(response.content)
+    # 页数较多的 PDF 按页分片并发解析
+    res_json_all = recognize_pdf2md_json(data)
     if res_json_all["code"] != 200:
         raise FileProcessException(f"pdf2md parse error: {res_json_all}")
 
@@ -2,23 +2,20 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-15 11:02:22
 LastEditors: longsion
-LastEditTime: 2024-10-29 10:10:18
+LastEditTime: 2025-03-25 17:20:31
 '''
 
 
 import re
-import pypeln as pl
-import requests
 
 from pkg.storage import Storage
 from .objects import Context, DocTreeNode, DocOriItem, DocOriItemType
 from pkg.utils.decorators import register_span_func
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.process_pool import run_cpu_task
 from pkg.utils.transform import html2markdown
-from pkg.utils.generator import batch_generator_with_index
 from pkg.utils import compress, plat_call, xjson
 from pkg.es.es_doc_item import DocItemES, DocItemModel
-from pkg.config import config
 
 
 @register_span_func(func_name="目录树预处理", span_export_func=lambda context: dict(
@@ -34,17 +31,11 @@ def preprocess_doctree(context: Context) -> Context:
     # 2. 方便切片逻辑的数据获取，以及存储
     """
 
-    context.doc_ori_items, doc_tree_nodes = doctree_dfs(context.doc_tree.tree[0])
-    table_items_nodes = [
-        (doc_ori_item, doc_tree_node) for doc_ori_item, doc_tree_node in zip(context.doc_ori_items, doc_tree_nodes) if doc_ori_item.type == DocOriItemType.TABLE
-    ]
-    markdowns = plat_call([merge_table(doc_ori_item.content) for doc_ori_item, _ in table_items_nodes], html_list_2_markdown)
-    for (doc_ori_item, doc_tree_node), content_markdown_list in zip(table_items_nodes, markdowns):
-        doc_ori_item.content = "\n".join(content_markdown_list)
-        doc_tree_node.content = [doc_ori_item.content]
+    # 纯 CPU 计算，开启进程池时在子进程中执行，返回的是目录树副本，需替换回 context
+    context.doc_ori_items, context.doc_tree.tree[0] = run_cpu_task(build_doc_ori_items, context.doc_tree.tree[0])
     # upload to es
 
-    thread = ThreadWithReturnValue(target=upload_ori_items_to_es, args=(context.doc_ori_items, context.params.uuid))
+    thread = ThreadWithReturnValue(target=upload_ori_items_to_es, args=(context.doc_ori_items, context.params.uuid, context.generation))
     upload_merge_thread = ThreadWithReturnValue(target=upload_merge_file, args=(context.doc_ori_items, context.params.uuid))
     thread.start()
     upload_merge_thread.start()
@@ -54,24 +45,28 @@ def preprocess_doctree(context: Context) -> Context:
     return context
 
 
-@register_span_func()
+def build_doc_ori_items(root: DocTreeNode) -> tuple[list[DocOriItem], DocTreeNode]:
+    '''
+    description: 遍历目录树生成原文列表，表格 html 合并后转为 markdown 并回写到目录树节点
+    return {*} (原文列表, 目录树根节点)
+    '''
+    doc_ori_items, doc_tree_nodes = doctree_dfs(root)
+    table_items_nodes = [
+        (doc_ori_item, doc_tree_node) for doc_ori_item, doc_tree_node in zip(doc_ori_items, doc_tree_nodes) if doc_ori_item.type == DocOriItemType.TABLE
+    ]
+    markdowns = plat_call([merge_table(doc_ori_item.content) for doc_ori_item, _ in table_items_nodes], html_list_2_markdown)
+    for (doc_ori_item, doc_tree_node), content_markdown_list in zip(table_items_nodes, markdowns):
+        doc_ori_item.content = "\n".join(content_markdown_list)
+        doc_tree_node.content = [doc_ori_item.content]
+    return doc_ori_items, root
+
+
 def html_list_2_markdown(tables):
     '''
-    description: 耗时超过，超过20个，则走proxy的并发处理
+    description: html 表格转 markdown，lxml 单次解析，本地处理即可，不再走 proxy 的并发处理
     return {*}
     '''
-    if len(tables) < 20:
-        return [html2markdown(table) for table in tables]
-    else:
-        url = config["proxy"]["url"]
-        batch_size = max(len(tables) // 10 + 1, 10)
-        workers = min(len(tables) // batch_size + 1, 10)
-        markdown_tables_2d = batch_generator_with_index(tables, batch_size) | pl.thread.map(
-            lambda x: (x[0], requests.post(f"{url}/transform/html2markdown", json=x[1]).json()), workers=workers, maxsize=workers
-        ) | list
-        markdown_tables_2d.sort(key=lambda x: x[0], reverse=False)
-        markdown_tables = [_markdown_table for _, _markdown_tables in markdown_tables_2d for _markdown_table in _markdown_tables]
-        return markdown_tables
+    return [html2markdown(table) for table in tables]
 
 
 def doctree_dfs(doctree_node: DocTreeNode, titles=[]) -> list[DocOriItem]:
@@ -106,25 +101,23 @@ def doctree_dfs(doctree_node: DocTreeNode, titles=[]) -> list[DocOriItem]:
     return r1, r2
 
 
-def upload_ori_items_to_es(doc_ori_items: list[DocOriItem], file_uuid: str):
-
-    DocItemES().delete_by_file_uuid(file_uuid, wait_delete=True)
-
-    batch_size = 1000
-    for i in range(0, len(doc_ori_items), batch_size):
+def upload_ori_items_to_es(doc_ori_items: list[DocOriItem], file_uuid: str, generation: str = ""):
 
-        batch_items = [
-            DocItemModel(
-                uuid=file_uuid,
-                titles=doc_ori_item.titles,
-                ori_id=doc_ori_item.ori_id,
-                content=doc_ori_item.content,
-                type=doc_ori_item.type.value,
-            )
-            for doc_ori_item in doc_ori_items[i:i + batch_size]
-        ]
+    if not generation:
+        # 按 generation 入库时旧数据在切换后回收，无需先删除
+        DocItemES().delete_by_file_uuid(file_uuid, wait_delete=True)
 
-        DocItemES().insert_doc_items(batch_items)
+    return DocItemES().insert_doc_items((
+        DocItemModel(
+            uuid=file_uuid,
+            titles=doc_ori_item.titles,
+            ori_id=doc_ori_item.ori_id,
+            content=doc_ori_item.content,
+            type=doc_ori_item.type.value,
+            generation=generation,
+        )
+        for doc_ori_item in doc_ori_items
+    ), size_hint=len(doc_ori_items))
 
 
 def upload_merge_file(doc_ori_items: list[DocOriItem], file_uuid: str):
@@ -2,18 +2,36 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-07-04 22:09:38
 LastEditors: longsion
-LastEditTime: 2024-10-16 15:48:23
+LastEditTime: 2025-03-22 16:20:47
 '''
 
+import time
+from typing import Iterable
+
 import pypeln as pl
 import requests
 from pkg.config import config
 from pkg.utils.decorators import register_span_func
 from pkg.utils.generator import batch_generator
-from .objects import Context, Fragment
+from .objects import Context, Fragment, VectorEntity
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
-from pkg.es.es_doc_fragment import DocFragmentES, DocFragmentModel
+from pkg.es import global_es
+from pkg.es.bulk_writer import RELAX_REFRESH_DOCS
+from pkg.es.es_doc_fragment import MATERIALIZED_TREE_KEYS, DocFragmentES, DocFragmentModel
+from pkg.utils.incremental_index import diff_fragments, incremental_index_enabled
 from pkg.utils.logger import logger
+from pkg.vdb import use_es_single_write, use_local_vdb
+
+STREAMING_CONFIG = config["parse"].get("streaming") or {}
+STREAMING_BATCH_SIZE = int(STREAMING_CONFIG.get("batch_size", 200))
+STREAMING_WORKERS = int(STREAMING_CONFIG.get("workers", 4))
+
+
+def streaming_ingest_enabled() -> bool:
+    """
+    parse.streaming.enabled 开启时，段落切片边切边写入 ES 并计算 embedding；增量入库需要全量对比，不走流式
+    """
+    return str(STREAMING_CONFIG.get("enabled", False)).lower() in ('1', 'true') and not incremental_index_enabled()
 
 
 @register_span_func(func_name="段落切片上报", span_export_func=lambda context: dict(
@@ -30,19 +48,32 @@ def upload_paragragh_fragment(context: Context) -> Context:
 
     file_uuid = context.params.uuid
 
-    # 删除老切片
-    es_fragment_t = ThreadWithReturnValue(target=_delete_and_insert_es_fragments, args=(file_uuid, context.doc_fragments))
+    if incremental_index_enabled():
+        # 增量入库：只写入有变化的切片，只对新增切片计算 embedding
+        incremental_t = ThreadWithReturnValue(target=_incremental_upload_fragments, args=(file_uuid, context.doc_fragments))
+        incremental_t.start()
+        context.threads.append(incremental_t)
+        incremental_t.join()
+        return context
+
+    # 删除老切片；按 generation 入库时旧切片及向量在切换后回收
+    es_fragment_t = ThreadWithReturnValue(target=_delete_and_insert_es_fragments, args=(file_uuid, context.doc_fragments, context.generation))
     es_fragment_t.start()
+    threads = [es_fragment_t]
 
     # 删除老向量
-    delete_vbd_t = ThreadWithReturnValue(target=delete_vdb, args=(file_uuid,))
-    delete_vbd_t.start()
+    if not context.generation:
+        delete_vbd_t = ThreadWithReturnValue(target=delete_vdb, args=(file_uuid,))
+        delete_vbd_t.start()
+        threads.append(delete_vbd_t)
 
-    # multi_embedding and upload to es
-    embedding_zilliz_t = ThreadWithReturnValue(target=embedding_and_upload, args=(context.doc_fragments, file_uuid))
-    embedding_zilliz_t.start()
+    # multi_embedding and upload to es；es 单次写入模式下 embedding 与切片一起写入
+    if not use_es_single_write():
+        embedding_zilliz_t = ThreadWithReturnValue(target=embedding_and_upload, args=(context.doc_fragments, file_uuid))
+        embedding_zilliz_t.start()
+        threads.append(embedding_zilliz_t)
 
-    for t in [es_fragment_t, delete_vbd_t, embedding_zilliz_t]:
+    for t in threads:
         context.threads.append(t)
         t.join()
         # 加入到context.threads，方便后面判断成功与否
@@ -50,11 +81,74 @@ def upload_paragragh_fragment(context: Context) -> Context:
     return context
 
 
-def _delete_and_insert_es_fragments(file_uuid, doc_fragments: list[Fragment]):
+@register_span_func(func_name="段落切片流式上报", span_export_func=lambda context: dict(
+    params=context.params.model_dump(),
+    trace_id=context.trace_id,
+    len_doc_fragments=len(context.doc_fragments),
+))
+def upload_paragragh_fragment_stream(context: Context, fragments: Iterable[Fragment]) -> Context:
+    """
+    段落切片流式上报
+    fragments 为切片生成器，每凑满一批即写入 ES 并计算 embedding，同时继续切后面的内容；
+    队列长度为 workers，写入/embedding 跟不上时切片生成阻塞，内存占用与文档大小无关
+    """
+    from pkg.vdb import delete_vdb
+
+    file_uuid = context.params.uuid
+
+    if not context.generation:
+        # 先删除老切片、老向量，再写入新数据，避免删除与写入交错；按 generation 入库时旧数据在切换后回收
+        delete_es_t = ThreadWithReturnValue(target=DocFragmentES().delete_by_file_uuid, args=(file_uuid, True))
+        delete_es_t.start()
+        delete_vbd_t = ThreadWithReturnValue(target=delete_vdb, args=(file_uuid,))
+        delete_vbd_t.start()
+        delete_es_t.join()
+        delete_vbd_t.join()
+
+    # 切片数在切完之前未知，按原文条数判断是否为大文档，大文档写入期间放宽 refresh
+    with global_es.bulk_writer.relaxed_refresh(DocFragmentES().index_name, enabled=bool(RELAX_REFRESH_DOCS and len(context.doc_ori_items) >= RELAX_REFRESH_DOCS)):
+        upload_t = ThreadWithReturnValue(target=_stream_insert_and_embedding, args=(file_uuid, fragments, context.generation))
+        upload_t.start()
+        context.threads.append(upload_t)
+        upload_t.join()
+
+    return context
+
+
+def _stream_insert_and_embedding(file_uuid, fragments: Iterable[Fragment], generation: str = ""):
     try:
-        DocFragmentES().delete_by_file_uuid(file_uuid, wait_delete=True)
-        _f_items = [DocFragmentModel(**item.model_dump(), file_uuid=file_uuid) for item in doc_fragments]
-        insert_result = DocFragmentES().insert_doc_fragments(_f_items)
+        start_time = time.time()
+        results = batch_generator(fragments, STREAMING_BATCH_SIZE) | pl.thread.map(
+            lambda batch: _insert_and_embedding_batch(file_uuid, batch, generation), workers=STREAMING_WORKERS, maxsize=STREAMING_WORKERS) | list
+
+        logger.info(f"stream insert es fragments finished, file_uuid: {file_uuid}, batches: {len(results)}, cost: {1000*(time.time() - start_time):.1f}ms")
+        return all(results)
+    except Exception as e:
+        logger.error(f"stream insert es fragments error: {e}")
+        return False
+
+
+def _insert_and_embedding_batch(file_uuid, doc_fragments: list[Fragment], generation: str = ""):
+    _f_items = [DocFragmentModel(**item.model_dump(), file_uuid=file_uuid, generation=generation) for item in doc_fragments]
+    if use_es_single_write():
+        # 先计算 embedding，与切片一起一次写入
+        return DocFragmentES().insert_doc_fragments(_f_items, embeddings=embedding_fragments(doc_fragments, file_uuid))
+
+    if not DocFragmentES().insert_doc_fragments(_f_items):
+        logger.error(f"stream insert es fragments failed, file_uuid: {file_uuid}, fragment_count: {len(doc_fragments)}")
+        return False
+
+    # 切片写入 ES 后再计算 embedding(es 向量模式下 embedding 按 uuid 更新到切片文档)
+    return embedding_and_upload(doc_fragments, file_uuid)
+
+
+def _delete_and_insert_es_fragments(file_uuid, doc_fragments: list[Fragment], generation: str = ""):
+    try:
+        if not generation:
+            DocFragmentES().delete_by_file_uuid(file_uuid, wait_delete=True)
+        _f_items = [DocFragmentModel(**item.model_dump(), file_uuid=file_uuid, generation=generation) for item in doc_fragments]
+        embeddings = embedding_fragments(doc_fragments, file_uuid) if use_es_single_write() else None
+        insert_result = DocFragmentES().insert_doc_fragments(_f_items, embeddings=embeddings)
         logger.info(f"delete and insert es fragments succeed, file_uuid: {file_uuid}, fragment_count: {len(doc_fragments)}")
         return insert_result
     except Exception as e:
@@ -62,8 +156,46 @@ def _delete_and_insert_es_fragments(file_uuid, doc_fragments: list[Fragment]):
         return False
 
 
+def _incremental_upload_fragments(file_uuid, doc_fragments: list[Fragment]):
+    from pkg.vdb import delete_vdb_fragments
+
+    try:
+        start_time = time.time()
+        _f_items = [DocFragmentModel(**item.model_dump(), file_uuid=file_uuid) for item in doc_fragments]
+        diff = diff_fragments(DocFragmentES().get_content_hashes_by_file_uuid(file_uuid), _f_items, exclude=MATERIALIZED_TREE_KEYS)
+
+        added_uuids = {item.uuid for item in diff.added}
+        added_fragments = [item for item in doc_fragments if item.uuid in added_uuids]
+        embeddings = embedding_fragments(added_fragments, file_uuid) if use_es_single_write() else None
+
+        success = DocFragmentES().delete_by_ids(diff.removed_ids, file_uuid=file_uuid) \
+            and delete_vdb_fragments(diff.removed_uuids, file_uuid=file_uuid) \
+            and DocFragmentES().update_by_ids(diff.changed) \
+            and DocFragmentES().insert_doc_fragments(diff.added, embeddings=embeddings)
+        if not success:
+            logger.error(f"incremental upload es fragments failed, file_uuid: {file_uuid}, {diff}")
+            return False
+
+        # 新增切片写入 ES 后再计算 embedding(es 向量模式下 embedding 按 _id 更新到切片文档)
+        if not use_es_single_write():
+            embedding_and_upload(added_fragments, file_uuid)
+
+        logger.info(f"incremental upload es fragments succeed, file_uuid: {file_uuid}, {diff}, cost: {1000*(time.time() - start_time):.1f}ms")
+        return True
+    except Exception as e:
+        logger.error(f"incremental upload es fragments error: {e}")
+        return False
+
+
 @register_span_func()
 def embedding_and_upload(doc_fragments: list[Fragment], file_uuid: str):
+    if use_local_vdb():
+        # 本地向量库：proxy 只计算 embedding，由本进程写入
+        from pkg.vdb.local import insert_entities
+
+        embeddings = embedding_fragments(doc_fragments, file_uuid)
+        return insert_entities(file_uuid, [VectorEntity(uuid=uuid, file_uuid=file_uuid, vector=vector) for uuid, vector in embeddings.items()])
+
     vector_params = [
         dict(
             file_uuid=file_uuid,
@@ -77,3 +209,26 @@ def embedding_and_upload(doc_fragments: list[Fragment], file_uuid: str):
         lambda x: requests.post(f"{url}/vector/upload", json=x), workers=12) | list
 
     return True
+
+
+def embedding_fragments(doc_fragments: list[Fragment], file_uuid: str) -> dict[str, list[float]]:
+    """
+    只计算切片 embedding(经 proxy 的全局 embedding 存储)，返回 切片 uuid -> 向量，由调用方与切片一起写入 ES
+    """
+    vector_params = [
+        dict(
+            file_uuid=file_uuid,
+            uuid=doc_fragment.uuid,
+            text=doc_fragment.ebed_text,
+        )
+        for doc_fragment in doc_fragments
+    ]
+    url = config["proxy"]["url"]
+    responses = batch_generator(vector_params, 320) | pl.thread.map(
+        lambda x: requests.post(f"{url}/vector/embedding", json=x), workers=12) | list
+
+    embeddings = {}
+    for response in responses:
+        response.raise_for_status()
+        embeddings.update({entity["uuid"]: entity["vector"] for entity in response.json()})
+    return embeddings
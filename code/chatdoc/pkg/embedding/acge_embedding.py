@@ -7,8 +7,10 @@ LastEditTime: 2025-03-09 08:13:25
 
 import numpy as np
 import heapq
-from pkg.utils.lru_cache import LRUCacheDict, LRUCachedFunction, BatchCacheManager
+from pkg.utils.lru_cache import BoundedLRUCache, LRUCachedFunction, BatchCacheManager, TieredCache
+from pkg.redis.cache_tier import VectorCodec, get_redis_cache_tier
 from pkg.config import config
+from pkg.embedding.batcher import EmbeddingBatcher
 from pkg.utils import global_thread_pool, retry_exponential_backoff
 
 
@@ -35,10 +37,6 @@ def acge_embedding(text, dimension=1024, digit=8):
     return resp["result"]["embedding"][0]
 
 
-acg_lru_cache = LRUCacheDict(max_size=5000, expiration=60 * 60)
-acge_embedding_with_cache = LRUCachedFunction(acge_embedding, acg_lru_cache, cache_key_suffix="acge_embedding")
-
-
 @retry_exponential_backoff()
 def acge_embedding_multi(text_list, dimension=1024, digit=8, headers=None, url=None):
     import requests
@@ -63,6 +61,30 @@ def acge_embedding_multi(text_list, dimension=1024, digit=8, headers=None, url=N
     return resp["result"]["embedding"]
 
 
+embedding_config = config.get("embedding") or {}
+cache_config = config.get("cache") or {}
+acge_embedding_batcher = EmbeddingBatcher(
+    acge_embedding_multi,
+    max_batch_size=int(embedding_config.get("batch_max_size", 16)),
+    max_wait_ms=float(embedding_config.get("batch_max_wait_ms", 5)),
+    concurrency=int(embedding_config.get("batch_concurrency", 8)),
+)
+
+
+def acge_embedding_batched(text, dimension=1024, digit=8):
+    """
+    单条文本 embedding，跨请求/线程合并为一次 acge_embedding_multi 调用
+    """
+    if str(embedding_config.get("batch_enabled", True)).lower() not in ('1', 'true'):
+        return acge_embedding(text, dimension=dimension, digit=digit)
+    return acge_embedding_batcher.embed(text, dimension=dimension, digit=digit)
+
+
+acg_lru_cache = TieredCache(
+    BoundedLRUCache(max_bytes=int(cache_config.get("embedding_max_mb", 512)) * 1024 * 1024, expiration=60 * 60),
+    second_tier=get_redis_cache_tier("acge_embedding", codec=VectorCodec(cache_config.get("redis_vector_dtype", "float16"))),
+)
+acge_embedding_with_cache = LRUCachedFunction(acge_embedding_batched, acg_lru_cache, cache_key_suffix="acge_embedding")
 acg_embedding_multi_batch_with_cache = BatchCacheManager(acge_embedding_multi, cache=acg_lru_cache, batch_size=16, cache_key_suffix="acge_embedding", thread_pool=global_thread_pool)
 
 
@@ -0,0 +1,101 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-11 16:20:45
+LastEditors: longsion
+LastEditTime: 2025-03-11 19:08:12
+'''
+
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from pkg.utils.logger import logger
+
+
+class EmbeddingBatcher:
+    """
+    进程级 embedding 微批调度器
+    各线程提交单条文本，调度线程在 max_wait_ms 内或凑满 max_batch_size 后合并成一次 multi 请求，再把结果分发回各调用方
+    - 同一批次内相同 (text, dimension, digit) 只请求一次
+    - 批次请求在独立的有界线程池中执行，调度线程只负责攒批
+    """
+
+    def __init__(self, multi_func: callable, max_batch_size: int = 16, max_wait_ms: float = 5, concurrency: int = 8):
+        self.multi_func = multi_func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="embedding_batcher")
+        self._dispatcher = None
+        self._lock = threading.Lock()
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is not None and self._dispatcher.is_alive():
+            return
+        with self._lock:
+            if self._dispatcher is None or not self._dispatcher.is_alive():
+                self._dispatcher = threading.Thread(target=self._run, name="embedding_batcher_dispatcher", daemon=True)
+                self._dispatcher.start()
+
+    def submit(self, text: str, dimension: int = 1024, digit: int = 8) -> Future:
+        self._ensure_dispatcher()
+        future = Future()
+        self._queue.put(((text, dimension, digit), future))
+        return future
+
+    def embed(self, text: str, dimension: int = 1024, digit: int = 8, timeout: float = None):
+        return self.submit(text, dimension=dimension, digit=digit).result(timeout=timeout)
+
+    def _collect(self) -> list[tuple]:
+        # 阻塞等待第一条请求，随后在 max_wait 窗口内尽量攒批
+        pending = [self._queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(pending) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                pending.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return pending
+
+    def _run(self):
+        while True:
+            try:
+                pending = self._collect()
+            except Exception as e:
+                logger.error(f"EmbeddingBatcher collect error: {e}")
+                continue
+
+            # dimension / digit 不同的请求不能合并到同一次调用
+            groups: dict[tuple, dict[str, list[Future]]] = {}
+            for (text, dimension, digit), future in pending:
+                groups.setdefault((dimension, digit), {}).setdefault(text, []).append(future)
+
+            for (dimension, digit), text_futures in groups.items():
+                self._executor.submit(self._dispatch, text_futures, dimension, digit)
+
+    def _dispatch(self, text_futures: dict[str, list[Future]], dimension: int, digit: int):
+        texts = list(text_futures.keys())
+        try:
+            st = time.time()
+            embeddings = self.multi_func(texts, dimension=dimension, digit=digit)
+            logger.debug(f"EmbeddingBatcher batch size: {len(texts)}, waiters: {sum(len(x) for x in text_futures.values())}, cost: {1000*(time.time() - st):.1f}ms")
+        except Exception as e:
+            for futures in text_futures.values():
+                for future in futures:
+                    future.set_exception(e)
+            return
+
+        if len(embeddings) != len(texts):
+            e = Exception(f"EmbeddingBatcher result size mismatch: {len(embeddings)} != {len(texts)}")
+            for futures in text_futures.values():
+                for future in futures:
+                    future.set_exception(e)
+            return
+
+        for text, embedding in zip(texts, embeddings):
+            for future in text_futures[text]:
+                future.set_result(embedding)
@@ -6,7 +6,7 @@ LastEditTime: 2024-04-26 10:58:28
 '''
 
 
-from pkg.utils.lru_cache import LRUCacheDict, LRUCachedFunction, BatchCacheManager
+from pkg.utils.lru_cache import BoundedLRUCache, LRUCachedFunction, BatchCacheManager
 from pkg.config import config
 from pkg.utils import global_thread_pool, retry_exponential_backoff
 
@@ -25,7 +25,7 @@ def peg_embedding(text):
     return completion.json()["result"]["embedding"][0]
 
 
-peg_lru_cache = LRUCacheDict(max_size=5000, expiration=60 * 60)
+peg_lru_cache = BoundedLRUCache(max_bytes=int((config.get("cache") or {}).get("embedding_max_mb", 512)) * 1024 * 1024, expiration=60 * 60)
 peg_embedding_with_cache = LRUCachedFunction(peg_embedding, cache=peg_lru_cache)
 
 
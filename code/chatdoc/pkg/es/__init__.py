@@ -13,10 +13,12 @@ import time
 import json
 import requests
 from datetime import datetime
-from elasticsearch import ConflictError, TransportError, helpers
+from elasticsearch import ConflictError, helpers
 from elasticsearch import Elasticsearch
 from pkg.utils.objects import IFBaseModel
-from requests.auth import HTTPBasicAuth
+from pkg.es.transport import EsTransport, DEFAULT_SEARCH_FILTER_PATH
+from pkg.es.bulk_writer import BulkWriter
+from typing import Iterable
 
 
 @cache
@@ -46,9 +48,16 @@ class ES:
     def __init__(self):
         hosts = config["es"]["hosts"].split("|")
         self.hosts = hosts
-        self.default_host = hosts[0]
         self.username = config["es"].get("username")
         self.password = config["es"].get("password")
+        self.transport = EsTransport(
+            hosts,
+            username=self.username,
+            password=self.password,
+            pool_maxsize=int(config["es"].get("pool_maxsize", 32)),
+            timeout=float(config["es"].get("timeout", 30)),
+            cooldown=float(config["es"].get("host_cooldown", 2)),
+        )
         if config["es"].get("username"):
             # deprecated
             # self.conn = Elasticsearch(hosts, http_auth=(config["es"]["username"], config["es"]["password"]))
@@ -62,6 +71,8 @@ class ES:
         else:
             self.conn = Elasticsearch(hosts)
 
+        self.bulk_writer = BulkWriter(self.conn)
+
     @staticmethod
     def analyze(text):
         json_text = {
@@ -105,48 +116,28 @@ class ES:
         ret = self.conn.search(index=index, query=search_body, size=1)
         return ret["hits"]["total"]["value"] > 0
 
-    def insert(self, index, docs, max_retries=3, retry_delay=1) -> bool:
+    def insert(self, index, docs: Iterable[dict], max_retries=3, retry_delay=1, size_hint: int = None) -> bool:
+        """
+        批量写入，docs 可以是列表或生成器(如大批量原文逐条生成，不必整体放入内存)
+        由 BulkWriter 按字节切分请求并发写入，429 时降低并发并重试被拒绝的文档
+        :param size_hint: docs 为生成器时的文档数，用于判断是否临时放宽 refresh
+        """
         # 判断文档是否已存在
-        if len(docs) == 0:
+        if isinstance(docs, list) and len(docs) == 0:
             logger.warning(f"document empty ignore es insert, index: {index}")
             return True
 
-        # 使用helpers.bulk方法插入，为每个操作指定op_type为'create'
+        # 为每个操作指定op_type为'create'
         # 确保了如果尝试插入的文档ID已经在索引中存在，则该操作会被忽略
-        for doc in docs:
-            doc["_op_type"] = "create"
-            doc["_source"]["created_at"] = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
-
-        for attempt in range(max_retries + 1):  # 加1是因为range不包含结束值
-            try:
-                result = helpers.bulk(self.conn, docs)
-                if result[0] == len(docs):
-                    # logger.info(f"All documents processed successfully docs size: {len(docs)}")
-                    return True
-                elif attempt < max_retries:  # 如果还有重试机会且没全部成功
-                    logger.info(f"Not all documents were processed correctly, retrying in {retry_delay} seconds... ({attempt+1}/{max_retries})")
-                    time.sleep(retry_delay)  # 等待一段时间后重试
-                else:
-                    logger.info("Exhausted all retries. Not all documents could be inserted.")
-            except TransportError as e:
-                if attempt < max_retries:
-                    logger.info(f"A transport error occurred: {e}. Retrying in {retry_delay} seconds... ({attempt+1}/{max_retries})")
-                    time.sleep(retry_delay)
-                else:
-                    logger.error(f"Failed after {max_retries} retries due to transport error: {e}")
-                    return False
-            except ConflictError as e:
-                if attempt < max_retries:
-                    logger.info(f"Conflict error occurred. Retrying in {retry_delay} seconds... ({attempt+1}/{max_retries})")
-                    time.sleep(retry_delay)
-                else:
-                    logger.error(f"Failed after {max_retries} retries due to conflict error: {e}")
-                    return False
-            except Exception as e:
-                logger.error(f"An unexpected error occurred: {e}")
-                return False
+        def _actions():
+            for doc in docs:
+                doc["_op_type"] = "create"
+                doc["_source"]["created_at"] = datetime.strftime(datetime.now(), "%Y-%m-%d %H:%M:%S")
+                yield doc
 
-        return False  # 如果所有尝试都失败了
+        if size_hint is None and isinstance(docs, list):
+            size_hint = len(docs)
+        return self.bulk_writer.write(index, _actions(), size_hint=size_hint, max_retries=max_retries, retry_delay=retry_delay)
 
     def delete_document(self, index, doc_id):
         """
@@ -156,6 +147,40 @@ class ES:
         """
         self.conn.delete(index=index, id=doc_id)
 
+    def scan(self, index, query: dict, source=False) -> list[dict]:
+        """
+        遍历 query 命中的全部文档(不受 max_result_window 限制)，返回 hits，包含 _id
+        :param source: 需要返回的字段列表，False 表示只返回 _id
+        """
+        return list(helpers.scan(self.conn, index=index, query=dict(query=query, _source=source), size=1000))
+
+    def delete_documents(self, index, doc_ids: list[str]) -> bool:
+        """
+        按 _id 批量删除，不存在的文档视为成功
+        """
+        if not doc_ids:
+            return True
+        success, errors = helpers.bulk(self.conn, [
+            {"_op_type": "delete", "_index": index, "_id": doc_id} for doc_id in doc_ids
+        ], raise_on_error=False)
+        errors = [error for error in errors if error.get("delete", {}).get("status") != 404]
+        if errors:
+            logger.error(f"ES delete documents error, index: {index}, errors: {errors[:3]}")
+        return not errors
+
+    def update_documents(self, index, docs: dict[str, dict]) -> bool:
+        """
+        按 _id 批量局部更新，只覆盖 doc 中的字段(如 embedding 等其它字段保持不变)
+        """
+        if not docs:
+            return True
+        success, errors = helpers.bulk(self.conn, [
+            {"_op_type": "update", "_index": index, "_id": doc_id, "doc": doc} for doc_id, doc in docs.items()
+        ], raise_on_error=False)
+        if errors:
+            logger.error(f"ES update documents error, index: {index}, errors: {errors[:3]}")
+        return not errors
+
     def delete_document_by_query(self, index, query: dict, wait_delete=True, wait_sec: int = 30, max_retries=5, retry_delay=1):
         """
         query = {"term": {"file_uuid": uuid}}
@@ -226,31 +251,18 @@ class ES:
             logger.error(f"Error during upsert operation: {e}")
             raise
 
-    def search(self, index, search_body):
+    def search(self, index, search_body, filter_path: str = DEFAULT_SEARCH_FILTER_PATH):
         try:
             st = time.time()
-            body_str = json.dumps(search_body, ensure_ascii=False)
-            for host in [self.default_host] + self.hosts:
-                url = f"{host}/{index}/_search"
-                if self.username:
-                    resp = requests.get(url, json=search_body, auth=HTTPBasicAuth(self.username, self.password), verify=False)
-                else:
-                    resp = requests.get(url, json=search_body, verify=False)
-
-                if resp.status_code == 200:
-                    resp = resp.json()
-                    self.default_host = host
-                    break
-                else:
-                    print(f"search error, search_body: {search_body},resp: {resp.text}")
-
-            hits = resp["hits"]["hits"]
+            resp = self.transport.search(index, search_body, filter_path=filter_path)
+            # filter_path 裁剪后，无命中时 ES 返回空对象
+            hits = resp.get("hits", {}).get("hits", [])
             et = time.time()
 
             logger.info(f"searching ES: {index}, duration: {(et-st) * 1000:.1f}ms")
 
             if et - st > 0.5:
-                logger.warning(f"ES search too slow: {1000*(et - st):.1f}ms, index: {index}, search_body: {body_str}")
+                logger.warning(f"ES search too slow: {1000*(et - st):.1f}ms, index: {index}, search_body: {json.dumps(search_body, ensure_ascii=False)}")
             # return [hit["_source"][field] for hit in hits]
             return hits
         except Exception as e:
@@ -312,6 +324,32 @@ def generate_es_mapping(model_class):
     }
 
 
+def dense_vector_property(dims: int = 1024, index: bool = True, int8: bool = False):
+    """
+    embedding 字段 mapping，按 HNSW 建立索引以支持 knn 检索
+    :param index: False 时只存 doc values 不建 HNSW，用于 script_score 重排
+    :param int8: HNSW 使用 int8 量化向量(int8_hnsw，ES 8.12+)，内存约为 float 的 1/4
+    """
+    if not index:
+        return {
+            "type": "dense_vector",
+            "dims": dims,
+            "index": False,
+        }
+
+    return {
+        "type": "dense_vector",
+        "dims": dims,
+        "index": True,
+        "similarity": "cosine",
+        "index_options": {
+            "type": "int8_hnsw" if int8 else "hnsw",
+            "m": int(config["vector"].get("es_hnsw_m", 16)),
+            "ef_construction": int(config["vector"].get("es_hnsw_ef_construction", 100)),
+        }
+    }
+
+
 es_index_default_settings = {
     "refresh_interval": "200ms",
     "number_of_shards": "3",
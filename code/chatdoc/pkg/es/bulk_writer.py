@@ -0,0 +1,186 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-27 10:36:12
+LastEditors: longsion
+LastEditTime: 2025-03-27 19:08:45
+
+批量写入：parallel_bulk 按字节切分请求并发写入，收到 429(写入队列已满)时降低并发并重试被拒绝的文档，大批量写入时临时放宽 refresh
+'''
+
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Iterable
+
+from elasticsearch import Elasticsearch, helpers
+
+from pkg.config import config
+from pkg.utils.logger import logger
+
+BULK_CONFIG = config["es"].get("bulk") or {}
+CHUNK_BYTES = int(float(BULK_CONFIG.get("chunk_mb", 10)) * 1024 * 1024)
+CHUNK_DOCS = int(BULK_CONFIG.get("chunk_docs", 2000))
+MAX_THREADS = int(BULK_CONFIG.get("threads", 4))
+# 单次写入文档数超过该值时临时放宽 refresh_interval，0 表示不放宽
+RELAX_REFRESH_DOCS = int(BULK_CONFIG.get("relax_refresh_docs", 0) or 0)
+RELAX_REFRESH_INTERVAL = BULK_CONFIG.get("relax_refresh_interval", "30s")
+# 恢复的 refresh_interval，与各索引 settings 一致
+REFRESH_INTERVAL = BULK_CONFIG.get("refresh_interval", "200ms")
+
+
+def _is_rejected(status, error) -> bool:
+    return status == 429 or "es_rejected_execution_exception" in str(error)
+
+
+class AdaptiveConcurrency:
+    """
+    进程内所有批量写入共享的并发度：收到 429 时减半，一轮写入没有被拒绝时加一，不超过 threads
+    """
+
+    def __init__(self, max_threads: int = MAX_THREADS):
+        self.max_threads = max(max_threads, 1)
+        self.current = self.max_threads
+        self._lock = threading.Lock()
+
+    def get(self) -> int:
+        return self.current
+
+    def on_rejected(self):
+        with self._lock:
+            self.current = max(self.current // 2, 1)
+
+    def on_success(self):
+        with self._lock:
+            self.current = min(self.current + 1, self.max_threads)
+
+
+class RefreshRelaxer:
+    """
+    大批量写入期间放宽索引的 refresh_interval，最后一个写入结束时恢复并 refresh
+    只在进程内计数，多个进程同时写入同一索引时先结束的进程会提前恢复，只影响写入速度，不影响数据
+    """
+
+    def __init__(self, conn: Elasticsearch):
+        self.conn = conn
+        self._counts: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _put_refresh_interval(self, index: str, interval: str, refresh: bool = False):
+        try:
+            self.conn.indices.put_settings(index=index, settings={"index": {"refresh_interval": interval}})
+            if refresh:
+                self.conn.indices.refresh(index=index)
+        except Exception as e:
+            logger.warning(f"ES put refresh_interval failed, index: {index}, interval: {interval}, {e}")
+
+    @contextmanager
+    def relax(self, index: str):
+        with self._lock:
+            self._counts[index] = self._counts.get(index, 0) + 1
+            if self._counts[index] == 1:
+                self._put_refresh_interval(index, RELAX_REFRESH_INTERVAL)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._counts[index] -= 1
+                if self._counts[index] == 0:
+                    self._put_refresh_interval(index, REFRESH_INTERVAL, refresh=True)
+
+
+class BulkWriter:
+
+    def __init__(self, conn: Elasticsearch):
+        self.conn = conn
+        self.concurrency = AdaptiveConcurrency()
+        self.refresh_relaxer = RefreshRelaxer(conn)
+
+    @contextmanager
+    def relaxed_refresh(self, index: str, enabled: bool = True):
+        if not enabled:
+            yield
+            return
+        with self.refresh_relaxer.relax(index):
+            yield
+
+    def write(self, index: str, actions: Iterable[dict], size_hint: int = None, max_retries=3, retry_delay=1) -> bool:
+        """
+        写入 actions，返回是否全部成功；create 时文档已存在(409)视为成功
+        :param actions: bulk action 列表或生成器，生成器只遍历一次
+        :param size_hint: 文档数，超过 relax_refresh_docs 时临时放宽 refresh_interval
+        """
+        if size_hint is None and isinstance(actions, list):
+            size_hint = len(actions)
+
+        with self.relaxed_refresh(index, enabled=bool(RELAX_REFRESH_DOCS and size_hint and size_hint >= RELAX_REFRESH_DOCS)):
+            st = time.time()
+            pending, total, failed = actions, 0, []
+            for attempt in range(max_retries + 1):
+                retry, failed, succeeded = self._write_round(pending, size_hint)
+                total = total or succeeded + len(retry) + len(failed)
+                if not retry:
+                    break
+                if attempt < max_retries:
+                    logger.info(f"ES bulk write {len(retry)} docs rejected, threads: {self.concurrency.get()}, retrying in {retry_delay * 2 ** attempt}s... ({attempt + 1}/{max_retries})")
+                    time.sleep(retry_delay * 2 ** attempt)
+                    pending, size_hint = retry, len(retry)
+                else:
+                    failed.extend(retry)
+
+            if failed:
+                logger.error(f"ES bulk write failed, index: {index}, failed: {len(failed)}/{total}, errors: {failed[:3]}")
+                return False
+
+            if total >= CHUNK_DOCS:
+                logger.info(f"ES bulk write succeed, index: {index}, docs: {total}, cost: {1000*(time.time() - st):.1f}ms")
+            return True
+
+    def _write_round(self, actions: Iterable[dict], size_hint: int = None) -> tuple[list[dict], list, int]:
+        """
+        写入一轮，返回 (需要重试的 action, 失败信息, 成功数)
+        结果与 action 顺序一致，按顺序对应回原 action；请求异常时未确认的 action 全部重试
+        """
+        threads = self.concurrency.get()
+        if size_hint is not None:
+            threads = min(threads, max(math.ceil(size_hint / CHUNK_DOCS), 1))
+
+        source, in_flight = iter(actions), deque()
+
+        def _track():
+            for action in source:
+                in_flight.append(action)
+                yield action
+
+        options = dict(chunk_size=CHUNK_DOCS, max_chunk_bytes=CHUNK_BYTES, raise_on_error=False, raise_on_exception=False)
+        if threads > 1:
+            results = helpers.parallel_bulk(self.conn, _track(), thread_count=threads, queue_size=threads, **options)
+        else:
+            results = helpers.streaming_bulk(self.conn, _track(), max_retries=0, **options)
+
+        retry, failed, succeeded, rejected = [], [], 0, False
+        try:
+            for ok, item in results:
+                action = in_flight.popleft()
+                op_type, info = next(iter(item.items()))
+                status = info.get("status")
+                if ok or (op_type == "create" and status == 409):
+                    succeeded += 1
+                elif _is_rejected(status, info.get("error")) or "exception" in info:
+                    rejected = rejected or _is_rejected(status, info.get("error"))
+                    retry.append(action)
+                else:
+                    failed.append(dict(status=status, error=info.get("error")))
+        except Exception as e:
+            # 连接异常等未按文档返回的错误，未确认的文档全部重试(兼容原 insert 整批重试的行为)
+            logger.warning(f"ES bulk write exception: {e}")
+            retry.extend(in_flight)
+            retry.extend(source)
+            rejected = True
+
+        if rejected:
+            self.concurrency.on_rejected()
+        else:
+            self.concurrency.on_success()
+        return retry, failed, succeeded
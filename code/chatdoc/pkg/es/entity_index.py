@@ -0,0 +1,253 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-04-01 14:20:31
+LastEditors: longsion
+LastEditTime: 2025-04-01 18:05:47
+
+进程内公司/文件实体索引：问题预处理时的公司、文件定位不再逐次查询 ES
+- 全量加载公司索引(v5_company)的名称、简称、别名与系统知识库的文件信息，构建 Aho-Corasick 自动机，扫描一遍问题即可找到出现的公司名/别名
+- 超过 entity_index_refresh_sec(每个进程加随机抖动)后在后台重建，期间仍使用旧索引；首次构建完成前由调用方回退到 ES 查询
+- 全量加载由 redis 锁串行化，同一时刻只有一个 worker 扫描 ES，未拿到锁的 worker 稍后重试
+- 自动机命中且无歧义时直接使用，不再查询 ES；未命中、索引未就绪或同一个词对应多家公司时才查询 ES(有歧义时与 ES 结果合并)
+- entity_index_refresh_sec 为 0 时不使用
+'''
+
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict
+from typing import Optional
+
+from pkg.config import config
+from pkg.es import global_es
+from pkg.es.es_company import CompanyES, ESCompanyObject
+from pkg.es.es_file import ESFileObject, FileES
+from pkg.es.generation import filter_active
+from pkg.utils import ensure_list
+from pkg.utils.aho_corasick import AhoCorasick
+from pkg.utils.logger import logger
+
+ENTITY_INDEX_REFRESH_SEC = int((config.get("cache") or {}).get("entity_index_refresh_sec", 300))
+# 全量加载锁，持有超时(进程被杀时自动释放)
+REFRESH_LOCK_KEY = "entity-index-refresh-lock"
+REFRESH_LOCK_TTL = 120
+# 未拿到锁时的重试间隔(秒)
+REFRESH_RETRY_SEC = (5, 30)
+# 与 FileES.search_file_brief_by_query 一致
+MAX_LOCATE_FILES = 100
+# 单字的简称/别名误匹配太多，不加入自动机
+MIN_WORD_LEN = 2
+COMPANY_SUFFIXES = ["集团股份有限公司", "股份有限公司", "有限责任公司", "集团有限公司", "有限公司", "股份公司", "集团", "公司"]
+
+# 仍由自己持有时才释放锁
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def company_short_name(name: str) -> str:
+    """
+    去掉公司全称中的组织形式后缀作为简称，如 上海合合信息科技股份有限公司 -> 上海合合信息科技
+    """
+    for suffix in COMPANY_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def company_words(company: ESCompanyObject) -> set[str]:
+    words = {company.name, company_short_name(company.name or "")} | set(company.alias or [])
+    return {word for word in words if word and len(word) >= MIN_WORD_LEN}
+
+
+def longest_matches(automaton: AhoCorasick, text: str) -> list[tuple]:
+    """
+    从左到右取不重叠的最长匹配，返回命中的 (模式串, 值)(按出现顺序)
+    """
+    matches = sorted(automaton.iter(text), key=lambda match: (match[0], -len(match[1])))
+    values, end, last = [], 0, None
+    for start, word, value in matches:
+        # 同一个词可能对应多个实体，均保留
+        if start < end and (start, word) != last:
+            continue
+        values.append((word, value))
+        end, last = start + len(word), (start, word)
+    return values
+
+
+class _EntitySnapshot(object):
+
+    def __init__(self, companies: list[ESCompanyObject], files: list[ESFileObject]):
+        self.companies: dict[str, ESCompanyObject] = {}
+        self.companies_by_word: dict[str, list[ESCompanyObject]] = defaultdict(list)
+        self.files_by_company: dict[str, list[ESFileObject]] = defaultdict(list)
+        self.company_automaton = AhoCorasick()
+        self.file_automaton = AhoCorasick()
+
+        for company in companies:
+            for key in (company.eid, company.uuid):
+                if key:
+                    self.companies[key] = company
+            for word in company_words(company):
+                self.company_automaton.add(word, company)
+                self.companies_by_word[word].append(company)
+
+        for file in files:
+            if file.company:
+                self.files_by_company[file.company].append(file)
+            if file.extract_company_str and len(file.extract_company_str) >= MIN_WORD_LEN:
+                self.file_automaton.add(file.extract_company_str, file)
+
+        self.company_automaton.build()
+        self.file_automaton.build()
+
+    def match_company_words(self, text: str) -> dict[str, list[ESCompanyObject]]:
+        """
+        文本中出现的公司名/简称/别名 -> 对应的公司(一个词可能对应多家公司)，按出现顺序
+        """
+        words: dict[str, dict] = defaultdict(dict)
+        for word, company in longest_matches(self.company_automaton, text):
+            words[word][id(company)] = company
+        return {word: list(companies.values()) for word, companies in words.items()}
+
+    def resolve_company(self, text: str) -> Optional[ESCompanyObject]:
+        """
+        text 即某家公司的名称/简称/别名，或 text 中只出现了一家公司且没有歧义时返回该公司
+        """
+        exact = list({id(company): company for company in self.companies_by_word.get(text, [])}.values())
+        if exact:
+            return exact[0] if len(exact) == 1 else None
+
+        words = self.match_company_words(text)
+        companies = {id(company): company for companies in words.values() for company in companies}
+        if len(companies) == 1:
+            return next(iter(companies.values()))
+        return None
+
+    def locate_files(self, text: str) -> tuple[list[ESFileObject], bool]:
+        """
+        问题中出现的公司名/别名对应的文件 + 抽取公司名出现在问题中的文件，以及是否有歧义(同一个词对应多家公司)
+        """
+        words = self.match_company_words(text)
+        files = [
+            file
+            for companies in words.values()
+            for company in companies
+            for key in {company.eid, company.uuid} if key
+            for file in self.files_by_company.get(key, [])
+        ] + [file for _word, file in longest_matches(self.file_automaton, text)]
+        ambiguous = any(len(companies) > 1 for companies in words.values())
+        return list({file.uuid: file for file in files}.values()), ambiguous
+
+
+class EntityIndex(object):
+
+    def __init__(self):
+        # 整体替换，读取时无需加锁
+        self.snapshot: Optional[_EntitySnapshot] = None
+        # 下次重建的时间，各进程的刷新间隔加随机抖动，避免同时全量加载
+        self.next_refresh_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get(self) -> Optional[_EntitySnapshot]:
+        if not ENTITY_INDEX_REFRESH_SEC:
+            return None
+        if time.time() >= self.next_refresh_at:
+            self._refresh_in_background()
+        return self.snapshot
+
+    def refresh(self) -> bool:
+        """
+        全量加载，未拿到锁(其他 worker 正在加载)时返回 False
+        """
+        from pkg.redis.redis import redis_store
+
+        lock_value = uuid.uuid4().hex
+        if not redis_store.set(REFRESH_LOCK_KEY, lock_value, nx=True, ex=REFRESH_LOCK_TTL):
+            return False
+        try:
+            self._load()
+        finally:
+            redis_store.eval(_RELEASE_LOCK_SCRIPT, 1, REFRESH_LOCK_KEY, lock_value)
+        return True
+
+    def _load(self):
+        start_time = time.time()
+        company_hits = global_es.scan(CompanyES().index_name, {"match_all": {}}, source=["eid", "name", "alias", "uuid"])
+        companies = [
+            ESCompanyObject(
+                uuid=hit["_source"].get("uuid"),
+                eid=hit["_source"].get("eid"),
+                name=hit["_source"].get("name"),
+                alias=ensure_list(hit["_source"].get("alias") or []),
+            ) for hit in company_hits
+        ]
+        file_hits = global_es.scan(FileES().index_name, {"term": {"ori_type": "系统知识库"}}, source=ESFileObject.keys(exclude=["doc_fragments_json"]))
+        files = [ESFileObject.from_hit(hit["_source"]) for hit in file_hits]
+
+        self.snapshot = _EntitySnapshot(companies, files)
+        logger.info(f"entity index refreshed, companies: {len(companies)}, files: {len(files)}, cost: {1000*(time.time() - start_time):.1f}ms")
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                if self.refresh():
+                    self.next_refresh_at = time.time() + ENTITY_INDEX_REFRESH_SEC * random.uniform(1.0, 1.5)
+                else:
+                    self.next_refresh_at = time.time() + random.uniform(*REFRESH_RETRY_SEC)
+            except Exception as e:
+                logger.error(f"entity index refresh error: {e}")
+                # 失败后等下一个刷新周期再重试，避免每个问题都触发全量加载
+                self.next_refresh_at = time.time() + ENTITY_INDEX_REFRESH_SEC * random.uniform(1.0, 1.5)
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=_run, daemon=True).start()
+
+
+entity_index = EntityIndex()
+
+
+def search_company_by_eids_or_uids(ids: list[str]) -> list[ESCompanyObject]:
+    """
+    同 CompanyES.search_company_by_eids_or_uids，索引中不存在的 id 回退查询 ES
+    """
+    snapshot = entity_index.get()
+    if snapshot is None:
+        return CompanyES().search_company_by_eids_or_uids(ids) if ids else []
+
+    companies = {id(snapshot.companies[_id]): snapshot.companies[_id] for _id in ids if _id in snapshot.companies}
+    missing = [_id for _id in ids if _id not in snapshot.companies]
+    if missing:
+        companies.update({id(company): company for company in CompanyES().search_company_by_eids_or_uids(missing)})
+    return list(companies.values())
+
+
+def resolve_company(text: str) -> list[ESCompanyObject]:
+    """
+    text 对应的唯一一家公司(完全一致，或只出现了一家公司)；索引未就绪、未命中或有歧义时返回空，由调用方回退到 CompanyES.search_company
+    """
+    snapshot = entity_index.get()
+    company = snapshot.resolve_company(text) if snapshot is not None and text else None
+    return [company] if company is not None else []
+
+
+def locate_files(question: str) -> tuple[list[ESFileObject], bool]:
+    """
+    问题中提到的公司对应的系统知识库文件及是否有歧义；索引未就绪或未命中时返回空，由调用方查询 FileES.search_file_brief_by_query
+    """
+    snapshot = entity_index.get()
+    if snapshot is None or not question:
+        return [], False
+    files, ambiguous = snapshot.locate_files(question)
+    return filter_active(files, lambda file: file.uuid)[:MAX_LOCATE_FILES], ambiguous
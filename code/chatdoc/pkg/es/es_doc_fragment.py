@@ -10,10 +10,17 @@ import time
 from pkg.config import config
 from pkg.embedding import EmbeddingType
 from pkg.es import global_es, EsBaseItem
+from pkg.es.fragment_payload import invalidate_fragment_payloads, touch_fragment_versions
+from pkg.es.vector_first_pass import embedding_properties, embedding_fields
+from pkg.es.generation import filter_active, generation_conditions
 from pkg.utils.logger import logger
 import requests
 
 
+# 预计算的子树聚合字段，体积较大且只在问答时从切片树中读取
+MATERIALIZED_TREE_KEYS = ["tree_ori_ids", "tree_text", "tree_all_texts"]
+
+
 class DocFragmentModel(EsBaseItem):
     uuid: str = ""                  # 切片唯一标识uuid
     file_uuid: str = ""             # 文件uuid
@@ -39,6 +46,14 @@ class DocFragmentModel(EsBaseItem):
     table_start_row_idx: int = 0    # 表格起始行
     table_end_row_idx: int = 0      # 表格结束行
 
+    content_hash: str = ""          # 切片内容摘要，增量入库时判断切片是否变化
+    generation: str = ""            # 入库批次，查询只命中文件当前 generation 的切片
+
+    # ---- 入库时预计算的子树聚合，只存放在切片树json中，不写入ES ----
+    tree_ori_ids: list[str] = []    # 节点及子孙节点的ori_id(非叶子节点)
+    tree_text: str = ""             # 节点及子孙节点拼接的原文(非叶子节点及表格叶子节点)
+    tree_all_texts: list[str] = []  # 节点及子孙节点的原文列表(非叶子节点及表格叶子节点)
+
 
 class DocFragmentES(object):
 
@@ -115,14 +130,17 @@ class DocFragmentES(object):
             "table_end_row_idx": {
                 "type": "integer"
             },
+            "content_hash": {
+                "type": "keyword"
+            },
+            "generation": {
+                "type": "keyword"
+            },
             "created_at": {
                 "type": "date",  # 字段类型为日期
                 "format": "yyyy-MM-dd HH:mm:ss"  # 日期格式示例，根据实际需求调整
             },
-            "acge_embedding": {
-                "type": "dense_vector",
-                "dims": 1024,
-            }
+            **embedding_properties("acge_embedding", dims=1024),
         }
 
     def create_index(self):
@@ -135,11 +153,11 @@ class DocFragmentES(object):
 
     @property
     def keys(self):
-        return DocFragmentModel.keys(exclude=["acge_embedding", "peg_embedding"])
+        return DocFragmentModel.keys(exclude=["acge_embedding", "peg_embedding"] + MATERIALIZED_TREE_KEYS)
 
     @property
     def keys_without_embedding(self):
-        return DocFragmentModel.keys(exclude=["acge_embedding", "peg_embedding"])
+        return DocFragmentModel.keys(exclude=["acge_embedding", "peg_embedding"] + MATERIALIZED_TREE_KEYS)
 
     def wait_delete_index_done(self):
         import time
@@ -165,36 +183,67 @@ class DocFragmentES(object):
         :param data:
         :return:
         """
-        return global_es.insert(self.index_name, docs=[
+        inserted = global_es.insert(self.index_name, docs=[
             {
                 "_index": self.index_name,
+                "_id": doc_fragment.uuid,
                 "_source": doc_fragment.model_dump()
             }
         ])
+        touch_fragment_versions([doc_fragment.file_uuid])
+        return inserted
 
-    def insert_doc_fragments(self, doc_fragments: list[DocFragmentModel]) -> bool:
+    def insert_doc_fragments(self, doc_fragments: list[DocFragmentModel], embeddings: dict[str, list[float]] = None) -> bool:
         """
-        插入数据
-        :param data:
+        插入数据，_id 即切片 uuid，proxy 回写 embedding 时按 _id 直接更新
+        :param embeddings: 切片 uuid -> acge_embedding，与切片一起写入(vector.es_single_write)
         :return:
         """
-        return global_es.insert(self.index_name, docs=[
+        embeddings = embeddings or {}
+        inserted = global_es.insert(self.index_name, docs=[
             {
                 "_index": self.index_name,
-                "_source": doc_fragment.model_dump()
+                "_id": doc_fragment.uuid,
+                "_source": {
+                    **doc_fragment.model_dump(exclude=MATERIALIZED_TREE_KEYS),
+                    **(embedding_fields("acge_embedding", embeddings[doc_fragment.uuid]) if doc_fragment.uuid in embeddings else {}),
+                }
             } for doc_fragment in doc_fragments
         ])
+        touch_fragment_versions([doc_fragment.file_uuid for doc_fragment in doc_fragments])
+        return inserted
 
     def delete_by_file_uuid(self, file_uuid, wait_delete=True):
         start_time = time.time()
         global_es.delete_document_by_query(index=self.index_name, query=dict(term=dict(file_uuid=file_uuid)), wait_delete=wait_delete)
+        touch_fragment_versions([file_uuid])
         logger.info(f"DocFragmentES delete_by_file_uuid: {file_uuid}, cost: {1000*(time.time() - start_time):.1f}ms")
 
     def delete_by_file_uuids(self, file_uuids, wait_delete=True):
         start_time = time.time()
         global_es.delete_document_by_query(index=self.index_name, query=dict(terms=dict(file_uuid=file_uuids)), wait_delete=wait_delete)
+        touch_fragment_versions(file_uuids)
         logger.info(f"DocFragmentES delete_by_file_uuids: {file_uuids}, cost: {1000*(time.time() - start_time):.1f}ms")
 
+    def get_content_hashes_by_file_uuid(self, file_uuid) -> list[dict]:
+        """
+        已入库切片的 _id / uuid / content_hash，增量入库时做对比
+        """
+        return global_es.scan(self.index_name, query=dict(term=dict(file_uuid=file_uuid)), source=["uuid", "content_hash"])
+
+    def delete_by_ids(self, ids: list[str], file_uuid: str = "") -> bool:
+        # _id 即切片 uuid，本进程内直接失效；其他进程按文件的切片版本号失效
+        invalidate_fragment_payloads(self.index_name, ids)
+        deleted = global_es.delete_documents(self.index_name, ids)
+        touch_fragment_versions([file_uuid])
+        return deleted
+
+    def update_by_ids(self, docs: dict[str, dict]) -> bool:
+        invalidate_fragment_payloads(self.index_name, list(docs) + [doc["uuid"] for doc in docs.values() if doc.get("uuid")])
+        updated = global_es.update_documents(self.index_name, docs)
+        touch_fragment_versions([doc.get("file_uuid") for doc in docs.values()])
+        return updated
+
     def get_by_uuids(self, uuids, fillup=True) -> list[DocFragmentModel]:
         uuids = list(set(uuids))
         hits = global_es.search(index=self.index_name, search_body=dict(
@@ -219,7 +268,8 @@ class DocFragmentES(object):
         # 根据uuid去重
         doc_fragments = {doc_fragment.uuid: doc_fragment for doc_fragment in doc_fragments}.values()
 
-        return doc_fragments
+        # 重新入库期间旧 generation 的切片尚未回收
+        return filter_active(doc_fragments, lambda doc_fragment: doc_fragment.file_uuid)
 
     def search_fragment(self, bm25_text, ebd_text, document_uuids, size=10) -> list[DocFragmentModel]:
         from pkg.es.es_retrieval import EmbeddingArgs, es_retrieve
@@ -235,8 +285,10 @@ class DocFragmentES(object):
                                #    EmbeddingArgs(type=EmbeddingType.peg, field="peg_embedding", size=size),
                            ],
                            must_conditions=[
-                               dict(terms=dict(file_uuid=document_uuids))
+                               dict(terms=dict(file_uuid=document_uuids)),
+                               *generation_conditions("file_uuid", document_uuids),
                            ] if document_uuids else [],
                            )
 
-        return [DocFragmentModel.from_hit(hit) for hit in hits]
+        doc_fragments = [DocFragmentModel.from_hit(hit) for hit in hits]
+        return doc_fragments if document_uuids else filter_active(doc_fragments, lambda doc_fragment: doc_fragment.file_uuid)
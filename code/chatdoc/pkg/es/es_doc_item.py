@@ -7,8 +7,10 @@ LastEditTime: 2024-10-16 10:57:40
 
 
 import time
+from typing import Iterable
 from pkg.config import config
 from pkg.es import global_es, EsBaseItem
+from pkg.es.generation import generation_conditions
 import requests
 from pkg.utils import ensure_list
 from pkg.utils.logger import logger
@@ -20,6 +22,7 @@ class DocItemModel(EsBaseItem):
     ori_id: list[str] = []
     content: str = None
     type: str = None
+    generation: str = ""    # 入库批次，查询只命中文件当前 generation 的数据
 
 
 class DocItemES(object):
@@ -59,6 +62,9 @@ class DocItemES(object):
             "content": {
                 "type": "text"
             },
+            "generation": {
+                "type": "keyword"
+            },
             "created_at": {
                 "type": "date",  # 字段类型为日期
                 "format": "yyyy-MM-dd HH:mm:ss"  # 日期格式示例，根据实际需求调整
@@ -77,7 +83,8 @@ class DocItemES(object):
                     "must": [
                         dict(term=dict(ori_id=ori_id)),
                         dict(term=dict(uuid=uuid)),
-                    ]
+                    ],
+                    "filter": generation_conditions("uuid", [uuid]),
                 },
             }
         })
@@ -127,18 +134,19 @@ class DocItemES(object):
             }
         ])
 
-    def insert_doc_items(self, doc_items: list[DocItemModel]) -> bool:
+    def insert_doc_items(self, doc_items: Iterable[DocItemModel], size_hint: int = None) -> bool:
         """
         插入数据
-        :param data:
+        :param doc_items: 列表或生成器，生成器按批写入，不必整体放入内存
+        :param size_hint: doc_items 为生成器时的数量
         :return:
         """
-        global_es.insert(self.index_name, docs=[
+        return global_es.insert(self.index_name, docs=(
             {
                 "_index": self.index_name,
                 "_source": doc_item.model_dump()
             } for doc_item in doc_items
-        ])
+        ), size_hint=len(doc_items) if isinstance(doc_items, list) else size_hint)
 
     def delete_by_file_uuid(self, uuid, wait_delete=True):
         start_time = time.time()
@@ -175,6 +183,7 @@ class DocItemES(object):
             "query": {
                 "bool": {
                     "should": should_condition,
+                    "filter": generation_conditions("uuid", list(uuid_groups)),
                     "minimum_should_match": 1
                 }
             },
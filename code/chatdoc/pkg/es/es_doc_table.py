@@ -9,6 +9,7 @@ LastEditTime: 2024-10-16 14:09:13
 import time
 from pkg.config import config
 from pkg.es import global_es, EsBaseItem
+from pkg.es.generation import filter_active, generation_conditions
 import requests
 
 from pkg.es.es_retrieval import es_retrieve
@@ -24,6 +25,7 @@ class DocTableModel(EsBaseItem):
     row_id: int = -1           # 行id  markdown2list 之后的行号
     keywords: list[str] = []   # 关键词列表【BM25搜索】 行B字段
     ebed_text: str = ""        # embedding字符串
+    generation: str = ""       # 入库批次，查询只命中文件当前 generation 的数据
 
 
 class DocTableES(object):
@@ -69,6 +71,9 @@ class DocTableES(object):
             "row_id": {
                 "type": "integer",
             },
+            "generation": {
+                "type": "keyword"
+            },
             "created_at": {
                 "type": "date",  # 字段类型为日期
                 "format": "yyyy-MM-dd HH:mm:ss"  # 日期格式示例，根据实际需求调整
@@ -114,19 +119,27 @@ class DocTableES(object):
             }
         ])
 
-    def insert_doc_tables(self, doc_tables: list[DocTableModel]) -> bool:
+    def insert_doc_tables(self, doc_tables: list[DocTableModel], doc_ids: list[str] = None) -> bool:
         """
         插入数据
         :param data:
+        :param doc_ids: 指定 ES 文档 _id(增量入库时使用由内容生成的 id)
         :return:
         """
         return global_es.insert(self.index_name, docs=[
             {
                 "_index": self.index_name,
-                "_source": doc_table.model_dump()
-            } for doc_table in doc_tables
+                "_source": doc_table.model_dump(),
+                **({"_id": doc_ids[i]} if doc_ids else {})
+            } for i, doc_table in enumerate(doc_tables)
         ])
 
+    def get_ids_by_file_uuid(self, uuid) -> list[str]:
+        return [hit["_id"] for hit in global_es.scan(self.index_name, query=dict(term=dict(uuid=uuid)))]
+
+    def delete_by_ids(self, ids: list[str]) -> bool:
+        return global_es.delete_documents(self.index_name, ids)
+
     def delete_by_file_uuid(self, uuid, wait_delete=True):
         start_time = time.time()
         global_es.delete_document_by_query(index=self.index_name, query=dict(term=dict(uuid=uuid)), wait_delete=wait_delete)
@@ -152,10 +165,13 @@ class DocTableES(object):
                                # EmbeddingArgs(type=EmbeddingType.peg, field="peg_embedding", size=size),
                            ],
                            must_conditions=[
-                               dict(terms=dict(uuid=document_uuids))
+                               dict(terms=dict(uuid=document_uuids)),
+                               *generation_conditions("uuid", document_uuids),
                            ] if document_uuids else [],
                            )
 
+        if not document_uuids:
+            hits = filter_active(hits, lambda hit: hit["uuid"], lambda hit: hit.get("generation"))
         hits = self.filter_by_embedding(hits, ebd_text, match_score=0.5)
         return [DocTableModel.from_hit(hit) for hit in hits]
 
@@ -178,6 +194,7 @@ class DocTableES(object):
         condition_filter = [
             dict(terms=dict(uuid=document_uuids)),
             dict(term=dict(type=DocTableType.THREE_TABLE.value)),
+            *generation_conditions("uuid", document_uuids),
         ]
         op_fields = DocTableModel.keys(exclude=["acge_embedding", "peg_embedding"])
         search_body = {
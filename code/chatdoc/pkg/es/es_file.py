@@ -9,6 +9,7 @@ LastEditTime: 2024-10-16 10:58:50
 import time
 from pkg.config import config
 from pkg.es import global_es, EsBaseItem, es_index_default_settings
+from pkg.es.generation import filter_active, generation_conditions
 from pkg.utils.logger import logger
 import requests
 
@@ -35,6 +36,8 @@ class ESFileObject(EsBaseItem):
     summary: str
     doc_fragments_json: str = ""
     tree_summaries: list[str] = []
+    # 入库批次，查询只命中文件当前 generation 的文件信息
+    generation: str = ""
 
     def get_file_desc_md(self, company_mapper: dict):
         """
@@ -78,6 +81,10 @@ class FileES(object):
                 "type": "keyword",
                 "ignore_above": 100
             },
+            # 入库批次
+            "generation": {
+                "type": "keyword"
+            },
             # 年份
             "year": {
                 "type": "keyword",
@@ -173,7 +180,12 @@ class FileES(object):
         ])
 
     def update_file(self, file_uuid, **kwargs):
-        exist_doc = global_es.get_extact_unique_field(self.index_name, "uuid", file_uuid)
+        hits = global_es.conn.search(index=self.index_name, size=1, query={
+            "bool": {
+                "filter": [dict(term=dict(uuid=file_uuid)), *generation_conditions("uuid", [file_uuid])],
+            }
+        })["hits"]["hits"]
+        exist_doc = hits[0] if hits else None
         if exist_doc:
             global_es.upsert_document(self.index_name, exist_doc["_id"], kwargs)
 
@@ -206,10 +218,10 @@ class FileES(object):
                 }
             }
         })
-        return [
+        return filter_active([
             ESFileObject.from_hit(hit["_source"])
             for hit in hits
-        ]
+        ], lambda file: file.uuid)
 
     def delete_by_file_uuid(self, uuid, wait_delete=True):
         start_time = time.time()
@@ -225,7 +237,11 @@ class FileES(object):
         hits = global_es.search(self.index_name, {
             "_source": ESFileObject.keys(exclude=["acge_embedding", "peg_embedding"]) if with_doc_fragments_json else ESFileObject.keys(exclude=["acge_embedding", "peg_embedding", "doc_fragments_json"]),
             "size": len(uuids),
-            "query": dict(terms=dict(uuid=uuids)),
+            "query": {
+                "bool": {
+                    "filter": [dict(terms=dict(uuid=uuids)), *generation_conditions("uuid", uuids)],
+                }
+            },
         })
         return [
             ESFileObject.from_hit(hit["_source"])
@@ -238,7 +254,7 @@ class FileES(object):
             "size": 1,
             "query": {
                 "bool": {
-                    "filter": [dict(term=dict(uuid=uuid))],
+                    "filter": [dict(term=dict(uuid=uuid)), *generation_conditions("uuid", [uuid])],
                 }
             }
         })
@@ -263,10 +279,10 @@ class FileES(object):
                 }
             },
         })
-        return [
+        return filter_active([
             ESFileObject.from_hit(hit["_source"])
             for hit in hits
-        ]
+        ], lambda file: file.uuid)
 
 
 if __name__ == "__main__":
@@ -10,10 +10,16 @@ import time
 from pkg.config import config
 from pkg.embedding import EmbeddingType
 from pkg.es import global_es, EsBaseItem
+from pkg.es.fragment_payload import invalidate_fragment_payloads, touch_fragment_versions
+from pkg.es.vector_first_pass import embedding_properties
 from pkg.utils.logger import logger
 import requests
 
 
+# 预计算的子树聚合字段，体积较大且只在问答时从切片树中读取
+MATERIALIZED_TREE_KEYS = ["tree_ori_ids", "tree_text", "tree_all_texts"]
+
+
 class PDocFragmentModel(EsBaseItem):
     user_id: str = ""               # 用户id
     uuid: str = ""                  # 切片唯一标识uuid
@@ -40,6 +46,13 @@ class PDocFragmentModel(EsBaseItem):
     table_start_row_idx: int = 0    # 表格起始行
     table_end_row_idx: int = 0      # 表格结束行
 
+    content_hash: str = ""          # 切片内容摘要，增量入库时判断切片是否变化
+
+    # ---- 入库时预计算的子树聚合，只存放在切片树json中，不写入ES ----
+    tree_ori_ids: list[str] = []    # 节点及子孙节点的ori_id(非叶子节点)
+    tree_text: str = ""             # 节点及子孙节点拼接的原文(非叶子节点及表格叶子节点)
+    tree_all_texts: list[str] = []  # 节点及子孙节点的原文列表(非叶子节点及表格叶子节点)
+
 
 class PDocFragmentES(object):
 
@@ -119,14 +132,14 @@ class PDocFragmentES(object):
             "table_end_row_idx": {
                 "type": "integer"
             },
+            "content_hash": {
+                "type": "keyword"
+            },
             "created_at": {
                 "type": "date",  # 字段类型为日期
                 "format": "yyyy-MM-dd HH:mm:ss"  # 日期格式示例，根据实际需求调整
             },
-            "acge_embedding": {
-                "type": "dense_vector",
-                "dims": 1024,
-            }
+            **embedding_properties("acge_embedding", dims=1024),
         }
 
     def create_index(self):
@@ -139,7 +152,7 @@ class PDocFragmentES(object):
 
     @property
     def keys(self):
-        return PDocFragmentModel.keys()
+        return PDocFragmentModel.keys(exclude=MATERIALIZED_TREE_KEYS)
 
     def wait_delete_index_done(self):
         import time
@@ -165,29 +178,36 @@ class PDocFragmentES(object):
         :param data:
         :return:
         """
-        return global_es.insert(self.index_name, docs=[
+        inserted = global_es.insert(self.index_name, docs=[
             {
                 "_index": self.index_name,
+                "_id": doc_fragment.uuid,
                 "_source": doc_fragment.model_dump()
             }
         ])
+        touch_fragment_versions([doc_fragment.file_uuid])
+        return inserted
 
     def insert_doc_fragments(self, doc_fragments: list[PDocFragmentModel]) -> bool:
         """
-        插入数据
+        插入数据，_id 即切片 uuid，proxy 回写 embedding 时按 _id 直接更新
         :param data:
         :return:
         """
-        return global_es.insert(self.index_name, docs=[
+        inserted = global_es.insert(self.index_name, docs=[
             {
                 "_index": self.index_name,
-                "_source": doc_fragment.model_dump()
+                "_id": doc_fragment.uuid,
+                "_source": doc_fragment.model_dump(exclude=MATERIALIZED_TREE_KEYS)
             } for doc_fragment in doc_fragments
         ])
+        touch_fragment_versions([doc_fragment.file_uuid for doc_fragment in doc_fragments])
+        return inserted
 
     def delete_by_file_uuid(self, file_uuid, wait_delete=True):
         start_time = time.time()
         global_es.delete_document_by_query(index=self.index_name, query=dict(term=dict(file_uuid=file_uuid)), wait_delete=wait_delete)
+        touch_fragment_versions([file_uuid])
         logger.info(f"PDocFragmentES delete_by_file_uuid: {file_uuid}, cost: {1000*(time.time() - start_time):.1}ms")
 
     def delete_by_user_and_file_uuids(self, user_id, uuids, wait_delete=True):
@@ -201,8 +221,36 @@ class PDocFragmentES(object):
             }
         }
         global_es.delete_document_by_query(index=self.index_name, query=query, wait_delete=wait_delete)
+        touch_fragment_versions(uuids)
         logger.info(f"PDocFragmentES delete_by_user_and_file_uuid, user_id: {user_id}, uuids: {uuids}, cost: {1000*(time.time() - start_time):.1}ms")
 
+    def get_content_hashes_by_user_and_file_uuid(self, user_id, file_uuid) -> list[dict]:
+        """
+        已入库切片的 _id / uuid / content_hash，增量入库时做对比
+        """
+        query = {
+            "bool": {
+                "must": [
+                    {"term": {"file_uuid": file_uuid}},
+                    {"term": {"user_id": user_id}}
+                ]
+            }
+        }
+        return global_es.scan(self.index_name, query=query, source=["uuid", "content_hash"])
+
+    def delete_by_ids(self, ids: list[str], file_uuid: str = "") -> bool:
+        # _id 即切片 uuid，本进程内直接失效；其他进程按文件的切片版本号失效
+        invalidate_fragment_payloads(self.index_name, ids)
+        deleted = global_es.delete_documents(self.index_name, ids)
+        touch_fragment_versions([file_uuid])
+        return deleted
+
+    def update_by_ids(self, docs: dict[str, dict]) -> bool:
+        invalidate_fragment_payloads(self.index_name, list(docs) + [doc["uuid"] for doc in docs.values() if doc.get("uuid")])
+        updated = global_es.update_documents(self.index_name, docs)
+        touch_fragment_versions([doc.get("file_uuid") for doc in docs.values()])
+        return updated
+
     def get_by_uuids(self, uuids, fillup=True) -> list[PDocFragmentModel]:
         uuids = list(set(uuids))
         hits = global_es.search(index=self.index_name, search_body=dict(
@@ -118,19 +118,35 @@ class PDocTableES(object):
             }
         ])
 
-    def insert_doc_tables(self, doc_tables: list[PDocTableModel]) -> bool:
+    def insert_doc_tables(self, doc_tables: list[PDocTableModel], doc_ids: list[str] = None) -> bool:
         """
         插入数据
         :param data:
+        :param doc_ids: 指定 ES 文档 _id(增量入库时使用由内容生成的 id)
         :return:
         """
         return global_es.insert(self.index_name, docs=[
             {
                 "_index": self.index_name,
-                "_source": doc_table.model_dump()
-            } for doc_table in doc_tables
+                "_source": doc_table.model_dump(),
+                **({"_id": doc_ids[i]} if doc_ids else {})
+            } for i, doc_table in enumerate(doc_tables)
         ])
 
+    def get_ids_by_user_and_file_uuid(self, user_id, uuid) -> list[str]:
+        query = {
+            "bool": {
+                "must": [
+                    {"term": {"uuid": uuid}},
+                    {"term": {"user_id": user_id}}
+                ]
+            }
+        }
+        return [hit["_id"] for hit in global_es.scan(self.index_name, query=query)]
+
+    def delete_by_ids(self, ids: list[str]) -> bool:
+        return global_es.delete_documents(self.index_name, ids)
+
     def delete_by_file_uuid(self, uuid, wait_delete=True):
         start_time = time.time()
         global_es.delete_document_by_query(index=self.index_name, query=dict(term=dict(uuid=uuid)), wait_delete=wait_delete)
@@ -164,10 +164,10 @@ class PFileES(object):
         url = config["es"]["hosts"] + "/" + self.index_name
         requests.delete(url)
 
-    def insert_file(self, file: PESFileObject, wait_insert=True, wait_sec: int = 30, sleep_gap=0.5):
+    def insert_file(self, file: PESFileObject, wait_insert=True):
         """
         插入数据
-        :param data:
+        :param wait_insert: 写入后 refresh 一次使文件立即可检索，不再轮询查询数量
         :return:
         """
         insert_succ = global_es.insert(self.index_name, docs=[
@@ -179,28 +179,11 @@ class PFileES(object):
         if not insert_succ:
             return False
 
-        if not wait_insert:
-            return True
-
-        query = {
-            "bool": {
-                "must": [
-                    {"term": {"uuid": file.uuid}},
-                    {"term": {"user_id": file.user_id}}
-                ]
-            }
-        }
-
-        st = time.time()
-        while time.time() < st + wait_sec:
-            count = global_es.get_query_count(self.index_name, query)
-            if count > 0:
-                logger.info(f"wait_insert file succ: time cost is {1000*(time.time() - st):.1f}ms")
-                return True
-            time.sleep(sleep_gap)
-
-        logger.error(f"Error: wait_insert file timeout: {query}")
-        return False
+        if wait_insert:
+            start_time = time.time()
+            global_es.conn.indices.refresh(index=self.index_name)
+            logger.info(f"PFileES insert_file refresh, uuid: {file.uuid}, cost: {1000*(time.time() - start_time):.1f}ms")
+        return True
 
     def update_file(self, file_uuid, **kwargs):
         exist_doc = global_es.get_extact_unique_field(self.index_name, "uuid", file_uuid)
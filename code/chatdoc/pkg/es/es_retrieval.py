@@ -6,13 +6,15 @@ LastEditTime: 2025-03-08 23:50:57
 '''
 
 from pkg.embedding import embedding_text_by_type, EmbeddingType
-from pkg.utils.logger import logger
 from pkg.utils.decorators import register_span_func
 from pkg.utils.rrf import RRF
 from pkg.es import global_es
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.es.fragment_payload import vector_hits_to_results
+from pkg.es.vector_first_pass import first_pass_enabled, first_pass_search_body, cosine_to_dot_product
+from pkg.es.generation import filter_active
+from pkg.utils.stage_dag import stage_pool
 from pydantic import BaseModel
-from pkg.vdb import get_vector_db_model
+from pkg.vdb import get_vector_db_model, get_es_num_candidates, use_es_knn
 
 
 class EmbeddingArgs(BaseModel):
@@ -31,6 +33,9 @@ def retrieval_embeddings_by_es(index, embedding_field_name, question_embedding:
         embedding_name: 查询问题匹配的ES数据库的表名的索引
     Returns:
     """
+    if first_pass_enabled():
+        return _first_pass_hits(index, first_pass_search_body(embedding_field_name, question_embedding, size, op_fields, must_conditions))
+
     source_string = f"""
                     if (!doc.containsKey('{embedding_field_name}') || doc['{embedding_field_name}'].empty) {{
                         return 0; 
@@ -80,6 +85,61 @@ def retrieval_embeddings_by_es(index, embedding_field_name, question_embedding:
     ]
 
 
+def retrieval_embeddings_by_es_knn(index, embedding_field_name, question_embedding: list[float], size: int, op_fields: list = [], must_conditions: list = []):
+    """
+    稠密检索，使用 ES knn(HNSW) 近似检索，must_conditions 作为 knn 的前置过滤条件(file_uuid/user_id/type)
+    Args:
+        question_embedding: 查询问题的向量
+        size: 返回的top-k的个数
+        must_conditions: 过滤条件，如 terms file_uuid / term user_id
+    Returns:
+    """
+    if first_pass_enabled():
+        return _first_pass_hits(index, first_pass_search_body(embedding_field_name, question_embedding, size, op_fields, must_conditions, knn=True))
+
+    knn = {
+        "field": embedding_field_name,
+        "query_vector": question_embedding,
+        "k": size,
+        "num_candidates": get_es_num_candidates(size),
+    }
+    if must_conditions:
+        knn["filter"] = {
+            "bool": {
+                "filter": list(must_conditions)
+            }
+        }
+
+    query = {
+        "_source": op_fields,
+        "size": size,
+        "knn": knn,
+    }
+
+    return [
+        {
+            "score": cosine_to_dot_product(hit["_score"]),
+            "_id": hit["_id"],
+            **hit["_source"]
+        }
+        for hit in global_es.search(index, query)
+    ]
+
+
+def _first_pass_hits(index, query: dict):
+    """
+    一阶段向量召回 + 全精度重排，得分即全精度点积
+    """
+    return [
+        {
+            "score": hit["_score"],
+            "_id": hit["_id"],
+            **hit["_source"]
+        }
+        for hit in global_es.search(index, query)
+    ]
+
+
 def retrieval_embeddings_by_tencent(index, embedding_field_name, question_embedding: list[float], size: int, op_fields: list = [], must_conditions: list = []):
     """
     使用腾讯VDB向量去召回，然后从es中加载详情数据
@@ -100,61 +160,14 @@ def retrieval_embeddings_by_tencent(index, embedding_field_name, question_embedd
 
     search_resp = search_analyst(size=size, file_uuids=document_uuids, question_embedding=question_embedding)
 
-    uuids = [hit["id"] for hit in search_resp[0]] if search_resp else []
     uuid_distance = {
         hit["id"]: hit["score"] for hit in search_resp[0]
     } if search_resp else {}
 
-    if len(document_uuids) == 1:
-        filters = [
-            dict(term=dict(file_uuid=document_uuids[0])),
-            dict(terms=dict(uuid=uuids))
-        ]
-
-        query = {
-            "_source": op_fields,
-            "size": len(uuids),
-            "query": {
-                "bool": {
-                    "filter": filters
-                },
-            }
-        }
-
-    else:
-        filters = [
-            dict(terms=dict(uuid=uuids))
-        ]
-        should_conditions = [
-            dict(term=dict(file_uuid=document_uuid)) for document_uuid in document_uuids
-        ]
-        query = {
-            "_source": op_fields,
-            "size": len(uuids),
-            "query": {
-                "bool": {
-                    "should": should_conditions,
-                    "filter": filters
-                },
-            }
-        }
-
-    result = [
-        {
-            "score": hit["_score"],
-            "_id": hit["_id"],
-            **hit["_source"]
-        }
-        for hit in global_es.search(index, query)
-    ]
-
-    result.sort(key=lambda x: uuids.index(x["uuid"]))
-    for item in result:
-        item["score"] = 1 + uuid_distance.get(item["uuid"], 0.0)
-
-    for item, uuid in zip(result, uuids):
-        if item["uuid"] != uuid:
-            logger.warning(f"Not Exactly .... {item['uuid']} | {uuid}")
+    # 详情优先从切片 payload 缓存读取，未命中的 uuid 一次查询 ES；结果保持向量召回顺序
+    result = vector_hits_to_results(index, uuid_distance, op_fields)
+    # 向量库按切片 uuid 召回，重新入库期间旧 generation 的切片尚未回收
+    result = filter_active(result, lambda hit: hit.get("file_uuid"), lambda hit: hit.get("generation"))
     return result
 
 
@@ -178,61 +191,44 @@ def retrieval_embeddings_by_zilliz(index, embedding_field_name, question_embeddi
 
     search_resp = search_analyst(size=size, file_uuids=document_uuids, question_embedding=question_embedding)
 
-    uuids = [hit["entity"]["uuid"] for hit in search_resp[0]] if search_resp else []
     uuid_distance = {
         hit["entity"]["uuid"]: hit["distance"] for hit in search_resp[0]
     } if search_resp else {}
 
-    if len(document_uuids) == 1:
-        filters = [
-            dict(term=dict(file_uuid=document_uuids[0])),
-            dict(terms=dict(uuid=uuids))
-        ]
-
-        query = {
-            "_source": op_fields,
-            "size": len(uuids),
-            "query": {
-                "bool": {
-                    "filter": filters
-                },
-            }
-        }
+    # 详情优先从切片 payload 缓存读取，未命中的 uuid 一次查询 ES；结果保持向量召回顺序
+    result = vector_hits_to_results(index, uuid_distance, op_fields)
+    # 向量库按切片 uuid 召回，重新入库期间旧 generation 的切片尚未回收
+    result = filter_active(result, lambda hit: hit.get("file_uuid"), lambda hit: hit.get("generation"))
 
-    else:
-        filters = [
-            dict(terms=dict(uuid=uuids))
-        ]
-        should_conditions = [
-            dict(term=dict(file_uuid=document_uuid)) for document_uuid in document_uuids
-        ]
-        query = {
-            "_source": op_fields,
-            "size": len(uuids),
-            "query": {
-                "bool": {
-                    "should": should_conditions,
-                    "filter": filters
-                },
-            }
-        }
+    result = [r for r in result if r["score"] >= 1.6]
+    return result
 
-    result = [
-        {
-            "score": hit["_score"],
-            "_id": hit["_id"],
-            **hit["_source"]
-        }
-        for hit in global_es.search(index, query)
-    ]
 
-    result.sort(key=lambda x: uuids.index(x["uuid"]))
-    for item in result:
-        item["score"] = 1 + uuid_distance.get(item["uuid"], 0.0)
+def retrieval_embeddings_by_local(index, embedding_field_name, question_embedding: list[float], size: int, op_fields: list = [], must_conditions: list = []):
+    """
+    使用本地向量库召回，然后从es中加载详情数据
+    """
+    from pkg.vdb.local import search_analyst
+
+    document_uuids = []
+
+    for condition in must_conditions:
+        if "terms" in condition and "file_uuid" in condition["terms"]:
+            document_uuids = condition["terms"]["file_uuid"]
+
+        elif "terms" in condition and "uuid" in condition["terms"]:
+            document_uuids = condition["terms"]["uuid"]
+
+    search_resp = search_analyst(size=size, file_uuids=document_uuids, question_embedding=question_embedding)
+
+    uuid_distance = {
+        hit["entity"]["uuid"]: hit["distance"] for hit in search_resp[0]
+    } if search_resp else {}
 
-    for item, uuid in zip(result, uuids):
-        if item["uuid"] != uuid:
-            logger.warning(f"Not Exactly .... {item['uuid']} | {uuid}")
+    # 详情优先从切片 payload 缓存读取，未命中的 uuid 一次查询 ES；结果保持向量召回顺序
+    result = vector_hits_to_results(index, uuid_distance, op_fields)
+    # 向量库按切片 uuid 召回，重新入库期间旧 generation 的切片尚未回收
+    result = filter_active(result, lambda hit: hit.get("file_uuid"), lambda hit: hit.get("generation"))
 
     result = [r for r in result if r["score"] >= 1.6]
     return result
@@ -281,9 +277,10 @@ def retrieve_bm25(index, text, text_field, size: int, op_fields: list = [], must
 def get_retrieval_embeddings_handler():
     current_vector_model = get_vector_db_model()
     vector_model_map = dict(
-        es=retrieval_embeddings_by_es,
+        es=retrieval_embeddings_by_es_knn if use_es_knn() else retrieval_embeddings_by_es,
         zilliz=retrieval_embeddings_by_zilliz,
-        tencent=retrieval_embeddings_by_tencent
+        tencent=retrieval_embeddings_by_tencent,
+        local=retrieval_embeddings_by_local,
     )
     func = vector_model_map.get(current_vector_model, retrieval_embeddings_by_es)
     return register_span_func()(func)
@@ -303,8 +300,7 @@ def es_retrieve(index, text, text_field, bm25_size=10, text_for_embedding="", op
     for embedding_arg in embedding_args:
         question_embedding = embedding_text_by_type(text_for_embedding or text, embedding_arg.type, dimension=embedding_arg.dimension, use_cache=True)
 
-        _t = ThreadWithReturnValue(target=get_retrieval_embeddings_handler(), args=(index, embedding_arg.field, question_embedding, embedding_arg.size, op_fields, must_conditions,))
-        _t.start()
+        _t = stage_pool.submit(get_retrieval_embeddings_handler(), index, embedding_arg.field, question_embedding, embedding_arg.size, op_fields, must_conditions)
         _retrieve_threads.append(_t)
 
     # BM25 Recall
@@ -314,7 +310,7 @@ def es_retrieve(index, text, text_field, bm25_size=10, text_for_embedding="", op
     )
 
     for _t, embedding_arg in zip(_retrieve_threads, embedding_args):
-        _hits = _t.join()
+        _hits = _t.result()
         hits.extend(
             [dict(**_hit, retrieval_type=embedding_arg.type.value) for _hit in _hits if _hit["ebed_text"] != "ROOT" and "......." not in _hit['ebed_text']]
         )
@@ -0,0 +1,127 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-31 10:26:03
+LastEditors: longsion
+LastEditTime: 2025-03-31 17:08:51
+
+切片详情(payload)缓存：zilliz / tencent / local 向量库只返回切片 uuid，详情优先从进程内缓存读取，只对未命中的 uuid 查询 ES
+- 缓存项带上所属文件的版本(当前 generation + 切片版本号)，切片写入/更新/删除后在 redis 中刷新文件的切片版本号，
+  其他进程(doc_worker 重新解析、增量入库)写入后版本不一致即视为未命中，不依赖过期时间
+- fragment_payload_max_mb 为 0 时不缓存，每次查询 ES
+'''
+
+from typing import Optional
+
+from pkg.config import config
+from pkg.es import global_es
+from pkg.es.generation import GENERATION_KEY, new_generation
+from pkg.utils.lru_cache import BoundedLRUCache
+
+CACHE_CONFIG = config.get("cache") or {}
+PAYLOAD_MAX_BYTES = int(CACHE_CONFIG.get("fragment_payload_max_mb", 256)) * 1024 * 1024
+PAYLOAD_TTL = int(CACHE_CONFIG.get("fragment_payload_ttl", 600))
+
+# 文件的切片版本号(file_uuid -> version)，切片写入后刷新
+FRAGMENT_VERSION_KEY = "file-fragment-version"
+
+# (index, uuid) -> {"_id", **_source, FIELDS_KEY: 已查询的字段, VERSION_KEY: 文件版本}，与 payload 放在一起以便按字节数估算缓存大小
+FIELDS_KEY = "__fields__"
+VERSION_KEY = "__version__"
+payload_cache: Optional[BoundedLRUCache] = BoundedLRUCache(max_bytes=PAYLOAD_MAX_BYTES, expiration=PAYLOAD_TTL) if PAYLOAD_MAX_BYTES else None
+
+
+def _redis():
+    from pkg.redis.redis import redis_store
+    return redis_store
+
+
+def get_fragment_versions(file_uuids: list[str]) -> dict[str, str]:
+    """
+    文件当前的版本：generation + 切片版本号，一次 redis 往返
+    """
+    file_uuids = list(dict.fromkeys(file_uuids))
+    if not file_uuids:
+        return {}
+    pipe = _redis().pipeline(transaction=False)
+    pipe.hmget(GENERATION_KEY, file_uuids)
+    pipe.hmget(FRAGMENT_VERSION_KEY, file_uuids)
+    generations, versions = pipe.execute()
+    return {
+        file_uuid: f"{(generation or b'').decode()}|{(version or b'').decode()}"
+        for file_uuid, generation, version in zip(file_uuids, generations, versions)
+    }
+
+
+def touch_fragment_versions(file_uuids: list[str]):
+    """
+    切片写入/更新/删除完成后调用，各进程中该文件已缓存的切片详情随之失效
+    """
+    file_uuids = [file_uuid for file_uuid in dict.fromkeys(file_uuids) if file_uuid]
+    if not file_uuids:
+        return
+    version = new_generation()
+    _redis().hset(FRAGMENT_VERSION_KEY, mapping={file_uuid: version for file_uuid in file_uuids})
+
+
+def load_fragment_payloads(index: str, uuids: list[str], op_fields: list) -> dict[str, dict]:
+    """
+    按切片 uuid 加载 op_fields，返回 uuid -> {"_id", **_source}，ES 中不存在的 uuid 不在结果中
+    """
+    fields = frozenset(op_fields) - {"_id"}
+    cached = {}
+    if payload_cache is not None:
+        for uuid in uuids:
+            item = payload_cache.get((index, uuid))
+            if item is not None and fields <= item[FIELDS_KEY]:
+                cached[uuid] = item
+
+    # 先取版本再查 ES：查询期间切片被更新时缓存项带的是旧版本，下次查询即失效
+    versions = get_fragment_versions([item.get("file_uuid") for item in cached.values() if item.get("file_uuid")])
+    payloads = {
+        uuid: {key: value for key, value in item.items() if key not in (FIELDS_KEY, VERSION_KEY)}
+        for uuid, item in cached.items() if item[VERSION_KEY] == versions.get(item.get("file_uuid"))
+    }
+    missing = [uuid for uuid in uuids if uuid not in payloads]
+
+    if missing:
+        query = {
+            "_source": list(fields | {"uuid", "file_uuid"}),
+            "size": len(missing),
+            "query": {
+                "bool": {
+                    "filter": [dict(terms=dict(uuid=missing))]
+                },
+            }
+        }
+        hits = global_es.search(index, query)
+        if payload_cache is not None:
+            # 缓存中没有的文件查询后再取版本，仅在切片恰好于两次读取之间更新时可能缓存旧数据，由过期时间兜底
+            versions.update(get_fragment_versions([
+                hit["_source"]["file_uuid"] for hit in hits
+                if hit["_source"].get("file_uuid") and hit["_source"]["file_uuid"] not in versions
+            ]))
+        for hit in hits:
+            payload = {"_id": hit["_id"], **hit["_source"]}
+            payloads[payload["uuid"]] = payload
+            if payload_cache is not None and payload.get("file_uuid") in versions:
+                payload_cache[(index, payload["uuid"])] = {**payload, FIELDS_KEY: fields | {"uuid", "file_uuid"}, VERSION_KEY: versions[payload["file_uuid"]]}
+
+    return payloads
+
+
+def vector_hits_to_results(index: str, uuid_distance: dict[str, float], op_fields: list) -> list[dict]:
+    """
+    向量库召回结果(按相似度排序的 uuid -> distance)转为检索结果，保持召回顺序，score 为 1 + distance
+    """
+    payloads = load_fragment_payloads(index, list(uuid_distance), op_fields)
+    return [
+        {**payloads[uuid], "score": 1 + distance}
+        for uuid, distance in uuid_distance.items() if uuid in payloads
+    ]
+
+
+def invalidate_fragment_payloads(index: str, uuids: list[str]):
+    if payload_cache is None:
+        return
+    for uuid in uuids:
+        del payload_cache[(index, uuid)]
@@ -0,0 +1,213 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-26 10:21:05
+LastEditors: longsion
+LastEditTime: 2025-03-26 18:37:44
+
+按代(generation)重新入库：重新解析时切片/原文/表格行/文件数据写入新的 generation，全部写入后原子切换文件的当前 generation，旧数据后台回收
+- 当前 generation 存放在 redis hash 中(file_uuid -> generation)，查询只命中当前 generation 的文档，不会读到写了一半或删了一半的数据
+- 未记录 generation 的文件(存量数据)只命中不带 generation 字段的文档
+- generation 由毫秒时间戳开头，按字符串比较即先后顺序；只允许切换到更新的 generation，回收时删除比当前 generation 更旧的文档
+- 删除文件即切换到一个没有任何文档的新 generation，查询立即不可见，数据后台删除
+'''
+
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from pkg.config import config
+from pkg.es import global_es
+from pkg.utils.incremental_index import incremental_index_enabled
+from pkg.utils.logger import logger
+
+GENERATION_FIELD = "generation"
+GENERATION_KEY = "file-generation"
+
+# 只允许切换到更新的 generation，返回切换后的当前 generation
+_ACTIVATE_SCRIPT = """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if current and current > ARGV[2] then
+    return current
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return ARGV[2]
+"""
+
+# 当前 generation 未变化时清除记录
+_RELEASE_SCRIPT = """
+if redis.call('HGET', KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+gc_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="es_generation_gc")
+
+
+def generation_enabled() -> bool:
+    """
+    parse.generation 开启时按 generation 重新入库；增量入库需要原地更新切片，不走 generation
+    """
+    return str(config["parse"].get("generation", False)).lower() in ('1', 'true') and not incremental_index_enabled()
+
+
+def new_generation() -> str:
+    return f"{int(time.time() * 1000):013d}{uuid.uuid4().hex[:8]}"
+
+
+def _redis():
+    from pkg.redis.redis import redis_store
+    return redis_store
+
+
+def _generation_indexes() -> list[tuple[str, str]]:
+    """
+    按 generation 写入的索引及其文件 uuid 字段
+    """
+    from pkg.es.es_doc_fragment import DocFragmentES
+    from pkg.es.es_doc_item import DocItemES
+    from pkg.es.es_doc_table import DocTableES
+    from pkg.es.es_file import FileES
+
+    return [
+        (DocFragmentES().index_name, "file_uuid"),
+        (DocItemES().index_name, "uuid"),
+        (DocTableES().index_name, "uuid"),
+        (FileES().index_name, "uuid"),
+    ]
+
+
+def get_active_generations(file_uuids: list[str]) -> dict[str, str]:
+    """
+    文件当前的 generation，未记录的文件(存量数据)不在结果中
+    """
+    file_uuids = list(dict.fromkeys(file_uuids))
+    if not file_uuids:
+        return {}
+    values = _redis().hmget(GENERATION_KEY, file_uuids)
+    return {file_uuid: value.decode() for file_uuid, value in zip(file_uuids, values) if value}
+
+
+def generation_conditions(uuid_field: str, file_uuids: list[str]) -> list[dict]:
+    """
+    只命中文件当前 generation 的查询条件，与 terms(uuid_field=file_uuids) 一起使用；未开启时返回空列表
+    generation 全局唯一，已记录的文件直接按 generation 过滤；存量文件只命中不带 generation 字段的文档
+    """
+    if not generation_enabled() or not file_uuids:
+        return []
+
+    actives = get_active_generations(file_uuids)
+    legacy_uuids = [file_uuid for file_uuid in file_uuids if file_uuid not in actives]
+
+    should = []
+    if actives:
+        should.append(dict(terms={GENERATION_FIELD: list(set(actives.values()))}))
+    if legacy_uuids:
+        should.append(dict(bool=dict(
+            filter=[dict(terms={uuid_field: legacy_uuids})],
+            must_not=[dict(exists=dict(field=GENERATION_FIELD))],
+        )))
+    return [dict(bool=dict(should=should, minimum_should_match=1))]
+
+
+def filter_active(items: list, file_uuid_of, generation_of=lambda item: item.generation) -> list:
+    """
+    过滤掉非当前 generation 的文档，用于无法按文件加查询条件的场景(按切片 uuid 加载、向量库召回后加载详情、不限定文件的检索)
+    """
+    if not generation_enabled() or not items:
+        return list(items)
+
+    actives = get_active_generations([file_uuid_of(item) for item in items])
+    return [
+        item for item in items
+        if (generation_of(item) or "") == actives.get(file_uuid_of(item), "")
+    ]
+
+
+def activate_generation(file_uuid: str, generation: str) -> bool:
+    """
+    新 generation 数据全部写入后调用：refresh 使新数据可检索，切换当前 generation，旧数据后台回收
+    已有更新的 generation 时(同一文件并发解析)不切换，本次写入的数据随之回收
+    """
+    indexes = [index for index, _ in _generation_indexes()]
+    global_es.conn.indices.refresh(index=",".join(indexes))
+
+    current = _redis().eval(_ACTIVATE_SCRIPT, 1, GENERATION_KEY, file_uuid, generation)
+    current = current.decode() if isinstance(current, bytes) else current
+    activated = current == generation
+    logger.info(f"activate generation, file_uuid: {file_uuid}, generation: {generation}, activated: {activated}, current: {current}")
+
+    gc_pool.submit(collect_stale_generations, file_uuid, current)
+    return activated
+
+
+def retire_files(file_uuids: list[str]):
+    """
+    删除文件：切换到一个没有任何文档的新 generation，查询立即不可见；ES 数据后台删除，完成后清除 generation 记录
+    向量由调用方按文件 uuid 删除
+    """
+    for file_uuid in file_uuids:
+        generation = new_generation()
+        current = _redis().eval(_ACTIVATE_SCRIPT, 1, GENERATION_KEY, file_uuid, generation)
+        current = current.decode() if isinstance(current, bytes) else current
+        gc_pool.submit(collect_stale_generations, file_uuid, current, with_vectors=False, release=current == generation)
+
+
+def reset_generation(file_uuid: str):
+    """
+    未开启 generation 时重新入库的数据不带 generation 字段，清除记录使其按存量数据查询
+    """
+    _redis().hdel(GENERATION_KEY, file_uuid)
+
+
+def discard_generation(file_uuid: str, generation: str):
+    """
+    入库失败时后台删除本次 generation 已写入的数据，未按 generation 入库时忽略
+    """
+    if generation:
+        gc_pool.submit(_collect, file_uuid, dict(term={GENERATION_FIELD: generation}), f"discard {generation}")
+
+
+def collect_stale_generations(file_uuid: str, generation: str, with_vectors: bool = True, release: bool = False):
+    """
+    删除文件比 generation 更旧的文档(含不带 generation 的存量文档)及其向量，不等待删除完成
+    """
+    stale_condition = dict(bool=dict(
+        should=[
+            dict(range={GENERATION_FIELD: dict(lt=generation)}),
+            dict(bool=dict(must_not=[dict(exists=dict(field=GENERATION_FIELD))])),
+        ],
+        minimum_should_match=1,
+    ))
+    if not _collect(file_uuid, stale_condition, f"before {generation}", with_vectors):
+        return False
+    if release:
+        _redis().eval(_RELEASE_SCRIPT, 1, GENERATION_KEY, file_uuid, generation)
+    return True
+
+
+def _collect(file_uuid: str, generation_condition: dict, desc: str, with_vectors: bool = True) -> bool:
+    from pkg.vdb import delete_vdb_fragments
+
+    try:
+        start_time = time.time()
+        indexes = _generation_indexes()
+
+        def _query(uuid_field: str) -> dict:
+            return dict(bool=dict(filter=[dict(term={uuid_field: file_uuid}), generation_condition]))
+
+        if with_vectors:
+            fragment_index, uuid_field = indexes[0]
+            hits = global_es.scan(fragment_index, query=_query(uuid_field), source=["uuid"])
+            if not delete_vdb_fragments([hit["_source"]["uuid"] for hit in hits], file_uuid=file_uuid):
+                logger.error(f"collect generations delete vectors failed, file_uuid: {file_uuid}, {desc}")
+                return False
+
+        for index, uuid_field in indexes:
+            global_es.delete_document_by_query(index=index, query=_query(uuid_field), wait_delete=False)
+
+        logger.info(f"collect generations, file_uuid: {file_uuid}, {desc}, cost: {1000*(time.time() - start_time):.1f}ms")
+        return True
+    except Exception as e:
+        logger.error(f"collect generations error, file_uuid: {file_uuid}, {desc}, {e}")
+        return False
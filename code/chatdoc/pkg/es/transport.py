@@ -0,0 +1,129 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-10 10:12:31
+LastEditors: longsion
+LastEditTime: 2025-03-10 15:40:06
+'''
+
+import itertools
+import threading
+import time
+
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+
+from pkg.utils.logger import logger
+
+
+# search 默认只保留调用方会用到的字段，减少响应体大小与解析耗时
+DEFAULT_SEARCH_FILTER_PATH = "hits.hits._id,hits.hits._score,hits.hits._source"
+
+
+class EsTransportError(Exception):
+    def __init__(self, message, status_code: int = None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+class _HostState:
+    def __init__(self, host):
+        self.host = host
+        self.failures = 0
+        self.down_until = 0.0
+
+    def is_healthy(self, now):
+        return self.down_until <= now
+
+    def mark_success(self):
+        self.failures = 0
+        self.down_until = 0.0
+
+    def mark_failure(self, now, cooldown, max_cooldown):
+        self.failures += 1
+        # 连续失败时指数退避，避免持续打到已宕机的节点
+        self.down_until = now + min(cooldown * (2 ** (self.failures - 1)), max_cooldown)
+
+
+class EsTransport:
+    """
+    ES HTTP 传输层
+    - 每个 host 一个长连接 Session（连接池复用 TCP/TLS）
+    - 健康感知的 host 轮转：失败的节点进入冷却期，冷却期内优先使用其他健康节点
+    - orjson 编解码 + filter_path 裁剪响应
+    """
+
+    def __init__(self, hosts: list[str], username: str = None, password: str = None,
+                 pool_maxsize: int = 32, timeout: float = 30, cooldown: float = 2, max_cooldown: float = 60):
+        self.hosts = [host.rstrip("/") for host in hosts]
+        self.auth = HTTPBasicAuth(username, password) if username else None
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+
+        self._states = [_HostState(host) for host in self.hosts]
+        self._round_robin = itertools.count()
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _get_session(self, host) -> requests.Session:
+        session = self._sessions.get(host)
+        if session is not None:
+            return session
+
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.auth = self.auth
+                session.verify = False
+                session.headers.update({"Content-Type": "application/json", "Accept": "application/json"})
+                self._sessions[host] = session
+        return session
+
+    def _candidate_states(self) -> list[_HostState]:
+        now = time.time()
+        start = next(self._round_robin) % len(self._states)
+        ordered = self._states[start:] + self._states[:start]
+        healthy = [state for state in ordered if state.is_healthy(now)]
+        # 全部节点都在冷却期时，按最早恢复的顺序兜底重试
+        unhealthy = sorted((state for state in ordered if not state.is_healthy(now)), key=lambda x: x.down_until)
+        return healthy + unhealthy
+
+    def perform_request(self, method: str, path: str, body=None, params: dict = None):
+        data = orjson.dumps(body, option=orjson.OPT_SERIALIZE_NUMPY) if body is not None else None
+        last_error = None
+
+        for state in self._candidate_states():
+            try:
+                resp = self._get_session(state.host).request(method, f"{state.host}{path}", data=data, params=params, timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                state.mark_failure(time.time(), self.cooldown, self.max_cooldown)
+                logger.warning(f"ES host unavailable: {state.host}, error: {e}")
+                last_error = EsTransportError(str(e))
+                continue
+
+            if resp.status_code >= 500 or resp.status_code == 429:
+                state.mark_failure(time.time(), self.cooldown, self.max_cooldown)
+                logger.warning(f"ES host error: {state.host}, status: {resp.status_code}, resp: {resp.text[:500]}")
+                last_error = EsTransportError(resp.text, resp.status_code)
+                continue
+
+            state.mark_success()
+            if resp.status_code >= 400:
+                # 请求本身有问题，换节点也没有意义
+                raise EsTransportError(resp.text, resp.status_code)
+
+            return orjson.loads(resp.content) if resp.content else {}
+
+        raise last_error or EsTransportError("No available ES host")
+
+    def search(self, index, search_body: dict, filter_path: str = DEFAULT_SEARCH_FILTER_PATH) -> dict:
+        params = {"filter_path": filter_path} if filter_path else None
+        return self.perform_request("POST", f"/{index}/_search", body=search_body, params=params)
@@ -0,0 +1,174 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-28 10:12:36
+LastEditors: longsion
+LastEditTime: 2025-03-28 17:45:20
+
+一阶段向量检索 + 全精度重排(vector.es_first_pass)
+- acge embedding 为 matryoshka 向量，截断到前 es_first_pass_dims 维并归一化后写入 {field}_fp，单独建 HNSW(可 int8 量化)用于召回
+- 全精度 embedding 只存 doc values 不建 HNSW，召回 es_rescore_factor 倍候选后按全精度点积重排，得分与原 script_score 一致
+- HNSW 只在开启 vector.es_knn 时建立，script_score 暴力检索不需要
+'''
+
+import math
+
+from pkg.config import config
+from pkg.es import dense_vector_property
+from pkg.utils.logger import logger
+
+FIRST_PASS_SUFFIX = "_fp"
+FIRST_PASS_DIMS = int(config["vector"].get("es_first_pass_dims", 256))
+FIRST_PASS_INT8 = str(config["vector"].get("es_first_pass_int8", True)).lower() in ('1', 'true')
+RESCORE_FACTOR = max(int(config["vector"].get("es_rescore_factor", 4)), 1)
+# knn 得分按 cosine 还原为点积，要求 embedding 为单位向量，写入时偏差超过该值打告警
+UNIT_NORM_TOLERANCE = 1e-3
+
+# 存量文档按全精度向量补写一阶段向量，update_by_query / reindex 使用
+BACKFILL_SCRIPT = """
+def v = ctx._source[params.field];
+if (v != null && v.size() > 0) {
+    int dims = (int) Math.min(params.dims, v.size());
+    double norm = 0;
+    for (int i = 0; i < dims; i++) { norm += v[i] * v[i]; }
+    norm = Math.sqrt(norm);
+    def fp = new ArrayList();
+    for (int i = 0; i < dims; i++) { fp.add(norm > 0 ? v[i] / norm : 0); }
+    ctx._source[params.target] = fp;
+}
+"""
+
+# 与 retrieval_embeddings_by_es 的打分一致：点积，小于 0 记 0
+DOT_PRODUCT_SCRIPT = """
+if (!doc.containsKey(params.field) || doc[params.field].empty) {
+    return 0;
+}
+double dp = dotProduct(params.queryVector, params.field);
+return dp < 0 ? 0 : dp;
+"""
+
+
+def first_pass_enabled() -> bool:
+    # 不引用 pkg.vdb：切片索引定义(es_doc_fragment)加载时 pkg.vdb 可能尚未初始化
+    return config["vector"]["model"] == 'es' and str(config["vector"].get("es_first_pass", False)).lower() in ('1', 'true')
+
+
+def knn_enabled() -> bool:
+    # 同 pkg.vdb.use_es_knn，mapping 定义加载时 pkg.vdb 可能尚未初始化
+    return str(config["vector"].get("es_knn", False)).lower() in ('1', 'true')
+
+
+def cosine_to_dot_product(score: float) -> float:
+    """
+    knn(cosine) 的 _score = (1 + cos) / 2，还原成与 script_score 一致的点积得分(小于 0 记 0)
+    仅当文档向量与查询向量均为单位向量时 cos 才等于点积：acge 接口返回归一化向量，写入时由 embedding_fields 校验
+    """
+    return max(2 * score - 1, 0)
+
+
+def first_pass_field(field: str) -> str:
+    return f"{field}{FIRST_PASS_SUFFIX}"
+
+
+def truncate_vector(vector: list[float], dims: int = FIRST_PASS_DIMS) -> list[float]:
+    """
+    matryoshka 向量截断到前 dims 维并重新归一化
+    """
+    vector = vector[:dims]
+    norm = math.sqrt(sum(x * x for x in vector))
+    return [x / norm for x in vector] if norm > 0 else list(vector)
+
+
+def embedding_properties(field: str, dims: int = 1024) -> dict:
+    """
+    embedding 字段 mapping；未开启 vector.es_knn 时只存 doc values 供 script_score 使用，不建 HNSW
+    开启一阶段检索时全精度向量不建 HNSW，另加截断/量化后的 {field}_fp
+    """
+    if not first_pass_enabled():
+        return {field: dense_vector_property(dims=dims, index=knn_enabled())}
+
+    return {
+        field: dense_vector_property(dims=dims, index=False),
+        first_pass_field(field): dense_vector_property(dims=min(FIRST_PASS_DIMS, dims), index=knn_enabled(), int8=FIRST_PASS_INT8),
+    }
+
+
+def embedding_fields(field: str, vector: list[float]) -> dict:
+    """
+    写入文档的 embedding 字段，开启一阶段检索时带上截断后的向量
+    """
+    if knn_enabled() and not first_pass_enabled():
+        check_unit_norm(field, vector)
+    if not first_pass_enabled():
+        return {field: vector}
+    return {field: vector, first_pass_field(field): truncate_vector(vector)}
+
+
+def check_unit_norm(field: str, vector: list[float]):
+    """
+    knn 检索得分按单位向量还原为点积(cosine_to_dot_product)，非单位向量时 knn 与 script_score 的得分不一致
+    """
+    norm = math.sqrt(sum(x * x for x in vector))
+    if abs(norm - 1) > UNIT_NORM_TOLERANCE:
+        logger.warning(f"{field} norm {norm:.6f} is not unit length, knn score will differ from script_score dot product")
+
+
+def first_pass_search_body(field: str, question_embedding: list[float], size: int, op_fields: list = [], must_conditions: list = [], knn: bool = False) -> dict:
+    """
+    按 {field}_fp 召回 size * es_rescore_factor 个候选，再按全精度向量点积重排取 size 个
+    knn 为 True 时一阶段使用 knn 查询(HNSW)，否则为截断向量上的 script_score 暴力检索
+    """
+    from pkg.vdb import get_es_num_candidates
+
+    window = size * RESCORE_FACTOR
+    fp_field = first_pass_field(field)
+    fp_embedding = truncate_vector(question_embedding)
+
+    if knn:
+        first_pass = {
+            "knn": {
+                "field": fp_field,
+                "query_vector": fp_embedding,
+                "num_candidates": get_es_num_candidates(window),
+                "filter": list(must_conditions),
+            }
+        }
+    else:
+        first_pass = {
+            "bool": {
+                "must": [
+                    {
+                        "script_score": {
+                            "query": {"match_all": {}},
+                            "script": {
+                                "source": DOT_PRODUCT_SCRIPT,
+                                "params": {"field": fp_field, "queryVector": fp_embedding},
+                            }
+                        }
+                    }
+                ],
+                "filter": list(must_conditions),
+            }
+        }
+
+    return {
+        "_source": op_fields,
+        "size": size,
+        "query": first_pass,
+        "rescore": {
+            "window_size": window,
+            "query": {
+                "rescore_query": {
+                    "script_score": {
+                        "query": {"match_all": {}},
+                        "script": {
+                            "source": DOT_PRODUCT_SCRIPT,
+                            "params": {"field": field, "queryVector": question_embedding},
+                        }
+                    }
+                },
+                # 只保留全精度得分
+                "query_weight": 0,
+                "rescore_query_weight": 1,
+            }
+        }
+    }
@@ -14,7 +14,7 @@ from pkg.es.es_doc_table import DocTableModel
 from pkg.es.es_p_doc_fragment import PDocFragmentES, PDocFragmentModel
 from pkg.es.es_p_doc_item import PDocItemES, PDocItemModel
 from pkg.es.es_p_doc_table import PDocTableModel
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.stage_dag import stage_pool
 from pkg.utils.transform import html2markdown
 from pkg.utils import duplicates_list
 
@@ -37,12 +37,11 @@ def fillin_doc_items_cache(doc_item_cache, uuid_ori_id_tuples: list[tuple[str, s
         to_request_list = list(to_request_dict.keys())
         threads = []
         for i in range(0, len(to_request_list), max_batch_size):
-            t = ThreadWithReturnValue(target=DocItemES().get_by_uuid_ori_tuples, kwargs=dict(pairs=to_request_list[i:i + max_batch_size]))
-            t.start()
+            t = stage_pool.submit(DocItemES().get_by_uuid_ori_tuples, pairs=to_request_list[i:i + max_batch_size])
             threads.append(t)
 
         for t in threads:
-            doc_items = t.join()
+            doc_items = t.result()
             for doc_item in doc_items:
                 for ori_id in doc_item.ori_id:
                     hashkey = f"{doc_item.uuid}|{ori_id}"
@@ -67,12 +66,11 @@ def fillin_personal_doc_items_cache(doc_item_cache, user_id: str, uuid_ori_id_tu
         to_request_list = list(to_request_dict.keys())
         threads = []
         for i in range(0, len(to_request_list), max_batch_size):
-            t = ThreadWithReturnValue(target=PDocItemES().get_by_uuid_ori_tuples, kwargs=dict(pairs=to_request_list[i:i + max_batch_size], user_id=user_id))
-            t.start()
+            t = stage_pool.submit(PDocItemES().get_by_uuid_ori_tuples, pairs=to_request_list[i:i + max_batch_size], user_id=user_id)
             threads.append(t)
 
         for t in threads:
-            doc_items = t.join()
+            doc_items = t.result()
             for doc_item in doc_items:
                 for ori_id in doc_item.ori_id:
                     hashkey = f"{doc_item.uuid}|{ori_id}"
@@ -167,6 +165,10 @@ def get_fragment_ori_ids(fragment: Union[DocFragmentModel, PDocFragmentModel], f
     if fragment.leaf:
         return fragment.ori_id
 
+    # 入库时已预计算
+    if fragment.tree_ori_ids:
+        return fragment.tree_ori_ids
+
     ori_ids = copy.copy(fragment.ori_id)
 
     children_ori_ids = [
@@ -197,6 +199,10 @@ def get_fragment_ori_text(fragment: Union[DocFragmentModel, PDocFragmentModel],
     if isinstance(fragment, PDocFragmentModel):
         doc_items_cache = p_doc_items_cache
 
+    # 入库时已预计算
+    if fragment.tree_text:
+        return fragment.tree_text
+
     if not fragment.ori_id:
         return ""
 
@@ -227,6 +233,10 @@ def get_fragment_all_texts(fragment: Union[DocFragmentModel, PDocFragmentModel],
     if isinstance(fragment, PDocFragmentModel):
         doc_items_cache = p_doc_items_cache
 
+    # 入库时已预计算
+    if fragment.tree_all_texts:
+        return fragment.tree_all_texts
+
     if not fragment.ori_id:
         return []
 
@@ -10,12 +10,14 @@ from pkg.es.es_p_file import PFileES
 from pkg.global_.objects import Context, GlobalQAType, QuestionAnalysisResult
 from pkg.es.es_file import FileES
 from pkg.es.es_company import CompanyES
+from pkg.es import entity_index
 from pkg.query_analysis import query_extract_uie
 from pkg.utils import ensure_list
 from pkg.utils.decorators import register_span_func
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.stage_dag import stage_pool
 from pkg.config import config
-from difflib import get_close_matches, SequenceMatcher
+from difflib import SequenceMatcher
+from pkg.utils.fuzzy_match import get_close_matches
 
 from datetime import datetime
 import re
@@ -68,9 +70,18 @@ def gen_query(query, words):
     return query
 
 
+def search_analyst_file_brief(question: str):
+    # 进程内实体索引定位问题中提到的公司的文件，无歧义命中时不查询 ES；未命中再按文件名查询 ES，有歧义时与 ES 结果合并去重
+    files, ambiguous = entity_index.locate_files(question)
+    if files and not ambiguous:
+        return files
+    files = files + FileES().search_file_brief_by_query(gen_query(question, filter_words))
+    return list({file.uuid: file for file in files}.values())[:entity_index.MAX_LOCATE_FILES]
+
+
 def search_both_file_brief(user_id: str, question: str):
-    analyst_brief_files = FileES().search_file_brief_by_query(question)
-    personal_brief_files = PFileES().search_file_brief_by_query(user_id, question)
+    analyst_brief_files = search_analyst_file_brief(question)
+    personal_brief_files = PFileES().search_file_brief_by_query(user_id, gen_query(question, filter_words))
 
     return analyst_brief_files + personal_brief_files
 
@@ -82,21 +93,18 @@ def preprocess_question(context: Context) -> Context:
     question = replace_query(ori_question)
     if question:
         if context.params.qa_type == GlobalQAType.ANALYST.value:
-            _files_brief_t = ThreadWithReturnValue(target=FileES().search_file_brief_by_query, args=(gen_query(replace_query(context.params.question), filter_words),))
+            _files_brief_t = stage_pool.submit(search_analyst_file_brief, question)
 
         elif context.params.qa_type == GlobalQAType.PERSONAL.value:
-            _files_brief_t = ThreadWithReturnValue(target=PFileES().search_file_brief_by_query, args=(context.params.user_id, gen_query(replace_query(context.params.question), filter_words),))
+            _files_brief_t = stage_pool.submit(PFileES().search_file_brief_by_query, context.params.user_id, gen_query(replace_query(context.params.question), filter_words))
 
         else:
-            _files_brief_t = ThreadWithReturnValue(target=search_both_file_brief, args=(context.params.user_id, gen_query(replace_query(context.params.question), filter_words),))
-
-        _files_brief_t.start()
+            _files_brief_t = stage_pool.submit(search_both_file_brief, context.params.user_id, question)
 
-        _extract_info_t = ThreadWithReturnValue(target=get_extract_info, args=(question,))
-        _extract_info_t.start()
+        _extract_info_t = stage_pool.submit(get_extract_info, question)
 
-        files_brief = _files_brief_t.join()
-        extract_info = _extract_info_t.join()
+        files_brief = _files_brief_t.result()
+        extract_info = _extract_info_t.result()
     else:
         files_brief = []
         extract_info = {}
@@ -104,7 +112,7 @@ def preprocess_question(context: Context) -> Context:
     match_names = []
     # extract commpany mapper
     if files_brief:
-        company_entities = CompanyES().search_company_by_eids_or_uids(list(set([_file.company for _file in files_brief if _file.company])))
+        company_entities = entity_index.search_company_by_eids_or_uids(list(set([_file.company for _file in files_brief if _file.company])))
         context.company_mapper.update({
             company.eid: company for company in company_entities
         })
@@ -401,11 +409,11 @@ def company_regular(question, companys):
     regular_companys = [
         regular_company
         for company in companys
-        for regular_company in CompanyES().search_company(company, size=1)
+        for regular_company in (entity_index.resolve_company(company) or CompanyES().search_company(company, size=1))
     ]
 
     if not regular_companys:
-        regular_companys = CompanyES().search_company(question, size=1)
+        regular_companys = entity_index.resolve_company(question) or CompanyES().search_company(question, size=1)
 
     regular_companys = list({obj.uuid: obj for obj in regular_companys}.values())
 
@@ -5,29 +5,27 @@ LastEditors: longsion
 LastEditTime: 2024-10-23 17:01:05
 '''
 
-from collections import OrderedDict
 from pkg.es.es_file import ESFileObject, FileES
 from pkg.es.es_p_doc_fragment import PDocFragmentModel
 from pkg.es.es_p_doc_table import PDocTableModel
 from pkg.es.es_p_file import PESFileObject, PFileES
 from pkg.global_.common import fillin_doc_items_cache, fillin_fragment_children_cache, fillin_personal_doc_items_cache, fillin_personal_fragment_children_cache, get_fragment_all_texts, get_fragment_ori_ids, get_fragment_ori_text, get_table_ori_text
 from pkg.global_.objects import Context, RetrieveContext, RetrieveType, GlobalQAType
-from pkg.config import config
 from pkg.es.es_doc_fragment import DocFragmentModel
 from pkg.es.es_doc_table import DocTableModel
 from pkg.storage import Storage
-from pkg.utils.jaeger import TracedThreadPoolExecutor
 from .preprocess_question import file_filter
-from pkg.rerank import rerank_api_by_cache
-from pkg.utils import compress, decompress, log_msg, split_list, sigmoid, xjson
+from pkg.rerank import rerank_scores
+from pkg.utils import compress, decompress, log_msg, sigmoid
 from pkg.utils.decorators import register_span_func
+from pkg.utils.fragment_tree import fragment_tree_cache, fragment_tree_version
 from pkg.utils.logger import logger
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.stage_dag import stage_pool
 from pkg.redis.redis import redis_store
 
+from concurrent.futures import wait
 import re
 import numpy as np
-import concurrent.futures
 
 
 def lambda_func(context: Context):
@@ -79,23 +77,21 @@ def rerank_by_question(context: Context) -> Context:
         return context
 
     if context.params.qa_type == GlobalQAType.ANALYST.value:
-        retrieve_files_t = ThreadWithReturnValue(target=get_files_by_uuid, args=(uuids,))
+        retrieve_files_t = stage_pool.submit(get_files_by_uuid, uuids)
 
     elif context.params.qa_type == GlobalQAType.PERSONAL.value:
-        retrieve_files_t = ThreadWithReturnValue(target=get_personal_files_by_uuid, args=(context.params.user_id, uuids,))
+        retrieve_files_t = stage_pool.submit(get_personal_files_by_uuid, context.params.user_id, uuids)
 
     else:
-        retrieve_files_t = ThreadWithReturnValue(target=get_both_files_by_uuid, args=(context,))
+        retrieve_files_t = stage_pool.submit(get_both_files_by_uuid, context)
 
-    retrieve_files_t.start()
     rerank_scores = rerank_max_score(context.question_analysis.retrieve_question, rerank_texts)
-    context.files = retrieve_files_t.join()
+    context.files = retrieve_files_t.result()
     context = file_filter(context)
     # 对切片进行cache填充
-    process_cache_t = ThreadWithReturnValue(target=process_cache, args=(context,))
-    process_cache_t.start()
+    process_cache_t = stage_pool.submit(process_cache, context)
     uuid_rerank_scores = rerank_score_by_filename(context)
-    process_cache_t.join()
+    process_cache_t.result()
     # 重排去重后去计算 repeat score
     r_contexts = generate_retieval_contexts(context, rerank_scores, uuid_rerank_scores)
 
@@ -188,24 +184,7 @@ def rerank_max_score(txt1: str, txt2s) -> list[float]:
             # 表格线替换为空
             txt2 = txt2.replace('|', ' ')
             clean_txt2s.append(txt2)
-        concurrent_split_txts = split_list(txt2_combines_all, chunk_size=16)
-        pairs = [[[txt1], concurrent_split_txt] for concurrent_split_txt in concurrent_split_txts]
-        tasks_with_index = [
-            (i, txt2) for i, txt2 in enumerate(pairs)
-        ]
-        with TracedThreadPoolExecutor(max_workers=8) as executor:
-            futures = {executor.submit(rerank_api_by_cache, txt2, headers=None, url=config["textin"]["rerank_url"], if_softmax=0): idx for idx, txt2 in tasks_with_index}
-
-            # 使用OrderedDict来保证按原顺序收集结果
-            ordered_results = OrderedDict()
-            for future in concurrent.futures.as_completed(futures):
-                idx = futures[future]
-                result = future.result()
-                ordered_results[idx] = result
-
-            # 提取并排序结果
-            ress = [ordered_results[i] for i in range(len(ordered_results))]
-        text_span_scores = [sigmoid(score) for text_span_score in ress for score in text_span_score]
+        text_span_scores = [sigmoid(score) for score in rerank_scores(txt1, txt2_combines_all)]
         # text_span_scores = [round(score, 4) for score in softmax(text_span_scores)]
 
         # pairs = [[txt1], clean_txt2s]
@@ -232,24 +211,7 @@ def rerank_score_by_filename(context):
     query = context.params.question
     name_uuid_dic = {c.filename: c.uuid for c in context.files}
     file_names = list(name_uuid_dic.keys())
-    concurrent_split_txts = split_list(file_names, chunk_size=16)
-    pairs = [[[query], concurrent_split_txt] for concurrent_split_txt in concurrent_split_txts]
-    tasks_with_index = [
-        (i, txt2) for i, txt2 in enumerate(pairs)
-    ]
-    with TracedThreadPoolExecutor(max_workers=8) as executor:
-        futures = {executor.submit(rerank_api_by_cache, txt2, headers=None, url=config["textin"]["rerank_url"], if_softmax=0): idx for idx, txt2 in tasks_with_index}
-
-        # 使用OrderedDict来保证按原顺序收集结果
-        ordered_results = OrderedDict()
-        for future in concurrent.futures.as_completed(futures):
-            idx = futures[future]
-            result = future.result()
-            ordered_results[idx] = result
-
-        # 提取并排序结果
-        ress = [ordered_results[i] for i in range(len(ordered_results))]
-    text_span_scores = [sigmoid(score) for text_span_score in ress for score in text_span_score]
+    text_span_scores = [sigmoid(score) for score in rerank_scores(query, file_names)]
     # hard_code
     max_score = max(text_span_scores) if text_span_scores else 0
     if 0.1 <= max_score * 10 < 1:
@@ -324,27 +286,27 @@ def replace_duplicate_context(contexts: list[RetrieveContext]) -> list[RetrieveC
     return contexts
 
 
-def fill_fragments_cache(context: Context):
-    # 从doc_fragments_json中更新 context.fragment_cache
+def fill_fragments_cache(context: Context, file_uuids: set[str] = None):
+    '''
+    description: 从进程内切片树缓存更新 context.fragment_cache，file_uuids 不为空时只填充召回命中的文件
+    return {*}
+    '''
     for file in context.files:
-        if file.doc_fragments_json:
-            doc_fragments = xjson.loads(file.doc_fragments_json)
-            if isinstance(doc_fragments, list):
-                # without embeddings
-                if isinstance(file, ESFileObject):
-                    doc_fragments = [
-                        DocFragmentModel.if_model_construct(**fragment, file_uuid=file.uuid) for fragment in doc_fragments
-                    ]
-                else:
-                    doc_fragments = [
-                        PDocFragmentModel.if_model_construct(**fragment, file_uuid=file.uuid) for fragment in doc_fragments
-                    ]
-
-                context.fragment_cache.update({doc_fragment.uuid: doc_fragment for doc_fragment in doc_fragments})
+        if file_uuids is not None and file.uuid not in file_uuids:
+            continue
+        if isinstance(file, ESFileObject):
+            tree = fragment_tree_cache.load(file, fetch=lambda _file: attach_file_fragments_json([_file]))
+            model_cls = DocFragmentModel
+        else:
+            tree = fragment_tree_cache.load(file, scope=file.user_id, fetch=lambda _file: attach_p_file_fragments_json(_file.user_id, [_file]))
+            model_cls = PDocFragmentModel
+
+        if tree is not None:
+            context.fragment_cache.update(tree.models(model_cls, construct=True))
 
 
 def process_cache(context: Context):
-    fill_fragments_cache(context)
+    fill_fragments_cache(context, file_uuids={fragment.file_uuid for fragment in context.fragment_retrieve_small})
     analyst_tables = [table for table in context.normal_table_retrieve_small + context.fixed_table_retrieve_small if isinstance(table, DocTableModel)]
     personal_tables = [table for table in context.normal_table_retrieve_small + context.fixed_table_retrieve_small if isinstance(table, PDocTableModel)]
 
@@ -398,15 +360,19 @@ def get_both_files_by_uuid(context: Context):
                               + [c.file_uuid for c in context.fragment_retrieve_small if isinstance(c, PDocFragmentModel)]
                               + [f.uuid for f in context.locationfiles if context.locationfiles if isinstance(f, PESFileObject)]))
 
-    personal_t = ThreadWithReturnValue(target=get_personal_files_by_uuid, args=(context.params.user_id, personal_uuids))
-    personal_t.start()
+    personal_t = stage_pool.submit(get_personal_files_by_uuid, context.params.user_id, personal_uuids)
 
-    all_files = get_files_by_uuid(analyst_uuids) + personal_t.join()
+    all_files = get_files_by_uuid(analyst_uuids) + personal_t.result()
 
     return all_files
 
 
 def attach_file_fragments_json(files: list[ESFileObject]):
+    # 进程内已缓存当前版本切片树的文件无需再拉取
+    files = [file for file in files if not fragment_tree_cache.contains(file.uuid, fragment_tree_version(file))]
+    if not files:
+        return
+
     uuids = [file.uuid for file in files]
     cache_keys = [f"fragment-{u}" for u in uuids]
     cached_results = redis_store.mget(cache_keys)
@@ -431,13 +397,15 @@ def attach_file_fragments_json(files: list[ESFileObject]):
             _file.doc_fragments_json = decompress(fragment_gz)
             redis_store.set(f"fragment-{_file.uuid}", fragment_gz)
 
-    with TracedThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(_attach_file_fragments_json, _file) for _file in uncached_files]
-        for _ in futures:
-            pass
+    wait([stage_pool.submit(_attach_file_fragments_json, _file) for _file in uncached_files])
 
 
 def attach_p_file_fragments_json(user_id: str, files: list[PESFileObject]):
+    # 进程内已缓存当前版本切片树的文件无需再拉取
+    files = [file for file in files if not fragment_tree_cache.contains(file.uuid, fragment_tree_version(file), scope=user_id)]
+    if not files:
+        return
+
     uuids = [file.uuid for file in files]
     cache_keys = [f"fragment-{user_id}-{u}" for u in uuids]
     cached_results = redis_store.mget(cache_keys)
@@ -462,7 +430,4 @@ def attach_p_file_fragments_json(user_id: str, files: list[PESFileObject]):
             _file.doc_fragments_json = decompress(fragment_gz)
             redis_store.set(f"fragment-{user_id}-{_file.uuid}", fragment_gz, ex=86400 * 30)  # 缓存过期时间为 30天
 
-    with TracedThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(_attach_p_file_fragments_json, _file) for _file in uncached_files]
-        for _ in futures:
-            pass
+    wait([stage_pool.submit(_attach_p_file_fragments_json, _file) for _file in uncached_files])
@@ -17,7 +17,7 @@ from pkg.utils.decorators import register_span_func
 from pkg.structure_static import match_fixed_tables, three_table_key_list
 from pkg.config import config
 from pkg.global_.objects import Context, GlobalQAType
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.stage_dag import stage_pool
 
 
 def lambda_func(context: Context):
@@ -47,14 +47,12 @@ def retrieve_small_by_analyst(context: Context) -> Context:
 
     _normal_table_retrieve_t, _paragraph_retrieve_t = None, None
     if document_uuids:
-        _normal_table_retrieve_t = ThreadWithReturnValue(target=retrieve_by_table, args=(context, document_uuids))
-        _normal_table_retrieve_t.start()
+        _normal_table_retrieve_t = stage_pool.submit(retrieve_by_table, context, document_uuids)
 
-        _paragraph_retrieve_t = ThreadWithReturnValue(target=retrieve_by_paragraph, args=(context, document_uuids))
-        _paragraph_retrieve_t.start()
+        _paragraph_retrieve_t = stage_pool.submit(retrieve_by_paragraph, context, document_uuids)
 
-        context.normal_table_retrieve_small += _normal_table_retrieve_t.join()
-        context.fragment_retrieve_small += _paragraph_retrieve_t.join()
+        context.normal_table_retrieve_small += _normal_table_retrieve_t.result()
+        context.fragment_retrieve_small += _paragraph_retrieve_t.result()
 
     return context
 
@@ -67,14 +65,12 @@ def retrieve_small_by_personal(context: Context) -> Context:
 
     _normal_table_retrieve_t, _paragraph_retrieve_t = None, None
     if document_uuids:
-        _normal_table_retrieve_t = ThreadWithReturnValue(target=retrieve_by_personal_table, args=(context, document_uuids))
-        _normal_table_retrieve_t.start()
+        _normal_table_retrieve_t = stage_pool.submit(retrieve_by_personal_table, context, document_uuids)
 
-        _paragraph_retrieve_t = ThreadWithReturnValue(target=retrieve_by_personal_paragraph, args=(context, document_uuids))
-        _paragraph_retrieve_t.start()
+        _paragraph_retrieve_t = stage_pool.submit(retrieve_by_personal_paragraph, context, document_uuids)
 
-        context.normal_table_retrieve_small += _normal_table_retrieve_t.join()
-        context.fragment_retrieve_small += _paragraph_retrieve_t.join()
+        context.normal_table_retrieve_small += _normal_table_retrieve_t.result()
+        context.fragment_retrieve_small += _paragraph_retrieve_t.result()
 
     return context
 
@@ -87,10 +83,9 @@ def retrieve_small(context: Context) -> Context:
     elif context.params.qa_type == GlobalQAType.PERSONAL.value:
         context = retrieve_small_by_personal(context)
     else:
-        personal_t = ThreadWithReturnValue(target=retrieve_small_by_personal, args=(context,))
-        personal_t.start()
+        personal_t = stage_pool.submit(retrieve_small_by_personal, context)
         context = retrieve_small_by_analyst(context)
-        context = personal_t.join()
+        context = personal_t.result()
 
     return context
 
@@ -141,15 +136,14 @@ def retrieve_by_table(context: Context, document_uuids: list[str]) -> list[DocTa
     doc_table_items: list[DocTableModel] = []
     threads = []
     for keyword in context.question_analysis.keywords:
-        t = ThreadWithReturnValue(target=DocTableES().search_table, kwargs=dict(bm25_text=keyword,
-                                                                                ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
-                                                                                document_uuids=document_uuids,
-                                                                                size=size))
-        t.start()
+        t = stage_pool.submit(DocTableES().search_table, bm25_text=keyword,
+                              ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
+                              document_uuids=document_uuids,
+                              size=size)
         threads.append(t)
 
     for t in threads:
-        doc_table_items.extend(t.join())
+        doc_table_items.extend(t.result())
     return doc_table_items
 
 
@@ -182,17 +176,15 @@ def retrieve_by_personal_table(context: Context, document_uuids: list[str]) -> l
     doc_table_items: list[PDocTableModel] = []
     threads = []
     for keyword in context.question_analysis.keywords:
-        t = ThreadWithReturnValue(target=PDocTableES().search_table, kwargs=dict(bm25_text=keyword,
-                                                                                 ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
-                                                                                 document_uuids=document_uuids,
-                                                                                 user_id=context.params.user_id,
-                                                                                 size=size,
-                                                                                 ))
-        t.start()
+        t = stage_pool.submit(PDocTableES().search_table, bm25_text=keyword,
+                              ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
+                              document_uuids=document_uuids,
+                              user_id=context.params.user_id,
+                              size=size)
         threads.append(t)
 
     for t in threads:
-        doc_table_items.extend(t.join())
+        doc_table_items.extend(t.result())
     return doc_table_items
 
 
@@ -6,7 +6,7 @@ LastEditTime: 2024-10-08 19:17:02
 '''
 
 import re
-from difflib import get_close_matches
+from pkg.utils.fuzzy_match import get_close_matches
 from pkg.es.es_doc_table import DocTableES, DocTableModel
 from pkg.es.es_doc_fragment import DocFragmentES, DocFragmentModel
 from pkg.es.es_file import ESFileObject
@@ -15,7 +15,7 @@ from pkg.es.es_p_doc_table import PDocTableES, PDocTableModel
 from pkg.es.es_p_file import PESFileObject
 from pkg.utils.decorators import register_span_func
 from pkg.global_.objects import Context, GlobalQAType
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.stage_dag import stage_pool
 
 
 def lambda_func(context: Context):
@@ -33,14 +33,12 @@ def lambda_func(context: Context):
 def retrieve_small_full_by_analyst(context: Context) -> Context:
     document_uuids = []
     # 没有选中文件时，进行全局检索，只使用段落召回与表格召回
-    _normal_table_retrieve_l = ThreadWithReturnValue(target=retrieve_by_table, args=(context, document_uuids))
-    _normal_table_retrieve_l.start()
+    _normal_table_retrieve_l = stage_pool.submit(retrieve_by_table, context, document_uuids)
 
-    _paragraph_retrieve_l = ThreadWithReturnValue(target=retrieve_by_paragraph, args=(context, document_uuids))
-    _paragraph_retrieve_l.start()
+    _paragraph_retrieve_l = stage_pool.submit(retrieve_by_paragraph, context, document_uuids)
 
-    normal_table_retrieve_small = _normal_table_retrieve_l.join()
-    fragment_retrieve_small = _paragraph_retrieve_l.join()
+    normal_table_retrieve_small = _normal_table_retrieve_l.result()
+    fragment_retrieve_small = _paragraph_retrieve_l.result()
 
     # 过滤召回内容
     files = [file for file in context.locationfiles]
@@ -70,14 +68,12 @@ def retrieve_small_full_by_personal(context: Context) -> Context:
     # 如果文件存在
     document_uuids = []
     # 没有选中文件时，进行全局检索，只使用段落召回与表格召回
-    _normal_table_retrieve_l = ThreadWithReturnValue(target=retrieve_by_personal_table, args=(context, document_uuids))
-    _normal_table_retrieve_l.start()
+    _normal_table_retrieve_l = stage_pool.submit(retrieve_by_personal_table, context, document_uuids)
 
-    _paragraph_retrieve_l = ThreadWithReturnValue(target=retrieve_by_personal_paragraph, args=(context, document_uuids))
-    _paragraph_retrieve_l.start()
+    _paragraph_retrieve_l = stage_pool.submit(retrieve_by_personal_paragraph, context, document_uuids)
 
-    normal_table_retrieve_small = _normal_table_retrieve_l.join()
-    fragment_retrieve_small = _paragraph_retrieve_l.join()
+    normal_table_retrieve_small = _normal_table_retrieve_l.result()
+    fragment_retrieve_small = _paragraph_retrieve_l.result()
 
     # 过滤召回内容
     files = [file for file in context.locationfiles]
@@ -110,10 +106,9 @@ def retrieve_small_full(context: Context) -> Context:
     elif context.params.qa_type == GlobalQAType.PERSONAL.value:
         context = retrieve_small_full_by_personal(context)
     else:
-        personal_t = ThreadWithReturnValue(target=retrieve_small_full_by_personal, args=(context,))
-        personal_t.start()
+        personal_t = stage_pool.submit(retrieve_small_full_by_personal, context)
         context = retrieve_small_full_by_analyst(context)
-        context = personal_t.join()
+        context = personal_t.result()
 
     return context
 
@@ -130,15 +125,14 @@ def retrieve_by_table(context: Context, document_uuids: list[str]) -> list[DocTa
     doc_table_items: list[DocTableModel] = []
     threads = []
     for keyword in context.question_analysis.keywords:
-        t = ThreadWithReturnValue(target=DocTableES().search_table, kwargs=dict(bm25_text=keyword,
-                                                                                ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
-                                                                                document_uuids=document_uuids,
-                                                                                size=size))
-        t.start()
+        t = stage_pool.submit(DocTableES().search_table, bm25_text=keyword,
+                              ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
+                              document_uuids=document_uuids,
+                              size=size)
         threads.append(t)
 
     for t in threads:
-        doc_table_items.extend(t.join())
+        doc_table_items.extend(t.result())
     return doc_table_items
 
 
@@ -171,16 +165,15 @@ def retrieve_by_personal_table(context: Context, document_uuids: list[str]) -> l
     doc_table_items: list[PDocTableModel] = []
     threads = []
     for keyword in context.question_analysis.keywords:
-        t = ThreadWithReturnValue(target=PDocTableES().search_table, kwargs=dict(bm25_text=keyword,
-                                                                                 ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
-                                                                                 document_uuids=document_uuids,
-                                                                                 size=size,
-                                                                                 user_id=context.params.user_id))
-        t.start()
+        t = stage_pool.submit(PDocTableES().search_table, bm25_text=keyword,
+                              ebd_text=context.question_analysis.retrieve_question if document_uuids != [] else context.params.question,
+                              document_uuids=document_uuids,
+                              size=size,
+                              user_id=context.params.user_id)
         threads.append(t)
 
     for t in threads:
-        doc_table_items.extend(t.join())
+        doc_table_items.extend(t.result())
     return doc_table_items
 
 
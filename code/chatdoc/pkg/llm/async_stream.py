@@ -0,0 +1,64 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-04-03 10:20:16
+LastEditors: longsion
+LastEditTime: 2025-04-03 17:42:05
+
+大模型异步流式输出：ASGI 模式下流式答案在事件循环中等待大模型，等待期间不占用线程
+- 问答流水线仍是同步生成器，取下一个 chunk 时 yield 一个 AwaitNext，由 asgi 在事件循环中 await 后 send 回生成器
+- 只在 asgi 的问答线程中开启(thread context 的 extra.async_stream)，flask 模式及不支持异步的模型仍返回同步迭代器
+'''
+
+from typing import AsyncIterator
+
+from pkg.utils.thread_with_return_value import get_thread_context
+
+# 流结束标记
+STREAM_END = object()
+
+
+class AsyncLLMStream(object):
+    """
+    大模型的异步流式响应，chunk 格式与同步的 result_generator 一致
+    """
+
+    def __init__(self, agen: AsyncIterator[str]):
+        self.agen = agen
+
+    async def next(self):
+        try:
+            return await self.agen.__anext__()
+        except StopAsyncIteration:
+            return STREAM_END
+
+    async def aclose(self):
+        aclose = getattr(self.agen, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+class AwaitNext(object):
+    """
+    同步生成器 yield 出的等待标记：asgi await stream.next() 后把结果 send 回生成器
+    """
+
+    def __init__(self, stream: AsyncLLMStream):
+        self.stream = stream
+
+
+def async_stream_enabled() -> bool:
+    thread_context = get_thread_context()
+    return bool(thread_context and thread_context.extra.get("async_stream"))
+
+
+def as_chunk_stream(stream):
+    return stream if isinstance(stream, AsyncLLMStream) else iter(stream)
+
+
+def next_chunk(stream):
+    """
+    在同步生成器中取下一个 chunk：x = yield from next_chunk(stream)，流结束时返回 STREAM_END
+    """
+    if isinstance(stream, AsyncLLMStream):
+        return (yield AwaitNext(stream))
+    return next(stream, STREAM_END)
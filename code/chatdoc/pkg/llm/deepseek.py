@@ -1,11 +1,29 @@
+import asyncio
 import time
 import requests
 from pkg.config import config
+from pkg.llm.async_stream import AsyncLLMStream, async_stream_enabled
 from pkg.llm.template_manager import TemplateManager
-from pkg.llm.util import result_generator
+from pkg.llm.util import aresult_generator, result_generator
 from pkg.utils import retry_exponential_backoff
 from pkg.utils.logger import logger
 
+# 异步流式请求共用的 httpx 客户端，需在事件循环中创建
+_async_client = None
+
+
+def get_async_client():
+    global _async_client
+    if _async_client is None:
+        import httpx
+
+        max_connections = int((config.get("asgi") or {}).get("llm_max_connections", 4096))
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(None, connect=10.0),
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+    return _async_client
+
 
 class DeepseekAPIInterface(object):
     """
@@ -39,6 +57,10 @@ class DeepseekAPIInterface(object):
         }
 
         start_time = time.time()
+        if stream and async_stream_enabled():
+            # asgi 模式：在事件循环中异步拉取，等待大模型期间不占用线程
+            return AsyncLLMStream(self.async_stream_request(ip_data, headers, start_time))
+
         op_data = requests.post(self.url, json=ip_data, headers=headers, stream=stream)
         if op_data.status_code != 200:
             raise Exception(f"Deepseek API call error, status_code:{op_data.status_code}, msg: {op_data.json()}")
@@ -56,6 +78,39 @@ class DeepseekAPIInterface(object):
                 return chunk_json
             return result_generator(start_time, op_data, get_chunk_data=get_chunk_data)
 
+    async def async_stream_request(self, ip_data, headers, start_time, max_retries=3, base_delay=1):
+        """
+        异步流式请求，chunk 格式同 result_generator；连接失败时按指数退避重试(同 retry_exponential_backoff)
+        """
+        import httpx
+
+        for retries in range(max_retries):
+            try:
+                async with get_async_client().stream("POST", self.url, json=ip_data, headers=headers) as op_data:
+                    if op_data.status_code != 200:
+                        await op_data.aread()
+                        raise Exception(f"Deepseek API call error, status_code:{op_data.status_code}, msg: {op_data.text}")
+
+                    print_request_id = False
+
+                    def get_chunk_data(chunk_json):
+                        nonlocal print_request_id
+                        if not print_request_id:
+                            logger.info(f'deepseek request_id: {chunk_json["id"]}')
+                            print_request_id = True
+                        return chunk_json
+
+                    async for chunk in aresult_generator(start_time, op_data.aiter_bytes(), get_chunk_data=get_chunk_data):
+                        yield chunk
+                    return
+            except httpx.ConnectError as e:
+                wait_time = base_delay * (2 ** retries)
+                logger.warning(f"async_stream_request请求失败，{wait_time}秒后重试...{e}")
+                await asyncio.sleep(wait_time)
+
+        logger.error('async_stream_request达到最大重试次数，请求失败')
+        raise Exception("async_stream_request达到最大重试次数，请求失败")
+
 
 if __name__ == '__main__':
     deepseekChat = DeepseekAPIInterface()
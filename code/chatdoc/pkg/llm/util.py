@@ -28,20 +28,26 @@ def set_stream_json(json_data):
     return set_stream_data(json.dumps(json_data, ensure_ascii=False))
 
 
-def result_generator(start_time, result, format_func=None, get_chunk_data=None):
-    chunk_bytes = b''
-    chunk_str = ''
-    pre_message = ''
-    stream_contents = []
-    first_input_time: int = None
-
-    def handle_chunk(chunk_one_str):
-        nonlocal pre_message
-        nonlocal stream_contents
+class StreamParser(object):
+    """
+    大模型流式响应解析：按 data: 切分出每个 chunk，转换为 {"content", "status"} 的 SSE 数据，同步/异步流共用
+    """
+
+    def __init__(self, start_time, format_func=None, get_chunk_data=None):
+        self.start_time = start_time
+        self.format_func = format_func
+        self.get_chunk_data = get_chunk_data
+        self.chunk_bytes = b''
+        self.chunk_str = ''
+        self.pre_message = ''
+        self.stream_contents = []
+        self.first_input_time: int = None
+
+    def handle_chunk(self, chunk_one_str):
         try:
             chunk_json = json.loads(chunk_one_str)  # parse the chunk
-            if get_chunk_data:
-                chunk_json = get_chunk_data(chunk_json)
+            if self.get_chunk_data:
+                chunk_json = self.get_chunk_data(chunk_json)
         except Exception:
             return None
         data = None
@@ -55,60 +61,90 @@ def result_generator(start_time, result, format_func=None, get_chunk_data=None):
                 delta_message = chunk_json["choices"][0]["delta"].get("content", "")
             else:
                 total_message = chunk_json["choices"][0].get("message", {}).get("content", "")
-                delta_message = re.sub(fr"^{pre_message}", "", total_message)
-                pre_message = total_message
+                delta_message = re.sub(fr"^{self.pre_message}", "", total_message)
+                self.pre_message = total_message
 
             data = {"content": delta_message, "status": "DOING"}
 
-        chunk_time = time.time() - start_time
-        stream_contents.append((delta_message, f"{1000*chunk_time:.1f}ms"))
+        chunk_time = time.time() - self.start_time
+        self.stream_contents.append((delta_message, f"{1000*chunk_time:.1f}ms"))
         # logger.info(f"Stream message received {chunk_time:.3f} seconds after request: {json.dumps(data, ensure_ascii=False)}")
         return data
 
-    fixed_prefix = stream_fixed_prefix.strip()
+    def feed(self, chunk) -> list[str]:
+        """
+        输入网络上收到的一段数据，返回其中完整的 SSE 数据
+        """
+        fixed_prefix = stream_fixed_prefix.strip()
+        results = []
 
-    for chunk in result:
         if type(chunk) is str:
             chunk = chunk.encode("utf-8")
-        chunk_bytes += chunk
+        self.chunk_bytes += chunk
         try:
             # errors='ignore' 忽略解码错误，解决乱码问题
-            chunk_str = chunk_bytes.decode('utf-8', errors='ignore')
-            if format_func:
-                chunk_str = format_func(chunk_str)
+            self.chunk_str = self.chunk_bytes.decode('utf-8', errors='ignore')
+            if self.format_func:
+                self.chunk_str = self.format_func(self.chunk_str)
         except Exception as e:
             logger.error(f"Decode chunk error: {e}")
             # chunk_bytes 为json一部分，可能会出现解码错误，发生错误后继续拼接，可以忽略
-            continue
-        while fixed_prefix in chunk_str:
-            temp_list = chunk_str.split(fixed_prefix)
+            return results
+        while fixed_prefix in self.chunk_str:
+            temp_list = self.chunk_str.split(fixed_prefix)
             if temp_list[0]:
-                data = handle_chunk(temp_list[0])
-                if not first_input_time:
-                    first_input_time = time.time()
+                data = self.handle_chunk(temp_list[0])
+                if not self.first_input_time:
+                    self.first_input_time = time.time()
                 if data:
                     data["status"] = "DOING"
-                    yield set_stream_json(data)
-            chunk_str = ''.join(temp_list[1:])
-            chunk_bytes = chunk_str.encode("utf-8")
-
-    if chunk_str:
-        data = handle_chunk(chunk_str)
-        if data:
-            data["status"] = "DOING"
-            yield set_stream_json(data)
-
-    chunk_time = time.time() - start_time
-    logger.info(f"Stream messages received: {stream_contents}")
-    logger.info(f"Finally Stream message received {chunk_time*1000:.1f}ms after request, answer_len: {sum([len(x[0]) for x in stream_contents])}")
-    if not first_input_time:
-        first_input_time = time.time()
-    logger.info(f"Stream message Total time: {1000*(time.time() - first_input_time):.1f}ms")
-
-    # 手动触发停止
-    data = {"content": "", "status": "DONE"}
-    yield set_stream_json(data)
-    yield stream_fixes_suffix
+                    results.append(set_stream_json(data))
+            self.chunk_str = ''.join(temp_list[1:])
+            self.chunk_bytes = self.chunk_str.encode("utf-8")
+        return results
+
+    def finish(self) -> list[str]:
+        """
+        流结束：处理剩余数据，追加 DONE 与结束标记
+        """
+        results = []
+        if self.chunk_str:
+            data = self.handle_chunk(self.chunk_str)
+            if data:
+                data["status"] = "DOING"
+                results.append(set_stream_json(data))
+
+        chunk_time = time.time() - self.start_time
+        logger.info(f"Stream messages received: {self.stream_contents}")
+        logger.info(f"Finally Stream message received {chunk_time*1000:.1f}ms after request, answer_len: {sum([len(x[0]) for x in self.stream_contents])}")
+        if not self.first_input_time:
+            self.first_input_time = time.time()
+        logger.info(f"Stream message Total time: {1000*(time.time() - self.first_input_time):.1f}ms")
+
+        # 手动触发停止
+        data = {"content": "", "status": "DONE"}
+        results.append(set_stream_json(data))
+        results.append(stream_fixes_suffix)
+        return results
+
+
+def result_generator(start_time, result, format_func=None, get_chunk_data=None):
+    parser = StreamParser(start_time, format_func=format_func, get_chunk_data=get_chunk_data)
+    for chunk in result:
+        yield from parser.feed(chunk)
+    yield from parser.finish()
+
+
+async def aresult_generator(start_time, result, format_func=None, get_chunk_data=None):
+    """
+    同 result_generator，result 为异步迭代的响应数据(如 httpx 的 aiter_bytes)
+    """
+    parser = StreamParser(start_time, format_func=format_func, get_chunk_data=get_chunk_data)
+    async for chunk in result:
+        for data in parser.feed(chunk):
+            yield data
+    for data in parser.finish():
+        yield data
 
 
 def check_repetition(text, delta_text):
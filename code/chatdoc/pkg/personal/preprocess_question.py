@@ -8,16 +8,19 @@ import os.path
 from pkg.personal.objects import Context, QuestionAnalysisResult
 from pkg.es.es_p_file import PESFileObject, PFileES
 from pkg.es.es_company import CompanyES
+from pkg.es import entity_index
 from pkg.query_analysis import query_extract_uie
 from pkg.storage import Storage
 from pkg.utils import compress, decompress, ensure_list, has_intersection_list
 from pkg.utils.decorators import register_span_func
-from pkg.utils.jaeger import TracedThreadPoolExecutor
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.fragment_tree import fragment_tree_cache, fragment_tree_version
+from pkg.utils.stage_dag import stage_pool
 from pkg.config import config
-from difflib import get_close_matches, SequenceMatcher
+from difflib import SequenceMatcher
+from pkg.utils.fuzzy_match import get_close_matches
 from pkg.redis.redis import redis_store
 
+from concurrent.futures import wait
 from datetime import datetime
 import re
 
@@ -65,11 +68,10 @@ def preprocess_question(context: Context) -> Context:
     # question 校验
     question = replace_query(ori_question)
     if question:
-        _extract_info_t = ThreadWithReturnValue(target=get_extract_info, args=(question,))
-        _extract_info_t.start()
+        _extract_info_t = stage_pool.submit(get_extract_info, question)
 
         all_files = get_personal_files_by_uuid(context.params.user_id, context.params.document_uuids)
-        extract_info = _extract_info_t.join()
+        extract_info = _extract_info_t.result()
     else:
         all_files = []
         extract_info = {}
@@ -89,7 +91,7 @@ def preprocess_question(context: Context) -> Context:
     context.question_analysis = analysis_result
 
     # extract commpany mapper
-    company_entities = CompanyES().search_company_by_eids_or_uids(list(set([_file.company for _file in all_files if _file.company])))
+    company_entities = entity_index.search_company_by_eids_or_uids(list(set([_file.company for _file in all_files if _file.company])))
     context.company_mapper.update({
         company.eid: company for company in company_entities
     })
@@ -256,7 +258,7 @@ def file_match(question, file_metas: list[PESFileObject], question_years, regula
     if company_eids:
         extract_company_names.extend(
             [
-                company.name for company in CompanyES().search_company_by_eids_or_uids(company_eids)
+                company.name for company in entity_index.search_company_by_eids_or_uids(company_eids)
             ]
         )
 
@@ -276,10 +278,9 @@ def file_match(question, file_metas: list[PESFileObject], question_years, regula
         # 构建线程列表
         threads = []
         for _extract_info in _extract_infos:
-            t = ThreadWithReturnValue(target=search_engine, args=(_extract_info, matches, 0.4, ))
-            t.start()
+            t = stage_pool.submit(search_engine, _extract_info, matches, 0.4)
             threads.append(t)
-        results = [t.join() for t in threads]
+        results = [t.result() for t in threads]
         for result in results:
             file_matches.extend(result)
 
@@ -395,11 +396,11 @@ def company_regular(question, companys):
     regular_companys = [
         regular_company
         for company in companys
-        for regular_company in CompanyES().search_company(company, size=1)
+        for regular_company in (entity_index.resolve_company(company) or CompanyES().search_company(company, size=1))
     ]
 
     if not regular_companys:
-        regular_companys = CompanyES().search_company(question, size=1)
+        regular_companys = entity_index.resolve_company(question) or CompanyES().search_company(question, size=1)
 
     regular_companys = list({obj.uuid: obj for obj in regular_companys}.values())
 
@@ -420,6 +421,11 @@ def get_personal_files_by_uuid(user_id, uuids, with_doc_fragments_json=True):
 
 
 def attach_p_file_fragments_json(user_id: str, files: list[PESFileObject]):
+    # 进程内已缓存当前版本切片树的文件无需再拉取
+    files = [file for file in files if not fragment_tree_cache.contains(file.uuid, fragment_tree_version(file), scope=user_id)]
+    if not files:
+        return
+
     uuids = [file.uuid for file in files]
     cache_keys = [f"fragment-{user_id}-{u}" for u in uuids]
     cached_results = redis_store.mget(cache_keys)
@@ -444,7 +450,4 @@ def attach_p_file_fragments_json(user_id: str, files: list[PESFileObject]):
             _file.doc_fragments_json = decompress(fragment_gz)
             redis_store.set(f"fragment-{user_id}-{_file.uuid}", fragment_gz, ex=86400 * 30)  # 缓存过期时间为 30天
 
-    with TracedThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(_attach_p_file_fragments_json, _file) for _file in uncached_files]
-        for _ in futures:
-            pass
+    wait([stage_pool.submit(_attach_p_file_fragments_json, _file) for _file in uncached_files])
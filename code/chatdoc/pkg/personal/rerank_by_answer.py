@@ -4,16 +4,14 @@ Date: 2024-05-06 15:15:43
 LastEditors: longsion
 LastEditTime: 2024-09-13 14:53:50
 '''
-from collections import OrderedDict
 from pkg.personal.objects import Context, RetrieveContext
-from pkg.rerank import rerank_api_by_cache
+from pkg.rerank import rerank_api_by_cache, rerank_scores
 from pkg.config import config
-from pkg.utils import split_list, softmax
+from pkg.utils import softmax
 from pkg.utils.decorators import register_span_func
 
 import numpy as np
 import re
-import concurrent.futures
 
 
 def func_span(context: Context):
@@ -104,23 +102,7 @@ class Reranking:
         # 每个划窗的span的分数
         if len(txt2_combines_all) > 0:
 
-            concurrent_split_txts = split_list(txt2_combines_all, chunk_size=16)
-            tasks_with_index = [
-                (i, txt2) for i, txt2 in enumerate(concurrent_split_txts)
-            ]
-            with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-                futures = {executor.submit(self.rerank_score, txt1, txt2): idx for idx, txt2 in tasks_with_index}
-
-                # 使用OrderedDict来保证按原顺序收集结果
-                ordered_results = OrderedDict()
-                for future in concurrent.futures.as_completed(futures):
-                    idx = futures[future]
-                    result = future.result()
-                    ordered_results[idx] = result
-
-                # 提取并排序结果
-                ress = [ordered_results[i] for i in range(len(ordered_results))]
-            text_span_scores = [score for text_span_score in ress for score in text_span_score]
+            text_span_scores = rerank_scores(txt1, [txt2.replace('|', ' ') for txt2 in txt2_combines_all])
             text_span_scores = [round(score, 4) for score in softmax(text_span_scores)]
 
             # text_span_scores = self.rerank_score(txt1, txt2_combines_all)
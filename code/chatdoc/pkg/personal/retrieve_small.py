@@ -4,17 +4,18 @@ Date: 2024-05-23 23:22:47
 LastEditors: longsion
 LastEditTime: 2024-10-16 14:13:33
 '''
-import json
 from pkg.es.es_p_doc_table import PDocTableES, PDocTableModel
 from pkg.es.es_p_doc_fragment import PDocFragmentES, PDocFragmentModel
 from pkg.embedding.acge_embedding import get_similar_top_n
 from pkg.utils import edit_distance
 from pkg.utils.decorators import register_span_func
+from pkg.utils.fragment_tree import fragment_tree_cache
 from pkg.structure_static import match_fixed_tables, three_table_key_list
 from pkg.config import config
 from pkg.personal.objects import Context
+from pkg.personal.preprocess_question import attach_p_file_fragments_json
 from pkg.personal.common import fillin_fragment_children_cache, fillin_doc_items_cache
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.stage_dag import stage_pool
 from pkg.utils.logger import logger
 
 
@@ -36,13 +37,9 @@ def retrieve_small(context: Context) -> Context:
     document_uuids = list(set([file.uuid for file in context.files]))
 
     # 三大表召回
-    _fixed_table_retrieve_t = ThreadWithReturnValue(target=retrieve_by_fixed_table, args=(context, document_uuids,))
-    _fixed_table_retrieve_t.start()
+    _fixed_table_retrieve_t = stage_pool.submit(retrieve_by_fixed_table, context, document_uuids)
 
-    # 更新 fragment cache 以及 doc item cache
-    fill_fragments_cache(context)
-
-    context.fixed_table_retrieve_small = _fixed_table_retrieve_t.join()
+    context.fixed_table_retrieve_small = _fixed_table_retrieve_t.result()
 
     fixed_table_file_uuids = [cur.uuid for cur in context.fixed_table_retrieve_small]
 
@@ -51,14 +48,15 @@ def retrieve_small(context: Context) -> Context:
 
     _normal_table_retrieve_t, _paragraph_retrieve_t = None, None
     if document_uuids:
-        _normal_table_retrieve_t = ThreadWithReturnValue(target=retrieve_by_table, args=(context, document_uuids))
-        _normal_table_retrieve_t.start()
+        _normal_table_retrieve_t = stage_pool.submit(retrieve_by_table, context, document_uuids)
+
+        _paragraph_retrieve_t = stage_pool.submit(retrieve_by_paragraph, context, document_uuids)
 
-        _paragraph_retrieve_t = ThreadWithReturnValue(target=retrieve_by_paragraph, args=(context, document_uuids))
-        _paragraph_retrieve_t.start()
+        context.normal_table_retrieve_small = _normal_table_retrieve_t.result()
+        context.fragment_retrieve_small = _paragraph_retrieve_t.result()
 
-        context.normal_table_retrieve_small = _normal_table_retrieve_t.join()
-        context.fragment_retrieve_small = _paragraph_retrieve_t.join()
+    # 只对召回命中的文件从切片树缓存中填充 fragment cache
+    fill_fragments_cache(context, file_uuids={fragment.file_uuid for fragment in context.fragment_retrieve_small})
 
     # 填充子切片cache及ori_item的cache，方便后续步骤使用
     table_ori_ids = [
@@ -70,17 +68,17 @@ def retrieve_small(context: Context) -> Context:
     return context
 
 
-def fill_fragments_cache(context: Context):
-    # 从doc_fragments_json中更新 context.fragment_cache
+def fill_fragments_cache(context: Context, file_uuids: set[str] = None):
+    '''
+    description: 从进程内切片树缓存更新 context.fragment_cache，file_uuids 不为空时只填充召回命中的文件
+    return {*}
+    '''
     for file in context.files:
-        if file.doc_fragments_json:
-            doc_fragments = json.loads(file.doc_fragments_json)
-            if isinstance(doc_fragments, list):
-                # without embeddings
-                doc_fragments = [
-                    PDocFragmentModel(**fragment, file_uuid=file.uuid) for fragment in doc_fragments
-                ]
-                context.fragment_cache.update({doc_fragment.uuid: doc_fragment for doc_fragment in doc_fragments})
+        if file_uuids is not None and file.uuid not in file_uuids:
+            continue
+        tree = fragment_tree_cache.load(file, scope=file.user_id, fetch=lambda _file: attach_p_file_fragments_json(_file.user_id, [_file]))
+        if tree is not None:
+            context.fragment_cache.update(tree.models(PDocFragmentModel))
 
 
 def retrieve_by_fixed_table(context: Context, document_uuids: list[str]) -> list[PDocTableModel]:
@@ -123,12 +121,11 @@ def retrieve_by_table(context: Context, document_uuids: list[str]) -> list[PDocT
 
     threads = []
     for keyword in context.question_analysis.keywords:
-        t = ThreadWithReturnValue(target=PDocTableES().search_table, kwargs=dict(bm25_text=keyword, ebd_text=context.question_analysis.retrieve_question, user_id=context.params.user_id, document_uuids=document_uuids, size=min(5 * len(context.files), 200)))
-        t.start()
+        t = stage_pool.submit(PDocTableES().search_table, bm25_text=keyword, ebd_text=context.question_analysis.retrieve_question, user_id=context.params.user_id, document_uuids=document_uuids, size=min(5 * len(context.files), 200))
         threads.append(t)
 
     for t in threads:
-        doc_table_items.extend(t.join())
+        doc_table_items.extend(t.result())
     # 表格召回过滤
     if len(context.locationfiles) < 4:
         doc_table_items = [doc_table_item
@@ -6,11 +6,18 @@ LastEditTime: 2024-07-16 23:18:55
 '''
 
 from pkg.utils.decorators import register_span_func
-from pkg.utils.transform import is_financial_string, markdown2list, uneven_list_to_markdown_table
-from .objects import Context, DocTreeNode, Fragment
+from pkg.utils import duplicates_list
+from pkg.utils.incremental_index import assign_content_ids, incremental_index_enabled
+from pkg.utils.transform import html2markdown, is_financial_string, markdown2list, uneven_list_to_markdown_table
+from pkg.utils.table_engine import MarkdownTableLength
+from .objects import Context, DocOriItem, DocTreeNode, Fragment
 import uuid
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
+# 入库时预计算子树字段的节点上限(tree_token_length)，控制切片树 json 的大小；
+# small2big 的 2000 只判断召回叶子自身的 tree_token_length，不限制父节点，父节点超过此上限时问答侧走递归拼接
+MATERIALIZE_MAX_TREE_TOKENS = 2000
+
 
 @register_span_func(func_name="段落切片", span_export_func=lambda context: dict(
     params=context.params.model_dump(),
@@ -24,6 +31,10 @@ def cut_paragraph_fragment(context: Context) -> Context:
     row_texts: 段落切片逻辑
     """
     context.doc_fragments = create_fragments(context.doc_tree.tree[0])
+    if incremental_index_enabled():
+        # 增量入库：切片 id 由内容生成，重新解析时未变化的切片 id 不变
+        assign_content_ids(f"{context.params.user_id}/{context.params.uuid}", context.doc_fragments)
+    materialize_fragment_trees(context.doc_fragments, context.doc_ori_items)
 
     return context
 
@@ -119,6 +130,55 @@ def create_fragments(node: DocTreeNode, parent_uuid: str = "", level: int = 1, t
     return fragments
 
 
+def materialize_fragment_trees(fragments: list[Fragment], doc_ori_items: list[DocOriItem]):
+    """
+    入库时预先计算切片子树的 ori_ids / 原文 / 原文列表，问答时直接读取，避免每次递归拼接及 html2markdown
+    计算逻辑与问答侧 common.get_fragment_ori_ids / get_fragment_ori_text / get_fragment_all_texts 保持一致
+    叶子文本切片直接按 ori_id 取原文即可，不做预计算；ROOT、子树超过 MATERIALIZE_MAX_TREE_TOKENS 以及缺少原文的节点及其祖先不做预计算，问答时走原有的递归逻辑
+
+    :param fragments: create_fragments 的结果(后序，子节点总在父节点之前)
+    :param doc_ori_items: ori_id 对应的原文
+    """
+    ori_contents = {ori_id: item.content for item in doc_ori_items for ori_id in item.ori_id if isinstance(item.content, str)}
+    fragment_map = {fragment.uuid: fragment for fragment in fragments}
+
+    def leaf_text(fragment: Fragment):
+        content = ori_contents[fragment.ori_id[0]]
+        return html2markdown(content) if content.startswith("<table border=") else content
+
+    for fragment in fragments:
+        if not fragment.ori_id or fragment.ori_id[0] not in ori_contents:
+            continue
+
+        if fragment.leaf:
+            if ori_contents[fragment.ori_id[0]].startswith("<table border="):
+                fragment.tree_text = leaf_text(fragment)
+                fragment.tree_all_texts = [fragment.tree_text]
+            continue
+
+        # 只预计算子树较小的节点，ROOT 及大章节的全文会使切片树 json 随层数成倍膨胀，问答时按需递归拼接
+        if fragment.type == "root" or fragment.tree_token_length >= MATERIALIZE_MAX_TREE_TOKENS:
+            continue
+
+        children = [fragment_map[child_uuid] for child_uuid in fragment.children_fragment_uuids]
+        if any(not child.ori_id or child.ori_id[0] not in ori_contents or (not child.leaf and not child.tree_ori_ids) for child in children):
+            continue
+
+        children_ori_ids = duplicates_list([child.ori_id if child.leaf else child.tree_ori_ids for child in children], lambda x: "|".join(x))
+        ori_ids = list(set(fragment.ori_id + [ori_id for child_ori_ids in children_ori_ids for ori_id in child_ori_ids]))
+        ori_ids.sort(key=lambda x: tuple([int(_x) for _x in x.split(",")]))
+
+        child_texts = duplicates_list([child.tree_text or leaf_text(child) for child in children])
+        children_all_texts = duplicates_list([
+            text for child in children for text in (child.tree_all_texts or [leaf_text(child)])
+        ])
+
+        content = ori_contents[fragment.ori_id[0]]
+        fragment.tree_ori_ids = ori_ids
+        fragment.tree_text = "#" * (fragment.level + 1) + " " + content + "\n" + "\n".join(child_texts)
+        fragment.tree_all_texts = [content] + children_all_texts
+
+
 def split_with_offsets(text, chunk_size, chunk_overlap):
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
     chunks = text_splitter.split_text(text)
@@ -153,10 +213,12 @@ def split_table_by_token_limit(table_markdown: str, token_limit: int = 1000):
 
         if not sub_table:
             sub_table = [title_row, row]
+            sub_table_length = MarkdownTableLength(fill_value="-").add(title_row).add(row)
             start_row_idx = row_id
             continue
 
-        if len(uneven_list_to_markdown_table(sub_table + [row], fill_value="-")) > token_limit:
+        # 增量计算加入该行后的 markdown 长度，不再每行重新生成整张子表
+        if sub_table_length.length(row) > token_limit:
             markdown_str = uneven_list_to_markdown_table(sub_table, fill_value="-")
             sub_tables.append(
                 (title_row_idx, start_row_idx, row_id - 1, markdown_str)
@@ -165,6 +227,7 @@ def split_table_by_token_limit(table_markdown: str, token_limit: int = 1000):
 
         else:
             sub_table.append(row)
+            sub_table_length.add(row)
 
     if sub_table:
         sub_tables.append(
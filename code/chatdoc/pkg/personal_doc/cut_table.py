@@ -9,8 +9,10 @@ LastEditTime: 2024-10-25 17:00:54
 import time
 from .objects import Context, DocOriItem, DocOriItemType, DocTableRowItem, DocTableType
 from pkg.utils.decorators import register_span_func
-from pkg.utils.transform import markdown2list, list2markdown, is_financial_string, financial_string_to_number
+from pkg.utils.transform import markdown2list, list2markdown
+from pkg.utils.table_engine import parse_financial_number
 from pkg.structure_static import three_table_set
+from pkg.utils.incremental_index import content_doc_ids, incremental_index_enabled
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
 import re
 from pkg.utils.logger import logger
@@ -55,14 +57,7 @@ def embedding_and_upload(doc_table_row_items: list[DocTableRowItem], file_uuid:
 
     start_time = time.time()
 
-    # 删除老切片
-    PDocTableES().delete_by_user_and_file_uuids(user_id, [file_uuid], wait_delete=True)
-
-    if not doc_table_row_items:
-        logger.warning(f"PFile cut has 0 table, file_uuid: {file_uuid}, user_id: {user_id}")
-        return True
-
-    success = PDocTableES().insert_doc_tables([
+    doc_tables = [
         PDocTableModel(
             user_id=user_id,
             uuid=file_uuid,
@@ -74,7 +69,29 @@ def embedding_and_upload(doc_table_row_items: list[DocTableRowItem], file_uuid:
             ebed_text=item.row_ebed_str,
         )
         for item in doc_table_row_items
-    ])
+    ]
+
+    if incremental_index_enabled():
+        # 增量入库：ES _id 由行内容生成，只删除已不存在的行、插入新增的行
+        doc_ids = content_doc_ids(f"{user_id}/{file_uuid}", [doc_table.model_dump() for doc_table in doc_tables])
+        existing_ids = set(PDocTableES().get_ids_by_user_and_file_uuid(user_id, file_uuid))
+        added = [(doc_id, doc_table) for doc_id, doc_table in zip(doc_ids, doc_tables) if doc_id not in existing_ids]
+        removed_ids = list(existing_ids - set(doc_ids))
+
+        success = PDocTableES().delete_by_ids(removed_ids) and PDocTableES().insert_doc_tables(
+            [doc_table for _, doc_table in added], doc_ids=[doc_id for doc_id, _ in added])
+        logger.info(f"PTable Incremental Update Es, file_uuid: {file_uuid}, user_id: {user_id}, success: {success}, added: {len(added)}, removed: {len(removed_ids)}, "
+                    f"unchanged: {len(doc_tables) - len(added)}, Elapsed: {1000*(time.time() - start_time):.1f}ms")
+        return success
+
+    # 删除老切片
+    PDocTableES().delete_by_user_and_file_uuids(user_id, [file_uuid], wait_delete=True)
+
+    if not doc_table_row_items:
+        logger.warning(f"PFile cut has 0 table, file_uuid: {file_uuid}, user_id: {user_id}")
+        return True
+
+    success = PDocTableES().insert_doc_tables(doc_tables)
 
     if not success:
         logger.error(f"PTable Update Es Not Success, file_uuid: {file_uuid}, user_id: {user_id}")
@@ -117,6 +134,8 @@ def extract_row_data_from_three_table(table: DocOriItem) -> list[DocTableRowItem
                 continue
 
         row_texts = []
+        # 每个单元格只解析一次数值，非数值为 None
+        row_numbers = [parse_financial_number(cell_data) for cell_data in row_data]
 
         # 默认：title列为第1列
         row_title = row_data[0]
@@ -126,8 +145,8 @@ def extract_row_data_from_three_table(table: DocOriItem) -> list[DocTableRowItem
             if not col_title:
                 continue
 
-            if is_financial_string(cell_data):
-                cell_number = financial_string_to_number(cell_data)
+            cell_number = row_numbers[col_idx]
+            if cell_number is not None:
                 row_texts.append(f"{col_title}的{row_title}是{cell_number}元")
 
             else:
@@ -146,7 +165,7 @@ def extract_row_data_from_three_table(table: DocOriItem) -> list[DocTableRowItem
                 type=DocTableType.THREE_TABLE,
                 row_id=row_idx,
                 keywords=list(filter(lambda x: x,
-                                     [_clean_text(keyword) for keyword in list(filter(lambda x: not is_financial_string(x), row_data))]
+                                     [_clean_text(keyword) for keyword, number in zip(row_data, row_numbers) if number is None]
                                      )),
                 row_ebed_str=f"## {table_title} \n" + "\n".join([_clean_text(row_text) for row_text in row_texts])
             )
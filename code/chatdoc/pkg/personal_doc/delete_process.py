@@ -13,6 +13,7 @@ from pkg.es.es_p_doc_fragment import PDocFragmentES
 from pkg.es.es_p_doc_table import PDocTableES
 from pkg.es.es_p_doc_item import PDocItemES
 from pkg.es.es_p_file import PFileES
+from pkg.utils.fragment_tree import fragment_tree_cache
 
 
 def process(params: DeleteParams) -> bool:
@@ -30,6 +31,7 @@ def process(params: DeleteParams) -> bool:
 
     # 删除向量库的向量
     result = delete_personal_vdb(params.user_id, params.uuids)
+    fragment_tree_cache.invalidate(params.uuids)
 
     for t in es_threads:
         result = result and (t.join() is None)
@@ -17,6 +17,7 @@ from pkg.es.es_p_file import PESFileObject, PFileES
 from pkg.openkie import ie_vllm
 from pkg.config import config
 from pkg.redis.redis import redis_store
+from pkg.utils.fragment_tree import fragment_tree_cache
 
 FinancialFileTypes = [
     FileTypeEnum.ZhaoGuShuoMingShu,
@@ -101,6 +102,8 @@ def upload_doc_fragments_json(doc_fragments_json: str, user_id: str, uuid: str):
     # 个人库的过期时间设为30天
     redis_store.set(f"fragment-{user_id}-{uuid}", stream, ex=86400 * 30)
     Storage.upload(f"User_{user_id}/fragments-{uuid}.gz", stream)
+    # 重新解析后旧的切片树失效，其他进程依赖 upload_time 版本号判断
+    fragment_tree_cache.invalidate([uuid])
 
 
 def extract_file_type(context: Context) -> FileTypeEnum:
@@ -72,6 +72,9 @@ class Params(BaseModel):
     # force_doc_parse:
     force_doc_parse: bool = False
 
+    # 任务优先级，越大越先处理(仅 job_queue 模式生效)
+    priority: int = 0
+
 
 class FileMeta(BaseModel):
 
@@ -254,6 +257,11 @@ class Fragment(BaseModel):
     table_start_row_idx: int = 0    # 表格起始行
     table_end_row_idx: int = 0      # 表格结束行
 
+    # ---- 入库时预计算的子树聚合，只存放在切片树json中，不写入ES ----
+    tree_ori_ids: list[str] = []    # 节点及子孙节点的ori_id(非叶子节点)
+    tree_text: str = ""             # 节点及子孙节点拼接的原文(非叶子节点及表格叶子节点)
+    tree_all_texts: list[str] = []  # 节点及子孙节点的原文列表(非叶子节点及表格叶子节点)
+
 
 # -------------
 
@@ -16,7 +16,7 @@ from pkg.personal_doc.doc_parse import local_or_remote_exist as local_or_remote_
 from pkg.personal_doc.catalog import local_or_remote_exist as local_or_remote_exist_catalog, upload_catalog
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
 from pkg.utils.logger import logger
-from pkg.clients.textin_ocr import TextinOcr
+from pkg.clients.pdf2md_shard import recognize_pdf2md_json
 
 
 class FileImage(BaseModel):
@@ -62,9 +62,8 @@ def request_parser(context: Context):
         data = f.read()
 
     st = time.time()
-    response = TextinOcr().recognize_pdf2md(image=data)
-    response.raise_for_status()
-    res_json_all = xjson.loads(response.content)
+    # 页数较多的 PDF 按页分片并发解析
+    res_json_all = recognize_pdf2md_json(data)
     if res_json_all["code"] != 200:
         raise FileProcessException(f"pdf2md parse error: {res_json_all}")
 
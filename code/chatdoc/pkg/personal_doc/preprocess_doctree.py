@@ -2,23 +2,19 @@
 Author: longsion<xianglong_chen@intsig.net>
 Date: 2024-05-15 11:02:22
 LastEditors: longsion
-LastEditTime: 2024-09-20 16:22:09
+LastEditTime: 2025-03-24 20:02:44
 '''
 
 
 import re
-import pypeln as pl
-import requests
 
 from pkg.storage import Storage
 from .objects import Context, DocTreeNode, DocOriItem, DocOriItemType
 from pkg.utils.decorators import register_span_func
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
 from pkg.utils.transform import html2markdown
-from pkg.utils.generator import batch_generator_with_index
 from pkg.utils import compress, plat_call, xjson
 from pkg.es.es_p_doc_item import PDocItemES, PDocItemModel
-from pkg.config import config
 
 
 @register_span_func(func_name="目录树预处理", span_export_func=lambda context: dict(
@@ -60,22 +56,10 @@ def preprocess_doctree(context: Context) -> Context:
 @register_span_func()
 def html_list_2_markdown(tables):
     '''
-    description: 耗时超过，超过20个，则走proxy的并发处理
+    description: html 表格转 markdown，lxml 单次解析，本地处理即可，不再走 proxy 的并发处理
     return {*}
     '''
-    if len(tables) < 20:
-        return [html2markdown(table) for table in tables]
-    else:
-        url = config["proxy"]["url"]
-        # url = "http://localhost:8000"
-        batch_size = max(len(tables) // 10 + 1, 10)
-        workers = min(len(tables) // batch_size + 1, 10)
-        markdown_tables_2d = batch_generator_with_index(tables, batch_size) | pl.thread.map(
-            lambda x: (x[0], requests.post(f"{url}/transform/html2markdown", json=x[1]).json()), workers=workers, maxsize=workers
-        ) | list
-        markdown_tables_2d.sort(key=lambda x: x[0], reverse=False)
-        markdown_tables = [_markdown_table for _, _markdown_tables in markdown_tables_2d for _markdown_table in _markdown_tables]
-        return markdown_tables
+    return [html2markdown(table) for table in tables]
 
 
 def doctree_dfs(doctree_node: DocTreeNode, titles=[]) -> list[DocOriItem]:
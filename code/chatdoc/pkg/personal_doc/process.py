@@ -22,17 +22,22 @@ from pkg.utils import global_file_thread_pool
 from pkg.es.es_p_file import PFileES, PESFileObject
 from pkg.config import config
 
-from pkg.utils.thread_with_return_value import ThreadWithReturnValue
+from pkg.utils.jaeger import tracer
+from pkg.utils.thread_with_return_value import ThreadContext, ThreadWithReturnValue, set_thread_context
+from pkg.redis.job_queue import Job, JobStageError, RedisJobQueue, StageCheckpointer, estimate_page_number
 
 from opentelemetry.trace import get_current_span
-from opentelemetry import context as otel_context
+from opentelemetry import context as otel_context, propagate
 import traceback
 from pkg.utils.logger import logger
 
 
-def thread_process(context: Context) -> Context:
+job_queue = RedisJobQueue("personal")
+
+
+def thread_process(context: Context, checkpointer: StageCheckpointer = None) -> Context:
     '''
-    description: 文档处理，后台线程池处理
+    description: 文档处理，后台线程池处理；job_queue 模式下由 worker 进程调用，传入 checkpointer
     return {*}
     '''
 
@@ -42,6 +47,58 @@ def thread_process(context: Context) -> Context:
     otel_context.attach(context.span_ctx)
 
     try:
+        context = run_stages(context, checkpointer)
+    except Exception as e:
+        logger.error(f"Doc Process Failed, trace_id: {context.trace_id}, exception: {e}, traceback: {traceback.format_exc()}")
+        # job_queue 模式下失败会重试，最终失败时由 on_job_failed 回调
+        if checkpointer is None:
+            callback(context.params.callback_url, context.params.uuid, FileProcessStatus.file_process_error.value, params=context.params)
+        raise e
+
+    # 等待后台线程执行完成
+    thread_rets = []
+    for thread in context.threads:
+        try:
+            thread_rets.append(thread.join())
+        except Exception as e:
+            logger.error(f"Doc Process Failed, trace_id: {context.trace_id}, exception: backend threads exception occurred: {thread.name}, exception: {e}")
+            thread_rets.append(False)
+
+    # 更新 es_file
+    insert_file_bool = PFileES().insert_file(context.es_file_entity)
+
+    # None和True表示成功，False|err表示失败
+    if not insert_file_bool or [thread_ret for thread_ret in thread_rets if thread_ret not in [None, True]]:
+        logger.error(f"Doc Process Failed, trace_id: {context.trace_id}, exception: backend threads exception occurred: {thread_rets}")
+        # job_queue 模式下抛出由 worker 重试，最终失败时由 on_job_failed 回调
+        if checkpointer is not None:
+            raise JobStageError(f"insert file failed: {not insert_file_bool}, backend threads: {thread_rets}")
+        callback(context.params.callback_url, context.params.uuid, FileProcessStatus.file_process_error.value, context.file_meta, params=context.params)
+    else:
+        # 回调文件处理状态：切片成功
+        callback(context.params.callback_url, context.params.uuid, FileProcessStatus.file_cut_success.value, context.file_meta, context.params)
+        # 清空后台线程
+        context.threads = []
+
+        logger.info(f"Doc Process Success, elapsed: {1000*(time.time() - start_time):.1f}ms")
+
+    return context
+
+
+def run_stages(context: Context, checkpointer: StageCheckpointer = None) -> Context:
+    '''
+    description: 依次执行文档处理各阶段(pdf2md, doctree, cut, meta, upload)
+    传入 checkpointer 时跳过已完成的阶段，阶段(含其后台线程)成功后写入 checkpoint；
+    meta 与 upload 并行执行，两者一起写入 checkpoint
+    return {*}
+    '''
+
+    def _finish(stages: list[str], thread_count: int):
+        if checkpointer:
+            checkpointer.finish(stages, context, context.threads[thread_count:])
+
+    if not checkpointer or not checkpointer.done("pdf2md"):
+        thread_count = len(context.threads)
         # 文档解析: 个人知识库仅调用pdf2md, TODO: 需要调用doc_parser的话再看，
         # Cover是否也需要更新？
         # 个人知识库只调用PDF2MD？防止Cover及Page图片可能会冲突！！！可以暂时这么去使用！后面需要加的话再添加相应的逻辑处理！
@@ -51,18 +108,27 @@ def thread_process(context: Context) -> Context:
         _t = ThreadWithReturnValue(target=callback, args=(context.params.callback_url, context.params.uuid, FileProcessStatus.file_catalog_success.value, context.file_meta, context.params, ))
         _t.start()
         context.threads.append(_t)
+        _finish(["pdf2md"], thread_count)
 
+    if not checkpointer or not checkpointer.done("doctree"):
+        thread_count = len(context.threads)
         # 目录树预处理
         # 1. 生成ori_id对于原文的映射，存入到es中
         # 2. 方便切片逻辑的数据获取，以及存储
         context = preprocess_doctree(context)
+        _finish(["doctree"], thread_count)
 
+    if not checkpointer or not checkpointer.done("cut"):
+        thread_count = len(context.threads)
         # 表格切片处理
         context = cut_table_fragment(context)
 
         # 段落切片处理
         context = cut_paragraph_fragment(context)
+        _finish(["cut"], thread_count)
 
+    if not checkpointer or not checkpointer.done("meta", "upload"):
+        thread_count = len(context.threads)
         # 异步进行文件基础信息提取
         _t_extract_file_meta = ThreadWithReturnValue(target=extract_file_meta, args=(context,))
         _t_extract_file_meta.start()
@@ -72,35 +138,11 @@ def thread_process(context: Context) -> Context:
 
         # 生成文件基础信息
         context = _t_extract_file_meta.join()
+        _finish(["meta", "upload"], thread_count)
 
-    except Exception as e:
-        logger.error(f"Doc Process Failed, trace_id: {context.trace_id}, exception: {e}, traceback: {traceback.format_exc()}")
-        callback(context.params.callback_url, context.params.uuid, FileProcessStatus.file_process_error.value, params=context.params)
-        raise e
-
-    # 等待后台线程执行完成
-    thread_rets = []
-    for thread in context.threads:
-        try:
-            thread_rets.append(thread.join())
-        except Exception as e:
-            logger.error(f"Doc Process Failed, trace_id: {context.trace_id}, exception: backend threads exception occurred: {thread.name}, exception: {e}")
-            thread_rets.append(False)
-
-    # 更新 es_file
-    insert_file_bool = PFileES().insert_file(context.es_file_entity)
-
-    # None和True表示成功，False|err表示失败
-    if not insert_file_bool or [thread_ret for thread_ret in thread_rets if thread_ret not in [None, True]]:
-        logger.error(f"Doc Process Failed, trace_id: {context.trace_id}, exception: backend threads exception occurred: {thread_rets}")
-        callback(context.params.callback_url, context.params.uuid, FileProcessStatus.file_process_error.value, context.file_meta, params=context.params)
-    else:
-        # 回调文件处理状态：切片成功
-        callback(context.params.callback_url, context.params.uuid, FileProcessStatus.file_cut_success.value, context.file_meta, context.params)
-        # 清空后台线程
-        context.threads = []
-
-        logger.info(f"Doc Process Success, elapsed: {1000*(time.time() - start_time):.1f}ms")
+    if checkpointer:
+        # 等待各阶段后台线程结束并写入最后的 checkpoint，后台线程失败时抛出异常以便重试
+        checkpointer.flush(wait=True)
 
     return context
 
@@ -118,8 +160,10 @@ def process(params: Params) -> Context:
     else:
         # download file
         context = download_file(context)
-        # TODO: 使用消息队列
-        if global_file_thread_pool._work_queue.qsize() >= config["threadpool"]["doc_process_queue_size"]:
+        if job_queue.enabled:
+            if job_queue.pending_size() >= job_queue.max_pending:
+                raise FileProcessException(message="当前文档处理队列已满，请稍后重试")
+        elif global_file_thread_pool._work_queue.qsize() >= config["threadpool"]["doc_process_queue_size"]:
             raise FileProcessException(message="当前文档处理队列已满，请稍后重试")
 
         # 存在相同文件
@@ -128,7 +172,17 @@ def process(params: Params) -> Context:
             context.file_meta.page_number = same_file_meta.page_number
             context.file_meta.first_image_id = same_file_meta.first_image_id
 
-        global_file_thread_pool.submit(thread_process, context)
+        if job_queue.enabled:
+            # 写入 redis 任务队列，由 doc_worker.py 进程消费
+            carrier = {}
+            propagate.inject(carrier)
+            job_queue.enqueue(params=context.params.model_dump_json(),
+                              context_json=dump_context(context),
+                              page_number=context.file_meta.page_number or estimate_page_number(context.org_file_path),
+                              priority=context.params.priority,
+                              carrier=carrier)
+        else:
+            global_file_thread_pool.submit(thread_process, context)
         context = report_process_result(context, "processing")
 
     return context
@@ -153,6 +207,34 @@ def process_sync(params: Params) -> Context:
     return context
 
 
+def dump_context(context: Context) -> str:
+    '''
+    description: 任务队列中保存的 context 快照，不包含线程、trace 等运行时对象
+    return {*}
+    '''
+    return context.model_dump_json(exclude={"span_ctx", "threads", "doc_parse_result", "page_base64_imgs", "answer_response"})
+
+
+def process_job(job: Job):
+    '''
+    description: worker 进程执行队列中的任务，从最近的 checkpoint 继续
+    return {*}
+    '''
+    context = Context.model_validate_json(job.context_json)
+    set_thread_context(ThreadContext(trace_id=context.trace_id or ""))
+
+    with tracer.start_as_current_span("personal parse job", context=propagate.extract(job.carrier)):
+        context.span_ctx = otel_context.get_current()
+        # 源文件保存在本地，换了 worker 机器需要重新下载
+        context = download_file(context)
+        thread_process(context, StageCheckpointer(job, dump_context))
+
+
+def on_job_failed(job: Job, e: Exception):
+    params = Params.model_validate_json(job.params)
+    callback(params.callback_url, params.uuid, FileProcessStatus.file_process_error.value, params=params)
+
+
 @register_span_func(span_export_func=lambda context: dict(
     params=context.params.model_dump(),
     response=context.answer_response.model_dump(),
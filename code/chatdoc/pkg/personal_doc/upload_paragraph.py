@@ -5,6 +5,8 @@ LastEditors: longsion
 LastEditTime: 2024-10-17 16:58:28
 '''
 
+import time
+
 import pypeln as pl
 import requests
 from pkg.config import config
@@ -12,7 +14,8 @@ from pkg.utils.decorators import register_span_func
 from pkg.utils.generator import batch_generator
 from .objects import Context, Fragment
 from pkg.utils.thread_with_return_value import ThreadWithReturnValue
-from pkg.es.es_p_doc_fragment import PDocFragmentES, PDocFragmentModel
+from pkg.es.es_p_doc_fragment import MATERIALIZED_TREE_KEYS, PDocFragmentES, PDocFragmentModel
+from pkg.utils.incremental_index import diff_fragments, incremental_index_enabled
 from pkg.utils.logger import logger
 
 
@@ -30,6 +33,14 @@ def upload_paragragh_fragment(context: Context) -> Context:
 
     file_uuid = context.params.uuid
 
+    if incremental_index_enabled():
+        # 增量入库：只写入有变化的切片，只对新增切片计算 embedding
+        incremental_t = ThreadWithReturnValue(target=_incremental_upload_fragments, args=(file_uuid, context.doc_fragments, context.params.user_id))
+        incremental_t.start()
+        context.threads.append(incremental_t)
+        incremental_t.join()
+        return context
+
     # 删除老切片
     es_fragment_t = ThreadWithReturnValue(target=_delete_and_insert_es_fragments, args=(file_uuid, context.doc_fragments, context.params.user_id))
     es_fragment_t.start()
@@ -62,8 +73,46 @@ def _delete_and_insert_es_fragments(file_uuid, doc_fragments: list[Fragment], us
         return False
 
 
+def _incremental_upload_fragments(file_uuid, doc_fragments: list[Fragment], user_id: str):
+    from pkg.vdb import delete_vdb_fragments
+
+    try:
+        start_time = time.time()
+        _f_items = [PDocFragmentModel(**item.model_dump(), file_uuid=file_uuid, user_id=user_id) for item in doc_fragments]
+        diff = diff_fragments(PDocFragmentES().get_content_hashes_by_user_and_file_uuid(user_id, file_uuid), _f_items, exclude=MATERIALIZED_TREE_KEYS)
+
+        success = PDocFragmentES().delete_by_ids(diff.removed_ids, file_uuid=file_uuid) \
+            and delete_vdb_fragments(diff.removed_uuids, user_id=user_id, file_uuid=file_uuid) \
+            and PDocFragmentES().update_by_ids(diff.changed) \
+            and PDocFragmentES().insert_doc_fragments(diff.added)
+        if not success:
+            logger.error(f"incremental upload es fragments failed, file_uuid: {file_uuid}, user_id: {user_id}, {diff}")
+            return False
+
+        # 新增切片写入 ES 后再计算 embedding(es 向量模式下 embedding 按 uuid 更新到切片文档)
+        added_uuids = {item.uuid for item in diff.added}
+        embedding_and_upload([item for item in doc_fragments if item.uuid in added_uuids], file_uuid, user_id)
+
+        logger.info(f"incremental upload es fragments succeed, file_uuid: {file_uuid}, user_id: {user_id}, {diff}, cost: {1000*(time.time() - start_time):.1f}ms")
+        return True
+    except Exception as e:
+        logger.error(f"incremental upload es fragments error: {e}")
+        return False
+
+
 @ register_span_func()
 def embedding_and_upload(doc_fragments: list[Fragment], file_uuid: str, user_id: str):
+    from pkg.vdb import use_local_vdb
+
+    if use_local_vdb():
+        # 本地向量库：proxy 只计算 embedding，由本进程写入
+        from pkg.doc.objects import VectorEntity
+        from pkg.doc.upload_paragraph import embedding_fragments
+        from pkg.vdb.local import insert_personal_entities
+
+        embeddings = embedding_fragments(doc_fragments, file_uuid)
+        return insert_personal_entities(user_id, [VectorEntity(uuid=uuid, file_uuid=file_uuid, vector=vector) for uuid, vector in embeddings.items()])
+
     vector_params = [
         dict(
             file_uuid=file_uuid,
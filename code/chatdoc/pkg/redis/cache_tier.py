@@ -0,0 +1,117 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-13 10:05:44
+LastEditors: longsion
+LastEditTime: 2025-03-13 17:21:09
+'''
+
+import struct
+
+import numpy as np
+
+from pkg.config import config
+from pkg.utils.logger import logger
+
+
+class VectorCodec:
+    """
+    向量压缩编码
+    - float16: 2 字节/维
+    - int8: 1 字节/维 + 4 字节 scale(对称量化)
+    """
+
+    def __init__(self, dtype: str = "float16"):
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"{dtype} is not a valid vector codec dtype")
+        self.dtype = dtype
+
+    def encode(self, vector) -> bytes:
+        array = np.asarray(vector, dtype=np.float32)
+        if self.dtype == "float16":
+            return array.astype(np.float16).tobytes()
+
+        scale = float(np.max(np.abs(array))) / 127 if array.size else 0.0
+        quantized = np.round(array / scale).astype(np.int8) if scale > 0 else np.zeros(array.shape, dtype=np.int8)
+        return struct.pack("<f", scale) + quantized.tobytes()
+
+    def decode(self, data: bytes) -> list[float]:
+        if self.dtype == "float16":
+            return np.frombuffer(data, dtype=np.float16).astype(np.float32).tolist()
+
+        scale = struct.unpack("<f", data[:4])[0]
+        return (np.frombuffer(data[4:], dtype=np.int8).astype(np.float32) * scale).tolist()
+
+
+class FloatCodec:
+    """
+    单个浮点数(如 rerank 得分)
+    """
+
+    def encode(self, value) -> bytes:
+        return struct.pack("<d", float(value))
+
+    def decode(self, data: bytes) -> float:
+        return struct.unpack("<d", data)[0]
+
+
+class RedisCacheTier:
+    """
+    redis 二级缓存，多个 worker 进程共享，重启后不丢失
+    key 为内容摘要(cache_key_digest)，value 经 codec 压缩编码
+    redis 异常时只记录日志并视为未命中，不影响主流程
+    """
+
+    def __init__(self, namespace: str, codec, ttl: int = 7 * 86400, client=None):
+        self.namespace = namespace
+        self.codec = codec
+        self.ttl = ttl
+        self._client = client
+
+    @property
+    def client(self):
+        if self._client is None:
+            from pkg.redis.redis import redis_store
+            self._client = redis_store
+        return self._client
+
+    def _redis_key(self, digest: bytes) -> str:
+        return f"{self.namespace}:{digest.hex()}"
+
+    def get_many(self, digests: list[bytes]) -> list:
+        if not digests:
+            return []
+        try:
+            raws = self.client.mget([self._redis_key(digest) for digest in digests])
+        except Exception as e:
+            logger.warning(f"RedisCacheTier {self.namespace} mget error: {e}")
+            return [None] * len(digests)
+
+        values = []
+        for raw in raws:
+            try:
+                values.append(self.codec.decode(raw) if raw is not None else None)
+            except Exception as e:
+                logger.warning(f"RedisCacheTier {self.namespace} decode error: {e}")
+                values.append(None)
+        return values
+
+    def set_many(self, items: list[tuple[bytes, object]]):
+        if not items:
+            return
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for digest, value in items:
+                pipe.set(self._redis_key(digest), self.codec.encode(value), ex=self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"RedisCacheTier {self.namespace} set error: {e}")
+
+
+def get_redis_cache_tier(namespace: str, codec):
+    """
+    cache.redis_enabled 开启时返回 redis 二级缓存，否则返回 None(仅使用进程内缓存)
+    """
+    cache_config = config.get("cache") or {}
+    if str(cache_config.get("redis_enabled", False)).lower() not in ('1', 'true'):
+        return None
+    return RedisCacheTier(f"{cache_config.get('redis_prefix', 'chatdoc:cache')}:{namespace}", codec, ttl=int(cache_config.get("redis_ttl", 7 * 86400)))
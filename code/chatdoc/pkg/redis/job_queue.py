@@ -0,0 +1,429 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-19 10:14:32
+LastEditors: longsion
+LastEditTime: 2025-03-19 18:36:50
+'''
+
+import json
+import os
+import signal
+import threading
+import time
+import uuid
+from typing import Callable
+
+from pkg.config import config
+from pkg.utils import compress, decompress
+from pkg.utils.logger import logger
+
+
+job_queue_config = config.get("job_queue") or {}
+
+
+class JobStageError(Exception):
+    def __init__(self, message: str, *args, **kwargs) -> None:
+        super().__init__(message, *args, **kwargs)
+        self.message = message
+
+
+class JobLostError(JobStageError):
+    """
+    租约已过期，任务被放回队列或已被其他 worker 取走，当前执行需中止且不能再 ack/retry
+    """
+
+
+# 原子地取出得分最小的任务，写入 running 并设置租约，同时累加尝试次数并记录本次执行的 owner
+_CLAIM_SCRIPT = """
+local items = redis.call('ZPOPMIN', KEYS[1])
+if #items == 0 then
+    return false
+end
+local job_id = items[1]
+redis.call('ZADD', KEYS[2], ARGV[1], job_id)
+redis.call('HINCRBY', ARGV[2] .. job_id, 'attempts', 1)
+redis.call('HSET', ARGV[2] .. job_id, 'owner', ARGV[3])
+return job_id
+"""
+
+# 续约：任务仍由本次执行持有(owner 一致且仍在 running)时才延长租约，否则返回 0
+_HEARTBEAT_SCRIPT = """
+if redis.call('HGET', KEYS[2], 'owner') ~= ARGV[1] or not redis.call('ZSCORE', KEYS[1], ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[2])
+return 1
+"""
+
+# 写入 checkpoint：owner 不一致时不写，避免覆盖新 owner 的进度
+_CHECKPOINT_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'owner') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'stages', ARGV[2], 'context', ARGV[3])
+return 1
+"""
+
+# 结束任务(ack / retry / fail)：仅在本次执行仍持有任务时生效
+_FINISH_SCRIPT = """
+if redis.call('HGET', KEYS[2], 'owner') ~= ARGV[1] or not redis.call('ZSCORE', KEYS[1], ARGV[2]) then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[2])
+if ARGV[3] == 'ack' then
+    redis.call('DEL', KEYS[2])
+elseif ARGV[3] == 'retry' then
+    redis.call('HSET', KEYS[2], 'status', 'pending', 'error', ARGV[4])
+    redis.call('ZADD', KEYS[3], ARGV[5], ARGV[2])
+else
+    redis.call('HSET', KEYS[2], 'status', 'failed', 'error', ARGV[4])
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+end
+return 1
+"""
+
+# 租约过期(worker 崩溃/被杀)的任务按原得分放回等待队列
+_REQUEUE_EXPIRED_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+for _, job_id in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], job_id)
+    local score = redis.call('HGET', ARGV[2] .. job_id, 'score')
+    if score then
+        redis.call('ZADD', KEYS[2], score, job_id)
+    end
+end
+return #expired
+"""
+
+
+def estimate_page_number(file_path: str) -> int:
+    """
+    未知页数时按文件大小估算页数，仅用于排队顺序
+    """
+    try:
+        size = os.path.getsize(file_path)
+    except (OSError, TypeError):
+        return 1
+    return max(1, size // int(job_queue_config.get("bytes_per_page", 100 * 1024)))
+
+
+class Job:
+    """
+    从队列中取出的任务
+    - params: 接口请求参数 json，用于最终失败时回调
+    - context_json: 最近一次 checkpoint 的 context 快照(入队时为初始 context)
+    - stages: 已完成并写入 checkpoint 的阶段
+    """
+
+    def __init__(self, queue: "RedisJobQueue", job_id: str, fields: dict):
+        self.queue = queue
+        self.job_id = job_id
+        self.params = fields.get("params", "")
+        self.context_json = decompress(fields["context"]) if fields.get("context") else ""
+        self.stages: list[str] = json.loads(fields.get("stages") or "[]")
+        self.carrier: dict = json.loads(fields.get("carrier") or "{}")
+        self.attempts = int(fields.get("attempts") or 0)
+        self.score = float(fields.get("score") or 0)
+        # 本次执行的持有标识，续约/checkpoint/结束时校验
+        self.owner = fields.get("owner", "")
+        # 续约失败(租约过期被放回队列)时置位，执行在下一个阶段边界中止
+        self.lost = threading.Event()
+
+    @property
+    def last_attempt(self) -> bool:
+        return self.attempts >= self.queue.max_attempts
+
+    def ensure_owned(self):
+        if self.lost.is_set():
+            raise JobLostError(f"job lease lost: {self.job_id}")
+
+
+class RedisJobQueue:
+    """
+    基于 redis 的持久化任务队列，进程重启不丢任务，多个 worker 进程共同消费
+    - pending: zset，得分 = 入队时间 + 页数 * page_weight - 优先级 * priority_weight，
+      页数少的先处理(短作业优先)，等待足够久的大文件不会饿死，优先级高的整体提前
+    - running: zset，得分为租约到期时间，worker 定时续约；到期未续约视为 worker 崩溃，任务放回 pending
+    - job:{id}: hash，保存参数、尝试次数与最近一次 checkpoint，失败重试时从 checkpoint 继续
+    """
+
+    def __init__(self, name: str, client=None):
+        self.name = name
+        self.prefix = f"{job_queue_config.get('prefix', 'chatdoc:job')}:{name}"
+        self.pending_key = f"{self.prefix}:pending"
+        self.running_key = f"{self.prefix}:running"
+        self.job_key_prefix = f"{self.prefix}:job:"
+
+        self.max_pending = int(job_queue_config.get("max_pending", config["threadpool"]["doc_process_queue_size"]))
+        self.max_attempts = int(job_queue_config.get("max_attempts", 3))
+        self.lease = int(job_queue_config.get("lease", 300))
+        self.page_weight = float(job_queue_config.get("page_weight", 2))
+        self.priority_weight = float(job_queue_config.get("priority_weight", 3600))
+        self.failed_ttl = int(job_queue_config.get("failed_ttl", 7 * 86400))
+
+        self._client = client
+        self._scripts = {}
+
+    @property
+    def enabled(self) -> bool:
+        return str(job_queue_config.get("enabled", False)).lower() in ('1', 'true')
+
+    @property
+    def client(self):
+        if self._client is None:
+            from pkg.redis.redis import redis_store
+            self._client = redis_store
+        return self._client
+
+    def job_key(self, job_id: str) -> str:
+        return f"{self.job_key_prefix}{job_id}"
+
+    def _script(self, source: str):
+        if source not in self._scripts:
+            self._scripts[source] = self.client.register_script(source)
+        return self._scripts[source]
+
+    def score(self, page_number: int, priority: int = 0) -> float:
+        return time.time() + max(page_number, 1) * self.page_weight - priority * self.priority_weight
+
+    def pending_size(self) -> int:
+        return self.client.zcard(self.pending_key)
+
+    def enqueue(self, params: str, context_json: str, page_number: int, priority: int = 0, carrier: dict = None) -> str:
+        job_id = uuid.uuid4().hex
+        score = self.score(page_number, priority)
+
+        pipe = self.client.pipeline(transaction=True)
+        pipe.hset(self.job_key(job_id), mapping=dict(
+            params=params,
+            context=compress(context_json),
+            stages="[]",
+            carrier=json.dumps(carrier or {}),
+            attempts=0,
+            score=score,
+            page_number=page_number,
+            priority=priority,
+            status="pending",
+            enqueued_at=time.time(),
+        ))
+        pipe.zadd(self.pending_key, {job_id: score})
+        pipe.execute()
+
+        logger.info(f"RedisJobQueue {self.name} enqueue job: {job_id}, page_number: {page_number}, priority: {priority}")
+        return job_id
+
+    def claim(self) -> Job:
+        owner = uuid.uuid4().hex
+        job_id = self._script(_CLAIM_SCRIPT)(keys=[self.pending_key, self.running_key], args=[time.time() + self.lease, self.job_key_prefix, owner])
+        if not job_id:
+            return None
+        job_id = job_id.decode() if isinstance(job_id, bytes) else job_id
+
+        fields = {}
+        for k, v in self.client.hgetall(self.job_key(job_id)).items():
+            k = k.decode() if isinstance(k, bytes) else k
+            # context 为压缩后的二进制，其余字段解码为字符串
+            fields[k] = v if k == "context" or not isinstance(v, bytes) else v.decode()
+
+        if not fields.get("params"):
+            # 任务数据已丢失(被手动清理等)，直接丢弃
+            logger.warning(f"RedisJobQueue {self.name} job data missing, drop job: {job_id}")
+            self.client.zrem(self.running_key, job_id)
+            return None
+
+        fields["owner"] = owner
+        self.client.hset(self.job_key(job_id), "status", "running")
+        return Job(self, job_id, fields)
+
+    def heartbeat(self, job: Job) -> bool:
+        """
+        续约，任务已不再由本次执行持有时返回 False 并标记 job.lost
+        """
+        owned = self._script(_HEARTBEAT_SCRIPT)(keys=[self.running_key, self.job_key(job.job_id)], args=[job.owner, job.job_id, time.time() + self.lease])
+        if not owned:
+            job.lost.set()
+            logger.warning(f"RedisJobQueue {self.name} job lease lost: {job.job_id}")
+        return bool(owned)
+
+    def save_checkpoint(self, job: Job, stages: list[str], context_json: str):
+        job.ensure_owned()
+        saved = self._script(_CHECKPOINT_SCRIPT)(keys=[self.job_key(job.job_id)], args=[job.owner, json.dumps(stages), compress(context_json)])
+        if not saved:
+            job.lost.set()
+            job.ensure_owned()
+        job.stages = list(stages)
+        logger.info(f"RedisJobQueue {self.name} checkpoint job: {job.job_id}, stages: {stages}")
+
+    def _finish(self, job: Job, action: str, error: str = "", arg=""):
+        finished = self._script(_FINISH_SCRIPT)(keys=[self.running_key, self.job_key(job.job_id), self.pending_key], args=[job.owner, job.job_id, action, error, arg])
+        if not finished:
+            logger.warning(f"RedisJobQueue {self.name} job not owned, skip {action}: {job.job_id}")
+        return bool(finished)
+
+    def ack(self, job: Job) -> bool:
+        return self._finish(job, "ack")
+
+    def retry(self, job: Job, error: str) -> bool:
+        """
+        放回等待队列，沿用入队时的得分，不会排到新任务之后
+        """
+        return self._finish(job, "retry", error, job.score)
+
+    def fail(self, job: Job, error: str) -> bool:
+        return self._finish(job, "fail", error, self.failed_ttl)
+
+    def requeue_expired(self) -> int:
+        count = self._script(_REQUEUE_EXPIRED_SCRIPT)(keys=[self.running_key, self.pending_key], args=[time.time(), self.job_key_prefix])
+        if count:
+            logger.warning(f"RedisJobQueue {self.name} requeue expired jobs: {count}")
+        return count
+
+
+class StageCheckpointer:
+    """
+    按阶段写入 checkpoint
+    阶段启动的后台线程(上传等)全部成功后才写入，保证从 checkpoint 恢复时不会遗漏该阶段的异步结果；
+    后台线程未结束时先继续执行后续阶段，不阻塞流水线
+    """
+
+    def __init__(self, job: Job, dump: Callable):
+        self.job = job
+        self.dump = dump
+        self._pending: list[tuple[list[str], str, list]] = []
+
+    def done(self, *stages: str) -> bool:
+        return all(stage in self.job.stages for stage in stages)
+
+    def finish(self, stages: list[str], context, threads: list):
+        self.job.ensure_owned()
+        self._pending.append((stages, self.dump(context), threads))
+        self.flush()
+
+    def flush(self, wait: bool = False):
+        self.job.ensure_owned()
+        completed, snapshot = list(self.job.stages), None
+        while self._pending:
+            stages, _snapshot, threads = self._pending[0]
+            if not wait and any(thread.is_alive() for thread in threads):
+                break
+
+            for thread in threads:
+                ret = thread.join()
+                if ret not in [None, True]:
+                    raise JobStageError(f"stages {stages} backend thread failed: {thread.name}, ret: {ret}")
+
+            self._pending.pop(0)
+            completed += [stage for stage in stages if stage not in completed]
+            snapshot = _snapshot
+
+        if snapshot is not None:
+            self.job.queue.save_checkpoint(self.job, completed, snapshot)
+
+
+class JobWorker:
+    """
+    任务消费进程，启动方式见 doc_worker.py
+    - concurrency 个线程并发执行任务，多个队列按顺序轮询
+    - 后台线程定时为执行中的任务续约，并把租约过期的任务放回队列
+    - 任务失败未超过 max_attempts 时重新入队并从 checkpoint 继续，否则调用 on_failed
+    """
+
+    def __init__(self, handlers: dict[RedisJobQueue, tuple[Callable, Callable]], concurrency: int = 3, poll_interval: float = 1.0):
+        self.handlers = handlers
+        self.queues = list(handlers.keys())
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+
+        self._active: dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def stop(self, *args):
+        logger.info("JobWorker stopping, wait for running jobs")
+        self._stop.set()
+
+    def run_forever(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        threads = [threading.Thread(target=self._consume, name=f"job_worker_{i}") for i in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+
+        lease = min(queue.lease for queue in self.queues)
+        while not self._stop.wait(max(lease / 3, 1)):
+            self._maintain()
+
+        for thread in threads:
+            thread.join()
+
+    def _maintain(self):
+        with self._lock:
+            jobs = list(self._active.values())
+        for job in jobs:
+            try:
+                # 续约失败时 job.lost 被置位，执行在下一个阶段边界抛出 JobLostError
+                job.queue.heartbeat(job)
+            except Exception as e:
+                logger.error(f"JobWorker heartbeat error, job: {job.job_id}, exception: {e}")
+
+        for queue in self.queues:
+            try:
+                queue.requeue_expired()
+            except Exception as e:
+                logger.error(f"JobWorker requeue expired error, queue: {queue.name}, exception: {e}")
+
+    def _claim(self) -> Job:
+        for queue in self.queues:
+            job = queue.claim()
+            if job is not None:
+                return job
+        return None
+
+    def _consume(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"JobWorker claim error: {e}")
+                job = None
+
+            if job is None:
+                self._stop.wait(self.poll_interval)
+                continue
+
+            self._run(job)
+
+    def _run(self, job: Job):
+        handler, on_failed = self.handlers[job.queue]
+        with self._lock:
+            self._active[job.job_id] = job
+
+        try:
+            if job.attempts > job.queue.max_attempts:
+                # 最后一次尝试时 worker 崩溃，不再重试
+                raise JobStageError(f"job exceeded max attempts: {job.attempts}")
+
+            logger.info(f"JobWorker start job: {job.job_id}, queue: {job.queue.name}, attempts: {job.attempts}, stages: {job.stages}")
+            handler(job)
+            job.ensure_owned()
+            if job.queue.ack(job):
+                logger.info(f"JobWorker finish job: {job.job_id}, queue: {job.queue.name}")
+
+        except JobLostError as e:
+            # 任务已被放回队列/由其他 worker 执行，不再 retry / fail
+            logger.warning(f"JobWorker job aborted: {job.job_id}, queue: {job.queue.name}, exception: {e}")
+
+        except Exception as e:
+            logger.error(f"JobWorker job failed: {job.job_id}, queue: {job.queue.name}, attempts: {job.attempts}, exception: {e}")
+            try:
+                if job.attempts < job.queue.max_attempts:
+                    job.queue.retry(job, str(e))
+                elif job.queue.fail(job, str(e)):
+                    on_failed(job, e)
+            except Exception as e:
+                logger.error(f"JobWorker handle failed job error: {job.job_id}, exception: {e}")
+
+        finally:
+            with self._lock:
+                self._active.pop(job.job_id, None)
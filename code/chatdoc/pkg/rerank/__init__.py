@@ -6,10 +6,16 @@ LastEditTime: 2025-03-09 08:13:37
 '''
 from pkg.utils import retry_exponential_backoff
 from pkg.config import config
-from pkg.utils.lru_cache import LRUCacheDict
+from pkg.utils.lru_cache import BoundedLRUCache, TieredCache
+from pkg.redis.cache_tier import FloatCodec, get_redis_cache_tier
+from pkg.rerank.scheduler import RerankScheduler
 import requests
 
-rerank_lru_cache = LRUCacheDict(max_size=20000, expiration=60 * 60)
+cache_config = config.get("cache") or {}
+rerank_lru_cache = TieredCache(
+    BoundedLRUCache(max_bytes=int(cache_config.get("rerank_max_mb", 64)) * 1024 * 1024, expiration=60 * 60),
+    second_tier=get_redis_cache_tier("rerank", codec=FloatCodec()),
+)
 
 
 @retry_exponential_backoff()
@@ -59,3 +65,23 @@ def rerank_api_by_cache(pairs, headers=None, url='http://xxxx/rerank', if_softma
             result[idx] = rerank_score
 
     return result
+
+
+rerank_config = config.get("rerank") or {}
+rerank_scheduler = RerankScheduler(
+    rerank_api,
+    cache=rerank_lru_cache,
+    concurrency=int(rerank_config.get("concurrency", 16)),
+    max_batch_size=int(rerank_config.get("max_batch_size", 32)),
+    max_batch_chars=int(rerank_config.get("max_batch_chars", 8000)),
+    timeout=float(rerank_config.get("timeout", 60)),
+)
+
+
+def rerank_scores(question: str, texts: list[str]) -> list[float]:
+    """
+    question 与 texts 的 rerank 得分，经全局调度器合并/去重请求
+    """
+    if not texts:
+        return []
+    return rerank_scheduler.score(question, texts, headers=None, url=config["textin"]["rerank_url"], if_softmax=0)
@@ -0,0 +1,129 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-12 10:31:08
+LastEditors: longsion
+LastEditTime: 2025-03-12 15:22:51
+'''
+
+import json
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from pkg.utils.logger import logger
+
+
+class RerankScheduler:
+    """
+    进程级 rerank 调度器
+    - 全局有界线程池，并发请求不会成倍放大线程数
+    - 按文本长度自适应切分批次，短文本多合并、长文本少合并
+    - 相同 (question, text, kwargs) 的在途请求只发一次，其余调用方等待同一个结果
+    - 结果写入 cache，命中 cache 的文本不再请求
+    """
+
+    def __init__(self, rerank_func: callable, cache, concurrency: int = 16, max_batch_size: int = 32, max_batch_chars: int = 8000, timeout: float = 60):
+        self.rerank_func = rerank_func
+        self.cache = cache
+        self.max_batch_size = max_batch_size
+        self.max_batch_chars = max_batch_chars
+        # 等待结果的超时时间(秒)
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="rerank_scheduler")
+        self._inflight: dict[tuple[str, str, str], Future] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(question: str, text: str):
+        return question + '##' + text
+
+    @staticmethod
+    def kwargs_key(kwargs: dict) -> str:
+        return json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str)
+
+    def split_batches(self, texts: list[str]) -> list[list[str]]:
+        batches, batch, batch_chars = [], [], 0
+        for text in texts:
+            if batch and (len(batch) >= self.max_batch_size or batch_chars + len(text) > self.max_batch_chars):
+                batches.append(batch)
+                batch, batch_chars = [], 0
+            batch.append(text)
+            batch_chars += len(text)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def score(self, question: str, texts: list[str], **kwargs) -> list[float]:
+        """
+        返回 question 与每个 text 的 rerank 得分，顺序与 texts 一致
+        """
+        futures: dict[str, Future] = {}
+        owned_texts = []
+        kwargs_key = self.kwargs_key(kwargs)
+
+        unique_texts = list(dict.fromkeys(texts))
+        cache_keys = [self.cache_key(question, text) for text in unique_texts]
+        if hasattr(self.cache, "get_many"):
+            cached_scores = self.cache.get_many(cache_keys)
+        else:
+            cached_scores = [self.cache[cache_key] if cache_key in self.cache else None for cache_key in cache_keys]
+
+        for text, cached_score in zip(unique_texts, cached_scores):
+            if cached_score is not None:
+                future = Future()
+                future.set_result(cached_score)
+                futures[text] = future
+                continue
+
+            with self._lock:
+                future = self._inflight.get((question, text, kwargs_key))
+                if future is None:
+                    future = Future()
+                    self._inflight[(question, text, kwargs_key)] = future
+                    owned_texts.append(text)
+            futures[text] = future
+
+        for batch in self.split_batches(owned_texts):
+            try:
+                self._executor.submit(self._request, question, batch, kwargs, kwargs_key)
+            except Exception as e:
+                # 提交失败(如线程池已关闭)时结束这些在途请求，否则本调用方及合并等待的调用方会一直阻塞
+                logger.error(f"RerankScheduler submit error: {e}")
+                self._resolve(question, batch, kwargs_key, error=e)
+
+        _, not_done = wait(futures.values(), timeout=self.timeout)
+        if not_done:
+            raise TimeoutError(f"RerankScheduler wait timeout: {len(not_done)} texts not scored in {self.timeout}s")
+        return [futures[text].result() for text in texts]
+
+    def _resolve(self, question: str, batch: list[str], kwargs_key: str, scores: list[float] = None, error: Exception = None):
+        with self._lock:
+            for i, text in enumerate(batch):
+                future = self._inflight.pop((question, text, kwargs_key), None)
+                if future is None:
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(scores[i])
+
+    def _request(self, question: str, batch: list[str], kwargs: dict, kwargs_key: str):
+        try:
+            scores = self.rerank_func([[question], batch], **kwargs)
+            if len(scores) != len(batch):
+                raise Exception(f"RerankScheduler result size mismatch: {len(scores)} != {len(batch)}")
+        except Exception as e:
+            logger.error(f"RerankScheduler request error: {e}")
+            self._resolve(question, batch, kwargs_key, error=e)
+            return
+
+        cached_items = [(self.cache_key(question, text), score) for text, score in zip(batch, scores)]
+        try:
+            if hasattr(self.cache, "set_many"):
+                self.cache.set_many(cached_items)
+            else:
+                for cache_key, score in cached_items:
+                    self.cache[cache_key] = score
+        except Exception as e:
+            logger.warning(f"RerankScheduler cache error: {e}")
+
+        self._resolve(question, batch, kwargs_key, scores=scores)
@@ -6,6 +6,7 @@ LastEditTime: 2025-03-09 08:13:43
 '''
 from pkg.config import config
 from pkg.utils.jaeger import TracedThreadPoolExecutor
+from pkg.utils.stage_dag import stage_pool
 from pkg.utils.logger import logger
 import requests
 from functools import wraps
@@ -27,7 +28,8 @@ def md5(content):
     return file_md5
 
 
-global_thread_pool = TracedThreadPoolExecutor(max_workers=config["threadpool"]["global_worker"])
+# 问答各阶段、embedding 批量请求等共用同一个有界线程池，避免多个线程池叠加导致线程过多
+global_thread_pool = stage_pool
 global_file_thread_pool = TracedThreadPoolExecutor(max_workers=config["threadpool"]["doc_process_worker"])
 
 
@@ -0,0 +1,194 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-14 10:21:36
+LastEditors: longsion
+LastEditTime: 2025-03-14 16:48:02
+'''
+
+from collections import OrderedDict
+import threading
+
+from pkg.config import config
+from pkg.utils import xjson
+
+
+def fragment_tree_version(file) -> str:
+    """
+    文件切片树的内容版本：重新解析会刷新 upload_time / created_at，版本不一致的缓存视为失效
+    """
+    return f"{getattr(file, 'upload_time', '') or ''}|{getattr(file, 'created_at', '') or ''}"
+
+
+class FragmentTree:
+    """
+    单个文件解码后的切片树
+    - fragments: uuid -> 原始切片 dict(不含 embedding)
+    - parent / children / ori_id 索引
+    - 按 model 类型惰性构造 pydantic 对象，构造一次后在请求间共享(只读)
+    """
+
+    def __init__(self, file_uuid: str, fragments: list[dict], nbytes: int = 0):
+        self.file_uuid = file_uuid
+        self.fragments: dict[str, dict] = {}
+        self.parent_index: dict[str, str] = {}
+        self.children_index: dict[str, list[str]] = {}
+        self.ori_id_index: dict[str, list[str]] = {}
+        self.nbytes = nbytes
+
+        for fragment in fragments:
+            uuid = fragment.get("uuid")
+            if not uuid:
+                continue
+            self.fragments[uuid] = fragment
+            self.parent_index[uuid] = fragment.get("parent_frament_uuid") or ""
+            self.children_index[uuid] = fragment.get("children_fragment_uuids") or []
+            for ori_id in fragment.get("ori_id") or []:
+                self.ori_id_index.setdefault(ori_id, []).append(uuid)
+
+        self._models: dict[type, dict] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_json(cls, file_uuid: str, doc_fragments_json: str):
+        doc_fragments = xjson.loads(doc_fragments_json)
+        if not isinstance(doc_fragments, list):
+            return None
+        # 解码后的 dict 与构造出的 model 约为原始 json 的数倍，按此估算占用
+        return cls(file_uuid, doc_fragments, nbytes=len(doc_fragments_json) * 4)
+
+    def get_parent(self, uuid: str) -> str:
+        return self.parent_index.get(uuid, "")
+
+    def get_children(self, uuid: str) -> list[str]:
+        return self.children_index.get(uuid, [])
+
+    def get_by_ori_id(self, ori_id: str) -> list[str]:
+        return self.ori_id_index.get(ori_id, [])
+
+    def models(self, model_cls, construct: bool = False) -> dict:
+        """
+        返回 uuid -> model_cls 实例，同一 model_cls 只构造一次
+        construct=True 时使用 if_model_construct 跳过校验
+        """
+        models = self._models.get(model_cls)
+        if models is not None:
+            return models
+
+        with self._lock:
+            models = self._models.get(model_cls)
+            if models is None:
+                factory = model_cls.if_model_construct if construct else model_cls
+                models = {
+                    uuid: factory(**{**fragment, "file_uuid": self.file_uuid}) for uuid, fragment in self.fragments.items()
+                }
+                self._models[model_cls] = models
+        return models
+
+
+class FragmentTreeCache:
+    """
+    进程级切片树缓存，按字节数限制容量的 LRU
+    key 为 (scope, file_uuid)，scope 区分个人库用户；value 记录内容版本，版本不一致视为未命中
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+
+        # (scope, file_uuid) -> (version, tree)，顺序即 LRU 顺序
+        self._trees = OrderedDict()
+        self._scopes: dict[str, set] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._trees)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(size=len(self._trees), bytes=self._bytes, max_bytes=self.max_bytes,
+                        hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    def contains(self, file_uuid: str, version: str, scope: str = "") -> bool:
+        with self._lock:
+            item = self._trees.get((scope, file_uuid))
+            return item is not None and item[0] == version
+
+    def get(self, file_uuid: str, version: str, scope: str = "") -> FragmentTree:
+        key = (scope, file_uuid)
+        with self._lock:
+            item = self._trees.get(key)
+            if item is None or item[0] != version:
+                self.misses += 1
+                return None
+            self._trees.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, file_uuid: str, version: str, tree: FragmentTree, scope: str = ""):
+        key = (scope, file_uuid)
+        with self._lock:
+            self._remove(key)
+            if tree.nbytes > self.max_bytes:
+                return
+            self._trees[key] = (version, tree)
+            self._scopes.setdefault(file_uuid, set()).add(scope)
+            self._bytes += tree.nbytes
+            while self._trees and self._bytes > self.max_bytes:
+                self._remove(next(iter(self._trees)))
+                self.evictions += 1
+
+    def load(self, file, scope: str = "", fetch=None) -> FragmentTree:
+        """
+        优先返回缓存中当前版本的切片树，未命中时解码 file.doc_fragments_json 并写入缓存
+        fetch(file): 拉取 file.doc_fragments_json；预处理时因缓存命中未拉取，之后切片树又被淘汰/替换时用于补拉
+        """
+        version = fragment_tree_version(file)
+        tree = self.get(file.uuid, version, scope=scope)
+        if tree is not None:
+            return tree
+
+        if not file.doc_fragments_json and fetch is not None:
+            fetch(file)
+        if not file.doc_fragments_json:
+            return None
+
+        tree = FragmentTree.from_json(file.uuid, file.doc_fragments_json)
+        if tree is not None:
+            self.set(file.uuid, version, tree, scope=scope)
+        return tree
+
+    def invalidate(self, file_uuids: list[str]):
+        """
+        文件重新解析或删除时调用，清除该文件在所有 scope 下的缓存
+        """
+        with self._lock:
+            for file_uuid in file_uuids:
+                for scope in list(self._scopes.get(file_uuid, ())):
+                    self._remove((scope, file_uuid))
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+            self._scopes.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        item = self._trees.pop(key, None)
+        if item is None:
+            return
+        self._bytes -= item[1].nbytes
+        scope, file_uuid = key
+        scopes = self._scopes.get(file_uuid)
+        if scopes is not None:
+            scopes.discard(scope)
+            if not scopes:
+                self._scopes.pop(file_uuid, None)
+
+
+fragment_tree_cache = FragmentTreeCache(
+    max_bytes=int((config.get("cache") or {}).get("fragment_tree_max_mb", 512)) * 1024 * 1024
+)
@@ -0,0 +1,120 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-04-02 10:31:08
+LastEditors: longsion
+LastEditTime: 2025-04-02 16:47:25
+
+文件名/公司名模糊匹配：difflib.get_close_matches 的等价实现，结果与其完全一致
+- 候选集按字符建倒排(字符 -> 候选下标、出现次数)，查询时按倒排向量化计算每个候选与查询的公共字符数，得到 quick_ratio(ratio 的上界)
+- 只对上界不低于 cutoff 的候选按上界从高到低计算 SequenceMatcher.ratio，已有 n 个结果且上界低于第 n 名时提前结束
+- 同一候选集的倒排按内容缓存，同一文件库的多次查询只建一次
+'''
+
+import heapq
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+import numpy as np
+
+
+class FuzzyIndex(object):
+    """
+    >>> FuzzyIndex(["ape", "apple", "peach", "puppy"]).close_matches("appel")
+    ['apple', 'ape']
+    """
+
+    def __init__(self, possibilities: list[str]):
+        self.possibilities = list(possibilities)
+        self.lengths = np.fromiter((len(x) for x in self.possibilities), dtype=np.int64, count=len(self.possibilities))
+
+        # (字符, 候选下标) 去重计数后按字符有序，每个字符的倒排是连续的一段
+        chars = np.frombuffer("".join(self.possibilities).encode("utf-32-le", "surrogatepass"), dtype=np.uint32).astype(np.int64)
+        owners = np.repeat(np.arange(len(self.possibilities), dtype=np.int64), self.lengths)
+        keys, counts = np.unique((chars << 32) | owners, return_counts=True)
+        self.owners = keys & 0xFFFFFFFF
+        self.counts = counts
+        posting_chars, starts = np.unique(keys >> 32, return_index=True)
+        ends = np.append(starts[1:], len(keys))
+        self.postings = {
+            chr(char): (start, end)
+            for char, start, end in zip(posting_chars.tolist(), starts.tolist(), ends.tolist())
+        }
+
+    def quick_ratios(self, word: str) -> np.ndarray:
+        """
+        每个候选的 SequenceMatcher.quick_ratio(公共字符数上界)，不低于 ratio
+        """
+        counts: dict[str, int] = {}
+        for char in word:
+            counts[char] = counts.get(char, 0) + 1
+        slices = [(*self.postings[char], count) for char, count in counts.items() if char in self.postings]
+        if slices:
+            owners = np.concatenate([self.owners[start:end] for start, end, _count in slices])
+            commons = np.concatenate([np.minimum(self.counts[start:end], count) for start, end, count in slices])
+            common = np.bincount(owners, weights=commons, minlength=len(self.possibilities))
+        else:
+            common = np.zeros(len(self.possibilities))
+
+        total = self.lengths + len(word)
+        # 与 difflib 一致：两者都为空时相似度为 1
+        return np.where(total > 0, 2.0 * common / np.maximum(total, 1), 1.0)
+
+    def close_matches(self, word: str, n: int = 3, cutoff: float = 0.6) -> list[str]:
+        """
+        同 difflib.get_close_matches(word, possibilities, n, cutoff)
+        """
+        if not n > 0:
+            raise ValueError("n must be > 0: %r" % (n,))
+        if not 0.0 <= cutoff <= 1.0:
+            raise ValueError("cutoff must be in [0.0, 1.0]: %r" % (cutoff,))
+        if not self.possibilities:
+            return []
+
+        bounds = self.quick_ratios(word)
+        candidates = np.flatnonzero(bounds >= cutoff)
+
+        result: list[tuple[float, str]] = []
+        s = SequenceMatcher()
+        s.set_seq2(word)
+        for i, bound in self._iter_by_bound(candidates, bounds, batch=max(4 * n, 32)):
+            # 上界已低于第 n 名，后续候选不可能进入结果(得分相同时按字符串比较，需继续)
+            if len(result) >= n and bound < result[0][0]:
+                break
+            x = self.possibilities[i]
+            s.set_seq1(x)
+            score = s.ratio()
+            if score < cutoff:
+                continue
+            if len(result) < n:
+                heapq.heappush(result, (score, x))
+            elif (score, x) > result[0]:
+                heapq.heapreplace(result, (score, x))
+
+        return [x for _score, x in sorted(result, reverse=True)]
+
+    @staticmethod
+    def _iter_by_bound(candidates: np.ndarray, bounds: np.ndarray, batch: int):
+        """
+        按上界从高到低遍历候选，每次只部分排序出一批，通常第一批内即可提前结束
+        """
+        remaining = candidates
+        while len(remaining):
+            if len(remaining) > batch:
+                part = np.argpartition(-bounds[remaining], batch - 1)
+                head, remaining = remaining[part[:batch]], remaining[part[batch:]]
+            else:
+                head, remaining = remaining, remaining[:0]
+            head = head[np.argsort(-bounds[head], kind="stable")]
+            yield from zip(head.tolist(), bounds[head].tolist())
+
+
+@lru_cache(maxsize=64)
+def _cached_index(possibilities: tuple[str, ...]) -> FuzzyIndex:
+    return FuzzyIndex(possibilities)
+
+
+def get_close_matches(word: str, possibilities: list[str], n: int = 3, cutoff: float = 0.6) -> list[str]:
+    """
+    替代 difflib.get_close_matches，参数与返回值相同
+    """
+    return _cached_index(tuple(possibilities)).close_matches(word, n=n, cutoff=cutoff)
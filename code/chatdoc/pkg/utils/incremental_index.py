@@ -0,0 +1,120 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-20 10:08:45
+LastEditors: longsion
+LastEditTime: 2025-03-20 17:52:13
+'''
+
+import json
+import uuid
+
+from pkg.config import config
+from pkg.utils import md5
+
+
+def incremental_index_enabled() -> bool:
+    """
+    parse.incremental 开启时，重新解析文件只写入有变化的切片/表格行，只对新增切片计算 embedding
+    """
+    return str((config.get("parse") or {}).get("incremental", False)).lower() in ('1', 'true')
+
+
+def content_id(scope: str, key: str, occurrence: int = 0) -> str:
+    """
+    由内容生成的确定性 id(uuid 格式)，相同内容重复出现时以 occurrence 区分
+    """
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"chatdoc/{scope}/{occurrence}/{key}"))
+
+
+def content_hash(source: dict) -> str:
+    return md5(json.dumps(source, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+
+
+def content_doc_ids(scope: str, sources: list[dict]) -> list[str]:
+    """
+    表格行等无需 embedding 的文档：整个文档内容即 id，内容不变则 id 不变
+    """
+    occurrences, ids = {}, []
+    for source in sources:
+        key = content_hash(source)
+        occurrence = occurrences.get(key, 0)
+        occurrences[key] = occurrence + 1
+        ids.append(content_id(scope, key, occurrence))
+    return ids
+
+
+def assign_content_ids(scope: str, fragments: list) -> list:
+    """
+    将切片的随机 uuid 替换为由切片内容生成的确定性 id，并同步替换父子引用
+    id 只取决于 embedding 相关的内容(类型、是否叶子节点、ebed_text)，ori_id/层级/偏移等变化不影响 id，
+    只需局部更新 ES 文档，无需重新计算 embedding
+    """
+    occurrences, mapping = {}, {}
+    for fragment in fragments:
+        key = f"{fragment.type}|{int(fragment.leaf)}|{fragment.ebed_text}"
+        occurrence = occurrences.get(key, 0)
+        occurrences[key] = occurrence + 1
+        mapping[fragment.uuid] = content_id(scope, key, occurrence)
+
+    for fragment in fragments:
+        fragment.uuid = mapping[fragment.uuid]
+        fragment.parent_frament_uuid = mapping.get(fragment.parent_frament_uuid, fragment.parent_frament_uuid)
+        fragment.children_fragment_uuids = [mapping.get(child_uuid, child_uuid) for child_uuid in fragment.children_fragment_uuids]
+
+    return fragments
+
+
+class FragmentDiff:
+    """
+    新切片与已入库切片的差异
+    - added: 新增切片，需要写入 ES 并计算 embedding
+    - changed: es _id -> 局部更新的字段，embedding 不变
+    - removed_ids / removed_uuids: 需要删除的 ES 文档 _id 及切片 uuid(用于删除向量)
+    """
+
+    def __init__(self):
+        self.added = []
+        self.changed: dict[str, dict] = {}
+        self.removed_ids: list[str] = []
+        self.removed_uuids: list[str] = []
+        self.unchanged = 0
+
+    def __str__(self) -> str:
+        return f"added: {len(self.added)}, changed: {len(self.changed)}, removed: {len(self.removed_ids)}, unchanged: {self.unchanged}"
+
+
+def diff_fragments(hits: list[dict], items: list, exclude: list[str] = []) -> FragmentDiff:
+    """
+    :param hits: 已入库切片的 ES hits，_source 包含 uuid、content_hash
+    :param items: 待入库的切片 model，会写入 content_hash
+    :param exclude: 不写入 ES 的字段
+    """
+    exclude = set(exclude) | {"created_at", "content_hash", "generation"}
+    diff = FragmentDiff()
+
+    existing: dict[str, tuple[str, str]] = {}
+    for hit in hits:
+        fragment_uuid = hit["_source"].get("uuid")
+        if fragment_uuid in existing:
+            # 重复写入的文档只保留一份
+            diff.removed_ids.append(hit["_id"])
+            continue
+        existing[fragment_uuid] = (hit["_id"], hit["_source"].get("content_hash", ""))
+
+    for item in items:
+        source = item.model_dump(exclude=exclude)
+        item.content_hash = content_hash(source)
+
+        es_id, old_hash = existing.pop(item.uuid, (None, None))
+        if es_id is None:
+            diff.added.append(item)
+        elif old_hash != item.content_hash:
+            diff.changed[es_id] = {**source, "content_hash": item.content_hash}
+        else:
+            diff.unchanged += 1
+
+    for fragment_uuid, (es_id, _) in existing.items():
+        diff.removed_ids.append(es_id)
+        diff.removed_uuids.append(fragment_uuid)
+
+    return diff
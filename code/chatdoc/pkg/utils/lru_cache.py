@@ -6,6 +6,8 @@ LastEditTime: 2024-04-26 10:59:48
 '''
 
 from collections import OrderedDict
+import hashlib
+import sys
 import time
 import threading
 import weakref
@@ -218,6 +220,251 @@ class LRUCacheDict(object):
             return None
 
 
+def cache_key_digest(key) -> bytes:
+    """
+    缓存 key 压缩为定长摘要，避免以整段文本作为 key 常驻内存
+    """
+    if isinstance(key, bytes) and len(key) == 16:
+        return key
+    if not isinstance(key, (str, bytes)):
+        key = repr(key)
+    if isinstance(key, str):
+        key = key.encode("utf-8", errors="ignore")
+    return hashlib.blake2b(key, digest_size=16).digest()
+
+
+def estimate_size(value) -> int:
+    """
+    估算缓存值占用的字节数，list/tuple 按首元素大小近似(embedding 向量等元素同构)
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)) and value:
+        size += sys.getsizeof(value[0]) * len(value)
+    elif isinstance(value, dict):
+        size += sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in value.items())
+    return size
+
+
+class BoundedLRUCache(object):
+    """ 线程安全、按字节数限制容量的 LRU 缓存
+
+    - get/set 均为 O(1)，不在每次访问时全量 cleanup
+    - 过期按写入顺序分摊清理：每次写入最多检查 sweep_batch 个最早写入的条目，读取时惰性判断过期
+    - key 统一压缩为 16 字节摘要
+    - 统计 hit/miss/eviction/expiration
+
+    >>> d = BoundedLRUCache(max_bytes=10 * 1024, expiration=60)
+    >>> d['foo'] = 'bar'
+    >>> d['foo']
+    'bar'
+    >>> d['missing']
+    Traceback (most recent call last):
+        ...
+    KeyError: 'missing'
+    >>> d.stats()['hits'], d.stats()['misses']
+    (1, 1)
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, expiration=15 * 60, max_size=None, sweep_batch=8):
+        self.max_bytes = max_bytes
+        self.max_size = max_size
+        self.expiration = expiration
+        self.sweep_batch = sweep_batch
+
+        # key -> (value, size, expire_at)，顺序即 LRU 顺序
+        self._values = OrderedDict()
+        # key -> expire_at，顺序即写入顺序(过期时间相同，写入顺序即过期顺序)
+        self._expire_order = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def size(self):
+        return len(self._values)
+
+    @property
+    def bytes(self):
+        return self._bytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return dict(
+                size=len(self._values),
+                bytes=self._bytes,
+                max_bytes=self.max_bytes,
+                hits=self.hits,
+                misses=self.misses,
+                hit_rate=round(self.hits / total, 4) if total else 0.0,
+                evictions=self.evictions,
+                expirations=self.expirations,
+            )
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._expire_order.clear()
+            self._bytes = 0
+
+    def __contains__(self, key):
+        digest = cache_key_digest(key)
+        with self._lock:
+            item = self._values.get(digest)
+            return item is not None and not self._is_expired(item[2], time.time())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_many(self, keys: list) -> list:
+        return [self.get(key) for key in keys]
+
+    def set_many(self, items: list[tuple]):
+        for key, value in items:
+            self[key] = value
+
+    def __getitem__(self, key):
+        digest = cache_key_digest(key)
+        with self._lock:
+            item = self._values.get(digest)
+            if item is None:
+                self.misses += 1
+                raise KeyError(key)
+            if self._is_expired(item[2], time.time()):
+                self._remove(digest)
+                self.expirations += 1
+                self.misses += 1
+                raise KeyError(key)
+            self._values.move_to_end(digest)
+            self.hits += 1
+            return item[0]
+
+    def __setitem__(self, key, value):
+        digest = cache_key_digest(key)
+        size = estimate_size(value)
+        now = time.time()
+        expire_at = now + self.expiration if self.expiration is not None else None
+
+        with self._lock:
+            self._remove(digest)
+            if size > self.max_bytes:
+                return
+            self._values[digest] = (value, size, expire_at)
+            self._expire_order[digest] = expire_at
+            self._bytes += size
+
+            self._sweep_expired(now)
+            self._evict()
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._remove(cache_key_digest(key))
+
+    @staticmethod
+    def _is_expired(expire_at, now):
+        return expire_at is not None and expire_at < now
+
+    def _remove(self, digest):
+        item = self._values.pop(digest, None)
+        if item is not None:
+            self._bytes -= item[1]
+            self._expire_order.pop(digest, None)
+
+    def _sweep_expired(self, now):
+        for _ in range(self.sweep_batch):
+            if not self._expire_order:
+                return
+            digest, expire_at = next(iter(self._expire_order.items()))
+            if not self._is_expired(expire_at, now):
+                return
+            self._remove(digest)
+            self.expirations += 1
+
+    def _evict(self):
+        while self._values and (self._bytes > self.max_bytes or (self.max_size and len(self._values) > self.max_size)):
+            digest = next(iter(self._values))
+            self._remove(digest)
+            self.evictions += 1
+
+
+class TieredCache(object):
+    """
+    两级缓存：进程内 BoundedLRUCache + 可选的共享二级缓存(如 RedisCacheTier)
+    二级缓存需实现 get_many(digests) / set_many([(digest, value)])，命中后回填一级缓存
+    """
+
+    def __init__(self, local: BoundedLRUCache, second_tier=None):
+        self.local = local
+        self.second_tier = second_tier
+        self.second_hits = 0
+        self.second_misses = 0
+
+    def __len__(self):
+        return len(self.local)
+
+    def size(self):
+        return self.local.size()
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self) -> dict:
+        return dict(**self.local.stats(), second_hits=self.second_hits, second_misses=self.second_misses)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        value = self.get_many([key])[0]
+        return default if value is None else value
+
+    def __getitem__(self, key):
+        value = self.get_many([key])[0]
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set_many([(key, value)])
+
+    def __delitem__(self, key):
+        del self.local[key]
+
+    def get_many(self, keys: list) -> list:
+        values = self.local.get_many(keys)
+        if self.second_tier is None:
+            return values
+
+        missing = [i for i, value in enumerate(values) if value is None]
+        if not missing:
+            return values
+
+        digests = [cache_key_digest(keys[i]) for i in missing]
+        for i, digest, value in zip(missing, digests, self.second_tier.get_many(digests)):
+            if value is None:
+                self.second_misses += 1
+                continue
+            self.second_hits += 1
+            self.local[digest] = value
+            values[i] = value
+        return values
+
+    def set_many(self, items: list[tuple]):
+        items = [(cache_key_digest(key), value) for key, value in items]
+        self.local.set_many(items)
+        if self.second_tier is not None:
+            self.second_tier.set_many(items)
+
+
 class LRUCachedFunction(object):
     """
     A memoized function, backed by an LRU cache.
@@ -254,15 +501,15 @@ class LRUCachedFunction(object):
     """
 
     def __init__(self, function, cache=None, cache_key_suffix: str = None):
-        if cache:
+        if cache is not None:
             self.cache = cache
         else:
-            self.cache = LRUCacheDict()
+            self.cache = BoundedLRUCache()
         self.function = function
         self._cache_key_suffix = cache_key_suffix or self.function.__name__
 
     def __call__(self, *args, **kwargs):
-        key = repr((args, kwargs)) + "#" + self._cache_key_suffix  # In principle a python repr(...) should not return any # characters.
+        key = self._generate_cache_key(args, kwargs)
         try:
             return self.cache[key]
         except KeyError:
@@ -270,43 +517,56 @@ class LRUCachedFunction(object):
             self.cache[key] = value
             return value
 
+    def _generate_cache_key(self, args, kwargs):
+        # 单参数调用与 BatchCacheManager 的单条输入使用同一个 key，两者可共享缓存
+        if len(args) == 1:
+            return make_cache_key(args[0], (), kwargs, self._cache_key_suffix)
+        return make_cache_key(args, (), kwargs, self._cache_key_suffix)
+
 
 class BatchCacheManager:
     def __init__(self, function, cache, batch_size: int = None, cache_key_suffix: str = None, thread_pool: ThreadPoolExecutor = None):
         self.function = function
-        self.cache = cache or LRUCacheDict()
+        self.cache = cache if cache is not None else BoundedLRUCache()
         self.batch_size = batch_size
         self._cache_key_suffix = cache_key_suffix or self.function.__name__
         self._thread_pool = thread_pool
 
     def __call__(self, inputs, *args, **kwargs):
-        result = []
-        to_request = []
-        request_indices = []
-
-        # 检查每个输入是否在缓存中
-        for i, input in enumerate(inputs):
-            cache_key = self._generate_cache_key(input, *args, **kwargs)
-            try:
-                # 从缓存获取结果
-                result.append(self.cache[cache_key])
-            except KeyError:
-                # 需要请求的加入列表
-                to_request.append(input)
-                request_indices.append(i)
-                result.append(None)  # 占位符
+        cache_keys = [self._generate_cache_key(input, *args, **kwargs) for input in inputs]
+
+        # 检查每个输入是否在缓存中，支持批量查询的缓存(如带 redis 二级缓存)一次取回
+        if hasattr(self.cache, "get_many"):
+            result = self.cache.get_many(cache_keys)
+        else:
+            result = [self._get(cache_key) for cache_key in cache_keys]
+
+        # 需要请求的加入列表
+        request_indices = [i for i, value in enumerate(result) if value is None]
+        to_request = [inputs[i] for i in request_indices]
 
         # 如果有未缓存的项，进行批处理请求
         if to_request:
             batched_results = self._process_batches(to_request, *args, **kwargs)
             # 填充结果到正确的位置
             for idx, res in zip(request_indices, batched_results):
-                cache_key = self._generate_cache_key(inputs[idx], *args, **kwargs)
-                self.cache[cache_key] = res
                 result[idx] = res
 
+            cached_items = [(cache_keys[idx], res) for idx, res in zip(request_indices, batched_results)]
+            if hasattr(self.cache, "set_many"):
+                self.cache.set_many(cached_items)
+            else:
+                for cache_key, res in cached_items:
+                    self.cache[cache_key] = res
+
         return result
 
+    def _get(self, cache_key):
+        try:
+            return self.cache[cache_key]
+        except KeyError:
+            return None
+
     def _process_batches(self, inputs, *args, **kwargs):
         if self.batch_size:
             groups = [inputs[i:i + self.batch_size] for i in range(0, len(inputs), self.batch_size)]
@@ -321,12 +581,16 @@ class BatchCacheManager:
                     results.extend(self.function(group, *args, **kwargs))
 
         else:
-            results = self.function(group, *args, **kwargs)
+            results = self.function(inputs, *args, **kwargs)
 
         return results
 
     def _generate_cache_key(self, input, *args, **kwargs):
-        return repr((input, args, kwargs)) + "#" + self._cache_key_suffix
+        return make_cache_key(input, args, kwargs, self._cache_key_suffix)
+
+
+def make_cache_key(input, args: tuple, kwargs: dict, suffix: str) -> bytes:
+    return cache_key_digest(repr((input, args, sorted(kwargs.items()))) + "#" + suffix)
 
 
 if __name__ == "__main__":
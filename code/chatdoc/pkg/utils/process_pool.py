@@ -0,0 +1,134 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-25 10:18:40
+LastEditors: longsion
+LastEditTime: 2025-03-25 18:46:12
+
+文档入库中纯 Python 的 CPU 密集阶段(目录树遍历、表格转换、切片生成)放到进程池执行，多个文件同时入库时不再争抢 GIL，也不拖慢同进程的问答线程
+'''
+
+import multiprocessing
+import os
+import pickle
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Callable
+
+from pkg.config import config
+from pkg.utils.logger import logger
+
+CPU_PROCESS_WORKERS = int(config["threadpool"].get("cpu_process_worker", 0) or 0)
+CPU_PROCESS_NICE = int(config["threadpool"].get("cpu_process_nice", 0) or 0)
+CPU_PROCESS_START_METHOD = config["threadpool"].get("cpu_process_start_method") or "spawn"
+# 超过该大小的参数/结果经共享内存传递
+SHM_MIN_BYTES = int(config["threadpool"].get("cpu_process_shm_min_kb", 1024)) * 1024
+SHM_DIR = "/dev/shm"
+
+
+class SharedPayload:
+    """
+    进程间传递的数据：pickle(protocol 5)序列化，较大的数据写入共享内存，只经管道传递共享内存名称
+    由读取方 load 后释放共享内存
+    """
+
+    def __init__(self, obj):
+        data = pickle.dumps(obj, protocol=5)
+        self.size = len(data)
+        self.name = None
+        self.data = data
+
+        if self.size >= SHM_MIN_BYTES and _shm_available(self.size):
+            shm = shared_memory.SharedMemory(create=True, size=self.size)
+            shm.buf[:self.size] = data
+            self.name, self.data = shm.name, None
+            shm.close()
+
+    def load(self):
+        if self.name is None:
+            return pickle.loads(self.data)
+
+        shm = shared_memory.SharedMemory(name=self.name)
+        try:
+            with shm.buf[:self.size] as view:
+                return pickle.loads(view)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def discard(self):
+        """
+        读取方未执行 load(任务异常)时释放共享内存
+        """
+        if self.name is None:
+            return
+        try:
+            shm = shared_memory.SharedMemory(name=self.name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+
+def _shm_available(size: int) -> bool:
+    # 容器内 /dev/shm 默认只有 64M，空间不足时写共享内存会触发 SIGBUS，走管道传递
+    try:
+        return shutil.disk_usage(SHM_DIR).free > size * 2
+    except OSError:
+        return False
+
+
+def _init_worker(nice: int):
+    if nice:
+        os.nice(nice)
+
+
+def _run_payload(fn: Callable, payload: SharedPayload) -> SharedPayload:
+    args, kwargs = payload.load()
+    return SharedPayload(fn(*args, **kwargs))
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ProcessPoolExecutor(
+                    max_workers=CPU_PROCESS_WORKERS,
+                    mp_context=multiprocessing.get_context(CPU_PROCESS_START_METHOD),
+                    initializer=_init_worker,
+                    initargs=(CPU_PROCESS_NICE,),
+                )
+                logger.info(f"cpu process pool start, workers: {CPU_PROCESS_WORKERS}, nice: {CPU_PROCESS_NICE}, start_method: {CPU_PROCESS_START_METHOD}")
+    return _executor
+
+
+def cpu_process_enabled() -> bool:
+    return CPU_PROCESS_WORKERS > 0
+
+
+def run_cpu_task(fn: Callable, *args, **kwargs):
+    """
+    在进程池中执行 fn 并返回结果，threadpool.cpu_process_worker 为 0 时在当前线程执行
+    fn 需为模块级函数，参数与返回值需可 pickle；返回的是结果副本，fn 对参数的修改不会反映到调用方
+    """
+    if not cpu_process_enabled():
+        return fn(*args, **kwargs)
+
+    global _executor
+    payload = SharedPayload((args, kwargs))
+    try:
+        return _get_executor().submit(_run_payload, fn, payload).result().load()
+    except BrokenProcessPool:
+        # 子进程异常退出(如 OOM)后进程池不可用，下次调用时重建
+        with _executor_lock:
+            _executor = None
+        raise
+    finally:
+        payload.discard()
@@ -0,0 +1,175 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-18 10:26:51
+LastEditors: longsion
+LastEditTime: 2025-03-18 19:12:07
+'''
+
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable
+
+from opentelemetry import context as otel_context
+
+from pkg.config import config
+from pkg.utils.thread_with_return_value import ThreadContext, get_thread_context, set_thread_context
+
+
+class StageDeadlineExceeded(TimeoutError):
+    def __init__(self, message, stage_names: list[str] = None):
+        super().__init__(message)
+        self.message = message
+        self.stage_names = stage_names or []
+
+
+class ContextPool:
+    """
+    进程级共享的有界线程池
+    - 提交时捕获调用方的 ThreadContext 与 otel context，在工作线程中恢复，链路与 trace_id 不丢失
+    - 线程数固定，不再每个子任务新建一个线程
+    - 池满时直接在调用线程中执行(caller-runs)：嵌套提交不会因等待自身占用的 worker 而死锁，负载高时自然形成背压
+    """
+
+    def __init__(self, max_workers: int = 64, thread_name_prefix: str = "context_pool"):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._slots = threading.BoundedSemaphore(max_workers)
+
+    @staticmethod
+    def _wrap(fn: Callable, args, kwargs):
+        parent_thread_context = get_thread_context()
+        parent_otel_context = otel_context.get_current()
+
+        def _run():
+            thread_context = ThreadContext(
+                trace_id=parent_thread_context.trace_id if parent_thread_context else "",
+                extra=parent_thread_context.extra if parent_thread_context else {},
+            )
+            set_thread_context(thread_context)
+            token = otel_context.attach(parent_otel_context)
+            thread_context.st = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                thread_context.duration = (time.time() - thread_context.st) * 1000
+                otel_context.detach(token)
+
+        return _run
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        if not self._slots.acquire(blocking=False):
+            future = Future()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            return future
+
+        run = self._wrap(fn, args, kwargs)
+
+        def _run_and_release():
+            try:
+                return run()
+            finally:
+                self._slots.release()
+
+        try:
+            return self._executor.submit(_run_and_release)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def map(self, fn: Callable, *iterables) -> list:
+        """
+        并发执行并按输入顺序返回结果，任一任务异常时抛出
+        """
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        return [future.result() for future in futures]
+
+
+class Stage:
+    """
+    流水线中的一个阶段：func(context) -> context，deps 为依赖的阶段名
+    """
+
+    def __init__(self, name: str, func: Callable, deps: list[str] = None):
+        self.name = name
+        self.func = func
+        self.deps = deps or []
+
+
+class StageDAG:
+    """
+    声明式阶段 DAG：依赖满足的阶段在共享线程池中并发执行
+
+    >>> dag = StageDAG([
+    ...     Stage("a", lambda ctx: ctx + ["a"]),
+    ...     Stage("b", lambda ctx: ctx, deps=["a"]),
+    ... ])
+    >>> dag.run([], pool=ContextPool(max_workers=2))
+    ['a']
+    """
+
+    def __init__(self, stages: list[Stage], stop_when: Callable = None):
+        names = [stage.name for stage in stages]
+        if len(set(names)) != len(names):
+            raise ValueError(f"duplicate stage names: {names}")
+        for stage in stages:
+            missing = [dep for dep in stage.deps if dep not in names]
+            if missing:
+                raise ValueError(f"stage {stage.name} depends on unknown stages: {missing}")
+
+        self.stages = stages
+        self.stop_when = stop_when
+
+    def run(self, context, deadline: float = None, pool: ContextPool = None):
+        """
+        执行全部阶段并返回 context
+        - 阶段返回值不为 None 时作为新的 context
+        - 每批阶段完成后检查 stop_when(context, done)，done 为已完成的阶段名集合；为真时不再调度后续阶段，直接返回(已在执行的阶段在后台继续完成)
+        - deadline(秒) 内未全部完成时抛出 StageDeadlineExceeded
+        """
+        pool = pool or stage_pool
+        deadline_at = time.time() + deadline if deadline else None
+
+        pending = {stage.name: stage for stage in self.stages}
+        done = set()
+        running: dict[Future, Stage] = {}
+
+        while pending or running:
+            ready = [stage for stage in pending.values() if all(dep in done for dep in stage.deps)]
+            for stage in ready:
+                pending.pop(stage.name)
+                running[pool.submit(stage.func, context)] = stage
+
+            if not running:
+                raise ValueError(f"stage dependency cycle: {list(pending)}")
+
+            timeout = None
+            if deadline_at is not None:
+                timeout = max(deadline_at - time.time(), 0)
+
+            finished, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not finished:
+                stage_names = [stage.name for stage in running.values()]
+                raise StageDeadlineExceeded(f"stage deadline exceeded, running stages: {stage_names}", stage_names)
+
+            for future in finished:
+                stage = running.pop(future)
+                result = future.result()
+                if result is not None:
+                    context = result
+                done.add(stage.name)
+
+            if self.stop_when and self.stop_when(context, done):
+                return context
+
+        return context
+
+
+stage_pool = ContextPool(max_workers=int(config["threadpool"]["global_worker"]), thread_name_prefix="stage_pool")
+
+
+def get_stage_deadline() -> float:
+    return float(config["threadpool"].get("stage_deadline", 0)) or None
@@ -0,0 +1,154 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-24 11:06:32
+LastEditors: longsion
+LastEditTime: 2025-03-24 19:20:15
+
+表格引擎：lxml 单次解析 html 表格为展开合并单元格后的二维网格，markdown / 行数据 / 数值单元格均由该网格产出
+'''
+
+import re
+from typing import Optional
+
+from lxml import html as lxml_html
+
+# financial_string_to_number 去除的字符：货币符号与千分位/小数点
+_FINANCIAL_STRIP = str.maketrans("", "", "$€￥,.")
+_INTEGER_PATTERN = re.compile(r"\s*[+-]?[0-9]+\s*")
+# float() 能解析的字符串至少包含一个数字或 inf/nan
+_MAYBE_FLOAT_PATTERN = re.compile(r"\d|inf|nan", re.IGNORECASE)
+
+
+def parse_financial_number(s: str) -> Optional[float]:
+    """
+    与 transform.financial_string_to_number 结果一致，无法解析时返回 None 而不是抛出异常
+    绝大多数单元格为整数或不含数字的文本，均不走异常路径
+    """
+    cleaned = s.translate(_FINANCIAL_STRIP)
+    if _INTEGER_PATTERN.fullmatch(cleaned):
+        return float(cleaned)
+    if not _MAYBE_FLOAT_PATTERN.search(cleaned):
+        return None
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+
+def _cell_text(cell) -> str:
+    return "".join(cell.itertext()).replace(' ', '').replace(',', '')
+
+
+def _span(cell, name: str) -> int:
+    # 与原实现一致：0 或负数的跨度不展开任何位置
+    value = cell.get(name)
+    return int(value) if value else 1
+
+
+class TableGrid:
+    """
+    展开合并单元格后的表格网格：合并单元格的文本只保留在左上角，其余位置为空字符串
+    与原 BeautifulSoup 版本 html2list 的结果一致
+    """
+
+    def __init__(self, rows: list[list[str]]):
+        self.rows = rows
+
+    @classmethod
+    def from_html(cls, html: str) -> "TableGrid":
+        if not html or not html.strip():
+            return cls([])
+
+        # 单次遍历得到每行的 (文本, colspan, rowspan)
+        root = lxml_html.fromstring(html)
+        cells = [
+            [(_cell_text(cell), _span(cell, "colspan"), _span(cell, "rowspan")) for cell in tr.iter("td", "th")]
+            for tr in root.iter("tr")
+        ]
+        return cls(_expand_spans(cells))
+
+    def markdown(self) -> str:
+        return rows_to_markdown(self.rows)
+
+
+def _expand_spans(cells: list[list[tuple[str, int, int]]]) -> list[list[str]]:
+    """
+    按列展开合并单元格，被合并的位置补空字符串；逐列处理，保证与原实现在不规整表格(跨度重叠、rowspan 超出表格)上结果一致
+    """
+    rows: list[list] = [list(row) for row in cells]
+    nb_row, nb_col = len(rows), max([len(row) for row in rows] + [0])
+
+    i_col = 0
+    while i_col < nb_col:
+        i_row = 0
+        # rowspan 超出表格时会补出新行，nb_row 随之增长
+        while i_row < nb_row:
+            row = rows[i_row]
+            if i_col >= len(row):
+                row.extend([""] * (i_col + 1 - len(row)))
+            cell = row[i_col]
+            if not isinstance(cell, tuple):
+                i_row += 1
+                continue
+            text, colspan, rowspan = cell
+            for span_col in range(i_col, i_col + colspan):
+                for span_row in range(i_row, i_row + rowspan):
+                    if span_col == i_col and span_row == i_row:
+                        continue
+                    while len(rows) <= span_row:
+                        rows.append([])
+                    nb_row = max(nb_row, len(rows))
+                    span_cells = rows[span_row]
+                    if len(span_cells) < span_col:
+                        span_cells.extend([""] * (span_col - len(span_cells)))
+                    span_cells.insert(span_col, "")
+                    nb_col = max(nb_col, len(span_cells))
+            row[i_col] = text
+            i_row += 1
+        i_col += 1
+    return rows
+
+
+def rows_to_markdown(rows: list[list[str]]) -> str:
+    lines = []
+    for ind, row in enumerate(rows):
+        lines.append("|" + "|".join(str(cell) for cell in row) + "|" + "\n")
+        if ind == 0:
+            lines.append("|" + "-|" * len(row) + "\n")
+    return "".join(lines)
+
+
+def html_to_markdown(html: str) -> str:
+    return TableGrid.from_html(html).markdown()
+
+
+class MarkdownTableLength:
+    """
+    逐行追加时增量计算 uneven_list_to_markdown_table(rows, fill_value) 的长度，避免每加一行都重新生成整张表
+    """
+
+    def __init__(self, fill_value: str = ""):
+        self.fill_len = len(fill_value)
+        self.rows = 0
+        self.cells = 0
+        self.chars = 0
+        self.max_cols = 0
+
+    def add(self, row: list) -> "MarkdownTableLength":
+        self.rows += 1
+        self.cells += len(row)
+        self.chars += sum(len(str(cell)) for cell in row)
+        self.max_cols = max(self.max_cols, len(row))
+        return self
+
+    def length(self, row: list = None) -> int:
+        """
+        当前表格(可额外追加 row)生成 markdown 后的长度
+        """
+        rows, cells, chars, max_cols = self.rows, self.cells, self.chars, self.max_cols
+        if row is not None:
+            rows, cells, chars, max_cols = rows + 1, cells + len(row), chars + sum(len(str(cell)) for cell in row), max(max_cols, len(row))
+        if not rows:
+            return 0
+        # 每行 "|" + cells + "|"*max_cols + "\n"，补齐的单元格为 fill_value；首行后的分隔行 "|" + "-|"*max_cols + "\n"
+        return chars + (max_cols * rows - cells) * self.fill_len + rows * (max_cols + 2) + 2 * max_cols + 2
@@ -17,33 +17,82 @@ if get_vector_db_model() == 'zilliz':
     from pkg.vdb.zilliz import delete_entities
     from pkg.vdb.zilliz import delete_personal_entities
     from pkg.vdb.zilliz import delete_entities_by_uuids
+    from pkg.vdb.zilliz import delete_fragment_entities
 elif get_vector_db_model() == 'tencent':
     from pkg.vdb.tencent import delete_entities
     from pkg.vdb.tencent import delete_personal_entities
     from pkg.vdb.tencent import delete_entities_by_uuids
+    from pkg.vdb.tencent import delete_fragment_entities
+elif get_vector_db_model() == 'local':
+    from pkg.vdb.local import delete_entities
+    from pkg.vdb.local import delete_personal_entities
+    from pkg.vdb.local import delete_entities_by_uuids
+    from pkg.vdb.local import delete_fragment_entities
 else:
     print(f'vector db model is {get_vector_db_model()}, 不需要删除')
 
+# 独立存储向量的向量库，es 模式下向量存放在切片文档中
+VDB_MODELS = ('tencent', 'zilliz', 'local')
+
+
+def use_es_knn():
+    """
+    vector.model 为 es 时，是否使用 knn(HNSW) 检索代替 script_score 暴力检索
+    需要 embedding 字段以 HNSW 方式建立索引
+    """
+    return str(config['vector'].get('es_knn', False)).lower() in ('1', 'true')
+
+
+def use_es_single_write() -> bool:
+    """
+    vector.model 为 es 时，切片先计算 embedding，与 embedding 一起一次写入 ES，不再由 proxy 按 uuid 回写
+    """
+    return get_vector_db_model() == 'es' and str(config['vector'].get('es_single_write', False)).lower() in ('1', 'true')
+
+
+def get_es_num_candidates(size: int) -> int:
+    # ES 限制 num_candidates 不超过 10000，且不能小于 k
+    num_candidates = max(int(config['vector'].get('es_num_candidates', 100)), size)
+    return min(num_candidates, 10000)
+
+
+def use_local_vdb() -> bool:
+    """
+    本地向量库：切片 embedding 经 proxy 计算后由本进程写入本地磁盘
+    """
+    return get_vector_db_model() == 'local'
+
 
 def get_vector_db_config():
-    if get_vector_db_model() not in ('tencent', 'zilliz'):
+    if get_vector_db_model() not in VDB_MODELS:
         return True
     return config[get_vector_db_model()] or {}
 
 
 def delete_vdb(file_uuid: str):
-    if get_vector_db_model() not in ('tencent', 'zilliz'):
+    if get_vector_db_model() not in VDB_MODELS:
         return True
     return delete_entities(file_uuid=file_uuid)
 
 
 def delete_vdb_uuids(file_uuids: list[str]):
-    if get_vector_db_model() not in ('tencent', 'zilliz'):
+    if get_vector_db_model() not in VDB_MODELS:
         return True
     return delete_entities_by_uuids(file_uuids=file_uuids)
 
 
 def delete_personal_vdb(user_id: str, file_uuids: list[str]):
-    if get_vector_db_model() not in ('tencent', 'zilliz'):
+    if get_vector_db_model() not in VDB_MODELS:
         return True
     return delete_personal_entities(user_id, file_uuids)
+
+
+def delete_vdb_fragments(fragment_uuids: list[str], user_id: str = None, file_uuid: str = None):
+    """
+    :param file_uuid: 切片所属文件，本地向量库据此只处理该文件的分片
+    """
+    if get_vector_db_model() not in VDB_MODELS or not fragment_uuids:
+        return True
+    if use_local_vdb():
+        return delete_fragment_entities(fragment_uuids, user_id=user_id, file_uuid=file_uuid)
+    return delete_fragment_entities(fragment_uuids, user_id=user_id)
@@ -0,0 +1,473 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-29 10:05:17
+LastEditors: longsion
+LastEditTime: 2025-03-29 19:22:48
+
+本地向量库(vector.model: local)：进程内检索，向量以文件形式持久化在本地磁盘，不依赖外部服务
+- 按文件分片(个人知识库按 user_id/file_uuid)，分片目录下为只追加的段(seg-*.npy 向量 + seg-*.json 切片 uuid)与 manifest.json
+- 向量归一化后以 float32 存储，检索时 mmap 读取，内积即余弦相似度(与 zilliz COSINE 的 distance 一致)
+- 插入追加新段；删除切片记录在 manifest 的 deleted 中，过半时合并段；删除文件直接删除分片目录
+- 指定文件检索时只在对应分片内精确计算；不指定文件时按分片中心向量做 IVF 式粗筛，只检索最近的 nprobe 个分片
+- 写入按 collection 加文件锁，manifest 原子替换；读取方按 manifest 的 mtime 判断分片是否变化
+'''
+
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Optional
+
+import numpy as np
+
+from pkg.config import config, BASE_DIR
+from pkg.doc.objects import VectorEntity
+from pkg.utils.logger import logger
+
+LOCAL_CONFIG = config.get("local") or {}
+LOCAL_PATH = LOCAL_CONFIG.get("path", "{BASE_DIR}/data/vectors").format(BASE_DIR=BASE_DIR)
+NPROBE = int(LOCAL_CONFIG.get("nprobe", 64))
+CACHE_SHARDS = int(LOCAL_CONFIG.get("cache_shards", 1024))
+CENTROID_REFRESH_SEC = float(LOCAL_CONFIG.get("centroid_refresh_sec", 60))
+
+COLLECTION_NAME = "fragment"
+P_COLLECTION_NAME = "p_fragment"
+MANIFEST = "manifest.json"
+
+
+def _safe_name(name: str) -> str:
+    return str(name).replace("/", "_").replace("..", "_")
+
+
+def _collection_dir(collection: str) -> str:
+    return os.path.join(LOCAL_PATH, collection)
+
+
+def _shard_dir(collection: str, file_uuid: str, user_id: str = None) -> str:
+    # 全局知识库按 file_uuid 前两位分目录，避免单个目录下文件过多
+    parent = _safe_name(user_id) if collection == P_COLLECTION_NAME else _safe_name(file_uuid)[:2]
+    return os.path.join(_collection_dir(collection), parent, _safe_name(file_uuid))
+
+
+def _list_shard_dirs(collection: str, user_id: str = None) -> list[str]:
+    base = _collection_dir(collection)
+    parents = [os.path.join(base, _safe_name(user_id))] if user_id else [entry.path for entry in _scandir(base) if entry.is_dir()]
+    return [entry.path for parent in parents for entry in _scandir(parent) if entry.is_dir()]
+
+
+def _scandir(path: str) -> list:
+    try:
+        return list(os.scandir(path))
+    except FileNotFoundError:
+        return []
+
+
+def _normalize(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def _read_manifest(shard_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(shard_dir, MANIFEST), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _write_json(path: str, data):
+    tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _write_segment(shard_dir: str, uuids: list[str], vectors: np.ndarray) -> dict:
+    name = f"seg-{int(time.time() * 1000):013d}-{uuid.uuid4().hex[:8]}"
+    tmp_path = os.path.join(shard_dir, f"{name}.tmp.npy")
+    np.save(tmp_path, vectors)
+    os.replace(tmp_path, os.path.join(shard_dir, f"{name}.npy"))
+    _write_json(os.path.join(shard_dir, f"{name}.json"), uuids)
+    return dict(name=name, count=len(uuids))
+
+
+class _Shard:
+    """
+    一个分片(文件)的向量，段以 mmap 方式加载
+    """
+
+    def __init__(self, shard_dir: str, manifest: dict):
+        self.shard_dir = shard_dir
+        self.file_uuid = os.path.basename(shard_dir)
+        self.segments = [np.load(os.path.join(shard_dir, f"{seg['name']}.npy"), mmap_mode="r") for seg in manifest["segments"]]
+        self.uuids = []
+        for seg in manifest["segments"]:
+            with open(os.path.join(shard_dir, f"{seg['name']}.json"), "r", encoding="utf-8") as f:
+                self.uuids.extend(json.load(f))
+
+        deleted = set(manifest.get("deleted", []))
+        self.alive = np.array([item not in deleted for item in self.uuids], dtype=bool) if deleted else None
+
+    def __len__(self):
+        return len(self.uuids)
+
+    def vectors(self) -> np.ndarray:
+        if not self.segments:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.concatenate(self.segments) if len(self.segments) > 1 else np.asarray(self.segments[0])
+
+    def scores(self, query: np.ndarray) -> np.ndarray:
+        scores = np.concatenate([segment @ query for segment in self.segments]) if self.segments else np.zeros(0, dtype=np.float32)
+        if self.alive is not None:
+            scores[~self.alive] = -np.inf
+        return scores
+
+
+class _ShardCache:
+    """
+    进程内分片缓存，按 manifest mtime 失效，超出 cache_shards 时淘汰最久未使用的分片
+    """
+
+    def __init__(self, max_shards: int = CACHE_SHARDS):
+        self.max_shards = max(max_shards, 1)
+        self._shards: OrderedDict[str, tuple[int, _Shard]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, shard_dir: str) -> Optional[_Shard]:
+        try:
+            mtime = os.stat(os.path.join(shard_dir, MANIFEST)).st_mtime_ns
+        except FileNotFoundError:
+            self.invalidate(shard_dir)
+            return None
+
+        with self._lock:
+            cached = self._shards.get(shard_dir)
+            if cached and cached[0] == mtime:
+                self._shards.move_to_end(shard_dir)
+                return cached[1]
+
+        shard = self._load(shard_dir)
+        if shard is None:
+            return None
+        with self._lock:
+            self._shards[shard_dir] = (mtime, shard)
+            self._shards.move_to_end(shard_dir)
+            while len(self._shards) > self.max_shards:
+                self._shards.popitem(last=False)
+        return shard
+
+    def invalidate(self, shard_dir: str):
+        with self._lock:
+            self._shards.pop(shard_dir, None)
+
+    @staticmethod
+    def _load(shard_dir: str) -> Optional[_Shard]:
+        # 读取 manifest 后段被合并删除时重新读取一次
+        for _ in range(2):
+            manifest = _read_manifest(shard_dir)
+            if manifest is None:
+                return None
+            try:
+                return _Shard(shard_dir, manifest)
+            except FileNotFoundError:
+                continue
+        return None
+
+
+class _CentroidIndex:
+    """
+    collection 内所有分片的中心向量，不指定文件检索时用于粗筛分片；超过 centroid_refresh_sec 后在后台重建，新入库的文件在重建后可被检索到
+    """
+
+    def __init__(self, collection: str):
+        self.collection = collection
+        # (分片目录, 中心向量矩阵)，整体替换，读取时无需加锁
+        self.index: tuple[list[str], np.ndarray] = ([], np.zeros((0, 0), dtype=np.float32))
+        self.built_at = 0.0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def probe(self, query: np.ndarray, nprobe: int) -> list[str]:
+        if self.built_at == 0:
+            self.refresh()
+        elif time.time() - self.built_at > CENTROID_REFRESH_SEC:
+            self._refresh_in_background()
+
+        shard_dirs, centroids = self.index
+        if len(shard_dirs) <= nprobe:
+            return list(shard_dirs)
+
+        scores = centroids @ query
+        top = np.argpartition(-scores, nprobe - 1)[:nprobe]
+        return [shard_dirs[i] for i in top]
+
+    def refresh(self):
+        start_time = time.time()
+        shard_dirs, centroids = [], []
+        for shard_dir in _list_shard_dirs(self.collection):
+            manifest = _read_manifest(shard_dir)
+            if manifest and manifest.get("centroid"):
+                shard_dirs.append(shard_dir)
+                centroids.append(manifest["centroid"])
+
+        self.index = (shard_dirs, np.asarray(centroids, dtype=np.float32) if centroids else np.zeros((0, 0), dtype=np.float32))
+        self.built_at = time.time()
+        logger.info(f"local vdb centroid index refreshed, collection: {self.collection}, shards: {len(shard_dirs)}, cost: {1000*(time.time() - start_time):.1f}ms")
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"local vdb centroid index refresh error: {self.collection}, {e}")
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=_run, daemon=True).start()
+
+
+shard_cache = _ShardCache()
+centroid_indexes = {collection: _CentroidIndex(collection) for collection in (COLLECTION_NAME, P_COLLECTION_NAME)}
+_write_locks = {collection: threading.Lock() for collection in (COLLECTION_NAME, P_COLLECTION_NAME)}
+
+
+@contextmanager
+def _collection_write_lock(collection: str):
+    """
+    同一 collection 的写入串行：进程内线程锁 + 跨进程文件锁
+    """
+    os.makedirs(_collection_dir(collection), exist_ok=True)
+    with _write_locks[collection]:
+        with open(os.path.join(_collection_dir(collection), ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _save_manifest(shard_dir: str, segments: list[dict], deleted: list[str], alive_vectors: np.ndarray):
+    centroid = _normalize(alive_vectors.mean(axis=0)).tolist() if len(alive_vectors) else []
+    _write_json(os.path.join(shard_dir, MANIFEST), dict(segments=segments, deleted=deleted, centroid=centroid))
+    shard_cache.invalidate(shard_dir)
+
+
+def _alive_vectors(shard: Optional[_Shard]) -> tuple[list[str], np.ndarray]:
+    if shard is None or not len(shard):
+        return [], np.zeros((0, 0), dtype=np.float32)
+    vectors = shard.vectors()
+    if shard.alive is None:
+        return list(shard.uuids), vectors
+    return [item for item, alive in zip(shard.uuids, shard.alive) if alive], vectors[shard.alive]
+
+
+def _compact(shard_dir: str, shard: _Shard, drop_uuids: set[str]) -> tuple[list[dict], np.ndarray]:
+    """
+    合并分片的段，去掉已删除及 drop_uuids 中的切片，返回新的段列表及其向量
+    """
+    uuids, vectors = _alive_vectors(shard)
+    keep = [i for i, item in enumerate(uuids) if item not in drop_uuids]
+    segments = [_write_segment(shard_dir, [uuids[i] for i in keep], np.ascontiguousarray(vectors[keep]))] if keep else []
+    return segments, vectors[keep] if keep else np.zeros((0, 0), dtype=np.float32)
+
+
+def _remove_stale_segments(shard_dir: str, segments: list[dict]):
+    names = {seg["name"] for seg in segments}
+    for entry in _scandir(shard_dir):
+        if entry.name.startswith("seg-") and entry.name.rsplit(".", 1)[0] not in names:
+            os.remove(entry.path)
+
+
+def _insert(collection: str, ins_entities: list[VectorEntity], user_id: str = None):
+    by_file: dict[str, list[VectorEntity]] = {}
+    for entity in ins_entities:
+        by_file.setdefault(entity.file_uuid, []).append(entity)
+
+    with _collection_write_lock(collection):
+        for file_uuid, entities in by_file.items():
+            shard_dir = _shard_dir(collection, file_uuid, user_id)
+            os.makedirs(shard_dir, exist_ok=True)
+            manifest = _read_manifest(shard_dir) or dict(segments=[], deleted=[])
+            shard = _Shard(shard_dir, manifest) if manifest["segments"] else None
+
+            new_uuids = [entity.uuid for entity in entities]
+            new_vectors = _normalize([entity.vector for entity in entities])
+
+            # 重复写入或删除后重新写入的切片：先合并段去掉旧数据，保证 deleted 只作用于旧段
+            existing = set(shard.uuids) if shard else set()
+            if existing & set(new_uuids) or (manifest["deleted"] and set(manifest["deleted"]) & set(new_uuids)):
+                segments, old_vectors = _compact(shard_dir, shard, set(new_uuids))
+                deleted = []
+            else:
+                segments, deleted = list(manifest["segments"]), list(manifest["deleted"])
+                _, old_vectors = _alive_vectors(shard)
+
+            segments.append(_write_segment(shard_dir, new_uuids, new_vectors))
+            alive_vectors = np.concatenate([old_vectors, new_vectors]) if len(old_vectors) else new_vectors
+            _save_manifest(shard_dir, segments, deleted, alive_vectors)
+            _remove_stale_segments(shard_dir, segments)
+
+
+def _delete_fragments(collection: str, shard_dirs: list[str], fragment_uuids: list[str]):
+    fragment_uuids = set(fragment_uuids)
+    with _collection_write_lock(collection):
+        for shard_dir in shard_dirs:
+            manifest = _read_manifest(shard_dir)
+            if not manifest:
+                continue
+            shard = _Shard(shard_dir, manifest)
+            hit = fragment_uuids & set(shard.uuids)
+            if not hit:
+                continue
+
+            deleted = sorted(set(manifest.get("deleted", [])) | hit)
+            if len(deleted) * 2 >= len(shard):
+                segments, alive_vectors = _compact(shard_dir, shard, hit)
+                if not segments:
+                    _remove_shard(shard_dir)
+                    continue
+                _save_manifest(shard_dir, segments, [], alive_vectors)
+                _remove_stale_segments(shard_dir, segments)
+            else:
+                uuids, alive_vectors = _alive_vectors(shard)
+                keep = [i for i, item in enumerate(uuids) if item not in hit]
+                _save_manifest(shard_dir, manifest["segments"], deleted, alive_vectors[keep])
+
+
+def _remove_shard(shard_dir: str):
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    shard_cache.invalidate(shard_dir)
+
+
+def _search(collection: str, shard_dirs: list[str], size: int, question_embedding: list[float]) -> list[list[dict]]:
+    query = _normalize(question_embedding)
+    shards = [shard for shard in (shard_cache.get(shard_dir) for shard_dir in shard_dirs) if shard is not None and len(shard)]
+    if not shards:
+        return [[]]
+
+    scores = np.concatenate([shard.scores(query) for shard in shards])
+    offsets = np.cumsum([0] + [len(shard) for shard in shards])
+    k = min(size, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind="stable")]
+
+    hits = []
+    for i in top:
+        if scores[i] == -np.inf:
+            continue
+        shard_idx = int(np.searchsorted(offsets, i, side="right")) - 1
+        shard = shards[shard_idx]
+        item_uuid = shard.uuids[i - offsets[shard_idx]]
+        hits.append(dict(id=item_uuid, distance=float(scores[i]), entity=dict(uuid=item_uuid, file_uuid=shard.file_uuid)))
+    return [hits]
+
+
+def insert_entities(file_uuid, ins_entities: list[VectorEntity]):
+    try:
+        t0 = time.time()
+        _insert(COLLECTION_NAME, ins_entities)
+        logger.info(f"local vdb insert batch_size {len(ins_entities)}, rt: {1000*(time.time() - t0):.1f}ms")
+        return True
+    except Exception as e:
+        logger.exception(f"local vdb insert error: {file_uuid} {e}")
+        return False
+
+
+def insert_personal_entities(user_id, ins_entities: list[VectorEntity]):
+    try:
+        t0 = time.time()
+        _insert(P_COLLECTION_NAME, ins_entities, user_id=user_id)
+        logger.info(f"local vdb insert personal batch_size {len(ins_entities)}, user_id: {user_id}, rt: {1000*(time.time() - t0):.1f}ms")
+        return True
+    except Exception as e:
+        logger.exception(f"local vdb insert personal error: {user_id} {e}")
+        return False
+
+
+def delete_entities(file_uuid):
+    return delete_entities_by_uuids([file_uuid])
+
+
+def delete_entities_by_uuids(file_uuids):
+    try:
+        with _collection_write_lock(COLLECTION_NAME):
+            for file_uuid in file_uuids:
+                _remove_shard(_shard_dir(COLLECTION_NAME, file_uuid))
+        logger.info(f"local vdb delete {file_uuids}")
+        return True
+    except Exception as e:
+        logger.exception(f"local vdb delete error: {file_uuids} {e}")
+        return False
+
+
+def delete_personal_entities(user_id, file_uuids):
+    try:
+        with _collection_write_lock(P_COLLECTION_NAME):
+            for file_uuid in file_uuids:
+                _remove_shard(_shard_dir(P_COLLECTION_NAME, file_uuid, user_id))
+        logger.info(f"local vdb delete {user_id}, {file_uuids}")
+        return True
+    except Exception as e:
+        logger.exception(f"local vdb delete error: {user_id}, {file_uuids}, {e}")
+        return False
+
+
+def delete_fragment_entities(fragment_uuids, user_id=None, file_uuid=None):
+    """
+    按切片 uuid 删除向量；指定 file_uuid 时只处理该文件的分片，否则遍历(用户的)全部分片
+    """
+    collection = P_COLLECTION_NAME if user_id else COLLECTION_NAME
+    try:
+        t0 = time.time()
+        if file_uuid:
+            shard_dirs = [_shard_dir(collection, file_uuid, user_id)]
+        else:
+            shard_dirs = _list_shard_dirs(collection, user_id=user_id)
+        _delete_fragments(collection, shard_dirs, fragment_uuids)
+        logger.info(f"local vdb delete fragments: {len(fragment_uuids)}, user_id: {user_id}, rt: {1000*(time.time() - t0):.1f}ms")
+        return True
+    except Exception as e:
+        logger.exception(f"local vdb delete fragments error: {len(fragment_uuids)}, user_id: {user_id}, {e}")
+        return False
+
+
+def search_analyst(size: int, file_uuids: list[str], question_embedding: list[float]):
+    """
+    返回格式与 zilliz search 一致：[[{"entity": {"uuid", "file_uuid"}, "distance"}]]
+    """
+    start_time = time.time()
+    if file_uuids:
+        shard_dirs = [_shard_dir(COLLECTION_NAME, file_uuid) for file_uuid in file_uuids]
+    else:
+        shard_dirs = centroid_indexes[COLLECTION_NAME].probe(_normalize(question_embedding), NPROBE)
+    search_resp = _search(COLLECTION_NAME, shard_dirs, size, question_embedding)
+    logger.info(f"local_vdb_search cost:  {1000*(time.time() - start_time):.1f}ms")
+    return search_resp
+
+
+def search_personal(size: int, file_uuids: list[str], question_embedding: list[float], user_id=None):
+    start_time = time.time()
+    if file_uuids and user_id:
+        shard_dirs = [_shard_dir(P_COLLECTION_NAME, file_uuid, user_id) for file_uuid in file_uuids]
+    elif user_id:
+        shard_dirs = _list_shard_dirs(P_COLLECTION_NAME, user_id=user_id)
+    elif file_uuids:
+        file_uuids = set(file_uuids)
+        shard_dirs = [shard_dir for shard_dir in _list_shard_dirs(P_COLLECTION_NAME) if os.path.basename(shard_dir) in file_uuids]
+    else:
+        shard_dirs = centroid_indexes[P_COLLECTION_NAME].probe(_normalize(question_embedding), NPROBE)
+    search_resp = _search(P_COLLECTION_NAME, shard_dirs, size, question_embedding)
+    logger.info(f"local_vdb_search cost:  {1000*(time.time() - start_time):.1f}ms")
+    return search_resp
@@ -134,6 +134,33 @@ def delete_personal_entities(user_id, file_uuids):
         return False
 
 
+@retry(stop=(stop_after_attempt(3) | stop_after_delay(1)), retry_error_callback=lambda x: False)
+def delete_fragment_entities(fragment_uuids, user_id=None):
+    """
+    按切片 uuid(即向量 id)删除向量，增量入库时删除已移除的切片；user_id 不为空时删除个人知识库向量
+    """
+    collection_name = P_COLLECTION_NAME if user_id else COLLECTION_NAME
+    try:
+        t0 = time.time()
+        for i in range(0, len(fragment_uuids), 1000):
+            get_tencent_client().delete(
+                database_name=DATABASE,
+                collection_name=collection_name,
+                document_ids=fragment_uuids[i:i + 1000],
+            )
+        rt = time.time() - t0
+        logger.info(f"Tencent VDB delete fragments: {len(fragment_uuids)}, user_id: {user_id}, rt: {1000*rt:.1f}ms")
+        return True
+    except Exception as e:
+        if isinstance(e, ServerInternalError) and e.code == 17505:
+            raise e
+
+        logger.error(f"Tencent VDB delete fragments error: {len(fragment_uuids)}, user_id: {user_id}, {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
 @retry(stop=(stop_after_attempt(3) | stop_after_delay(1)), reraise=True)
 def search_personal(size: int, file_uuids: list[str], question_embedding: list[float], user_id=None):
     start_time = time.time()
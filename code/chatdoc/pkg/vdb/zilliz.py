@@ -94,6 +94,28 @@ def delete_personal_entities(user_id, file_uuids):
         return False
 
 
+def delete_fragment_entities(fragment_uuids, user_id=None):
+    """
+    按切片 uuid 删除向量，增量入库时删除已移除的切片；user_id 不为空时删除个人知识库向量
+    """
+    collection_name = P_COLLECTION_NAME if user_id else COLLECTION_NAME
+    try:
+        t0 = time.time()
+        for i in range(0, len(fragment_uuids), 1000):
+            filter_str = f'uuid in {fragment_uuids[i:i + 1000]}'
+            if user_id:
+                filter_str += f' and user_id == "{user_id}"'
+            get_milvus_client().delete(collection_name=collection_name, filter=filter_str)
+        rt = time.time() - t0
+        logger.info(f"Zilliz delete fragments: {len(fragment_uuids)}, user_id: {user_id}, rt: {1000*rt:.1f}ms")
+        return True
+    except Exception as e:
+        logger.error(f"Zilliz delete fragments error: {len(fragment_uuids)}, user_id: {user_id}, {e}")
+        import traceback
+        traceback.print_exc()
+        return False
+
+
 def search_analyst(size: int, file_uuids: list[str], question_embedding: list[float]):
     start_time = time.time()
     filter_str = f"file_uuid in {file_uuids}" if file_uuids else ""
@@ -0,0 +1,36 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-28 15:02:44
+LastEditors: longsion
+LastEditTime: 2025-03-28 16:11:09
+'''
+from pkg.es.es_doc_fragment import DocFragmentES
+from pkg.es.es_p_doc_fragment import PDocFragmentES
+from pkg.es import global_es
+from pkg.es.vector_first_pass import BACKFILL_SCRIPT, FIRST_PASS_DIMS, first_pass_enabled, first_pass_field
+
+
+def put_first_pass_mapping(es_obj, field: str = "acge_embedding"):
+    """
+    已有索引增加一阶段向量字段并按全精度向量补写，开启 vector.es_first_pass 后执行
+    全精度向量的 HNSW 无法原地去掉，需要省内存时改用 reindex_fragment_knn.py 重建索引
+    """
+    fp_field = first_pass_field(field)
+    global_es.conn.indices.put_mapping(index=es_obj.index_name, properties={fp_field: es_obj.properties[fp_field]})
+    resp = global_es.conn.update_by_query(
+        index=es_obj.index_name,
+        query=dict(bool=dict(
+            filter=[dict(exists=dict(field=field))],
+            must_not=[dict(exists=dict(field=fp_field))],
+        )),
+        script=dict(source=BACKFILL_SCRIPT, params=dict(field=field, target=fp_field, dims=FIRST_PASS_DIMS)),
+        conflicts="proceed",
+        wait_for_completion=False,
+    )
+    print(f"put mapping {es_obj.index_name}.{fp_field}, backfill task: {resp['task']}")
+
+
+if __name__ == '__main__':
+    assert first_pass_enabled(), "vector.es_first_pass is not enabled"
+    for es_obj in [DocFragmentES(), PDocFragmentES()]:
+        put_first_pass_mapping(es_obj)
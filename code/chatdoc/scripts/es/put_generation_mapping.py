@@ -0,0 +1,25 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-26 15:12:40
+LastEditors: longsion
+LastEditTime: 2025-03-26 15:30:18
+'''
+from pkg.es.es_doc_fragment import DocFragmentES
+from pkg.es.es_doc_item import DocItemES
+from pkg.es.es_doc_table import DocTableES
+from pkg.es.es_file import FileES
+from pkg.es import global_es
+from pkg.es.generation import GENERATION_FIELD
+
+
+def put_generation_mapping(es_obj):
+    """
+    已有索引增加 generation 字段(keyword)，开启 parse.generation 前执行；新增字段无需 reindex，存量文档不带该字段
+    """
+    global_es.conn.indices.put_mapping(index=es_obj.index_name, properties={GENERATION_FIELD: es_obj.properties[GENERATION_FIELD]})
+    print(f"put mapping {es_obj.index_name}.{GENERATION_FIELD}")
+
+
+if __name__ == '__main__':
+    for es_obj in [DocFragmentES(), DocItemES(), DocTableES(), FileES()]:
+        put_generation_mapping(es_obj)
@@ -0,0 +1,40 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-03-11 11:02:17
+LastEditors: longsion
+LastEditTime: 2025-03-28 16:20:31
+'''
+import sys
+from pkg.es.es_doc_fragment import DocFragmentES
+from pkg.es.es_p_doc_fragment import PDocFragmentES
+from pkg.es import global_es
+from pkg.es.vector_first_pass import BACKFILL_SCRIPT, FIRST_PASS_DIMS, first_pass_enabled, first_pass_field, knn_enabled
+
+
+def reindex_with_knn_mapping(es_obj, dest_index: str):
+    """
+    已有索引的 acge_embedding 未按 HNSW 建立索引时，dense_vector 的 mapping 无法原地修改
+    新建带 HNSW mapping 的索引并 reindex，完成后将 config 中的索引名切换为新索引即可开启 vector.es_knn
+    HNSW mapping 只在 vector.es_knn 开启时生成，需先修改 config 再执行
+    开启 vector.es_first_pass 时新索引的全精度向量不建 HNSW，reindex 时补写一阶段向量
+    """
+    global_es.create_index(dest_index, dict(settings=es_obj.settings, mappings=dict(properties=es_obj.properties)))
+    script = dict(
+        source=BACKFILL_SCRIPT,
+        params=dict(field="acge_embedding", target=first_pass_field("acge_embedding"), dims=FIRST_PASS_DIMS),
+    ) if first_pass_enabled() else None
+    resp = global_es.conn.reindex(
+        source=dict(index=es_obj.index_name),
+        dest=dict(index=dest_index),
+        script=script,
+        wait_for_completion=False,
+    )
+    print(f"reindex {es_obj.index_name} -> {dest_index}, task: {resp['task']}")
+
+
+if __name__ == '__main__':
+    if not knn_enabled():
+        sys.exit("vector.es_knn 未开启，新索引不会建立 HNSW，请先修改 config")
+    suffix = sys.argv[1] if len(sys.argv) > 1 else "knn"
+    for es_obj in [DocFragmentES(), PDocFragmentES()]:
+        reindex_with_knn_mapping(es_obj, f"{es_obj.index_name}_{suffix}")
@@ -0,0 +1,74 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-04-05 19:20:14
+LastEditors: longsion
+LastEditTime: 2025-04-05 20:48:31
+
+文件名/公司名模糊匹配：FuzzyIndex / get_close_matches 与 difflib.get_close_matches 结果完全一致
+'''
+
+import difflib
+import random
+
+import pytest
+
+pytest.importorskip("numpy")
+
+from pkg.utils.fuzzy_match import FuzzyIndex, get_close_matches  # noqa: E402
+
+# 字符集小，容易出现得分相同、上界相同的候选
+ALPHABET = "abcd中国公司"
+CUTOFFS = [0.0, 0.3, 0.5, 0.6, 2 / 3, 0.75, 1.0]
+
+
+def random_word(rnd: random.Random, max_len: int = 6) -> str:
+    return "".join(rnd.choice(ALPHABET) for _ in range(rnd.randint(0, max_len)))
+
+
+def test_random_equivalence():
+    rnd = random.Random(20250402)
+    for _ in range(3000):
+        possibilities = [random_word(rnd) for _ in range(rnd.choice([0, 1, 2, 5, 20, 100]))]
+        # 重复候选
+        possibilities += rnd.sample(possibilities, min(len(possibilities), rnd.randint(0, 3)))
+        word = random_word(rnd)
+        n = rnd.choice([1, 2, 3, 5, 50, 1000])
+        cutoff = rnd.choice(CUTOFFS + [rnd.random()])
+
+        expected = difflib.get_close_matches(word, possibilities, n=n, cutoff=cutoff)
+        assert get_close_matches(word, possibilities, n=n, cutoff=cutoff) == expected, (word, possibilities, n, cutoff)
+        assert FuzzyIndex(possibilities).close_matches(word, n=n, cutoff=cutoff) == expected, (word, possibilities, n, cutoff)
+
+
+def test_many_candidates():
+    # 候选数超过一批(max(4n, 32))，覆盖分批部分排序
+    rnd = random.Random(7)
+    possibilities = [random_word(rnd, 10) for _ in range(2000)]
+    index = FuzzyIndex(possibilities)
+    for _ in range(40):
+        word = random_word(rnd, 10)
+        for n, cutoff in [(1, 0.0), (3, 0.6), (10, 0.3), (100, 0.5)]:
+            assert index.close_matches(word, n=n, cutoff=cutoff) == difflib.get_close_matches(word, possibilities, n=n, cutoff=cutoff)
+
+
+@pytest.mark.parametrize("possibilities", [["ax", "ay"], ["ay", "ax"], ["ax", "ay", "ax", "az"]])
+def test_equal_bound_does_not_break(possibilities):
+    # 上界等于第 n 名得分时不能提前结束：得分相同按字符串取大者
+    for n in (1, 2, 3):
+        assert get_close_matches("aw", possibilities, n=n, cutoff=0.5) == difflib.get_close_matches("aw", possibilities, n=n, cutoff=0.5)
+
+
+@pytest.mark.parametrize("word, possibilities", [("", [""]), ("", ["a", ""]), ("a", [""]), ("", []), ("a", [])])
+def test_empty_strings(word, possibilities):
+    for cutoff in CUTOFFS:
+        assert get_close_matches(word, possibilities, cutoff=cutoff) == difflib.get_close_matches(word, possibilities, cutoff=cutoff)
+
+
+@pytest.mark.parametrize("n, cutoff", [(0, 0.6), (-1, 0.6), (3, -0.1), (3, 1.1)])
+def test_invalid_arguments(n, cutoff):
+    with pytest.raises(ValueError):
+        difflib.get_close_matches("a", ["a"], n=n, cutoff=cutoff)
+    with pytest.raises(ValueError):
+        get_close_matches("a", ["a"], n=n, cutoff=cutoff)
+    with pytest.raises(ValueError):
+        FuzzyIndex([]).close_matches("a", n=n, cutoff=cutoff)
@@ -0,0 +1,132 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-04-05 10:16:42
+LastEditors: longsion
+LastEditTime: 2025-04-05 15:32:08
+
+pdf2md 分片解析：用假的 TextinOcr 按页生成结果，分片拼接后须与整份解析一致
+'''
+
+import copy
+import functools
+import io
+import json
+
+import pytest
+
+from pkg.clients import pdf2md_shard
+
+# 每页段落数，含没有段落的页
+PAGE_PARAGRAPHS = [3, 0, 2, 1, 0, 0, 4, 1, 2, 0, 3]
+
+
+class FakeResponse(object):
+    def __init__(self, result: dict):
+        self.content = json.dumps(result).encode("utf-8")
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeTextinOcr(object):
+    """
+    按页宽还原原文档页码(第 i 页宽 100 + i)，像 pdf2md 一样按子文档从 1 开始编 page_id
+    per_page 为 True 时 paragraph_id 为页内编号，否则为全文连续编号
+    """
+    per_page = True
+
+    @property
+    def options(self):
+        return dict(page_start=0, page_count=2000)
+
+    def recognize_pdf2md(self, image, options: dict = None):
+        from pypdf import PdfReader
+
+        options = {**self.options, **(options or {})}
+        reader = PdfReader(io.BytesIO(image))
+        pages = reader.pages[options["page_start"]:options["page_start"] + options["page_count"]]
+        return FakeResponse(fake_result([int(page.mediabox.width) - 100 for page in pages], self.per_page))
+
+
+def fake_result(page_indexes: list[int], per_page: bool) -> dict:
+    detail, pages, metrics, toc, markdowns = [], [], [], [], []
+    paragraph_id = 0
+    for page_id, page_idx in enumerate(page_indexes, start=1):
+        texts = []
+        for i in range(PAGE_PARAGRAPHS[page_idx]):
+            text = f"page {page_idx} paragraph {i}"
+            detail.append(dict(page_id=page_id, paragraph_id=i if per_page else paragraph_id, text=text))
+            texts.append(text)
+            paragraph_id += 1
+        pages.append(dict(page_id=page_id, status="success"))
+        metrics.append(dict(page_id=page_id, angle=0))
+        if texts:
+            toc.append(dict(page_id=page_id, title=texts[0], level=1))
+            markdowns.append("\n\n".join(texts))
+
+    return dict(
+        code=200,
+        message="success",
+        result=dict(
+            detail=detail,
+            pages=pages,
+            markdown="\n\n".join(markdowns),
+            catalog=dict(toc=toc),
+            total_page_number=len(page_indexes),
+            valid_page_number=len(page_indexes),
+            total_paragraph_count=len(detail),
+            version="fake",
+        ),
+        metrics=metrics,
+    )
+
+
+def make_pdf(page_count: int) -> bytes:
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    for i in range(page_count):
+        writer.add_blank_page(width=100 + i, height=200)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+# 单页分片时无法区分全文编号与页内编号(见 test_paragraph_id_per_page_ignores_pages_without_paragraphs)，只测页内编号
+@pytest.mark.parametrize("per_page, shard_pages", [(True, 1)] + [(per_page, n) for per_page in (True, False) for n in (2, 3, 4, 10)])
+def test_sharded_equals_unsharded(monkeypatch, per_page, shard_pages):
+    pytest.importorskip("pypdf")
+    monkeypatch.setattr(FakeTextinOcr, "per_page", per_page)
+    monkeypatch.setattr(pdf2md_shard, "TextinOcr", FakeTextinOcr)
+    monkeypatch.setattr(pdf2md_shard, "split_pdf", functools.partial(pdf2md_shard.split_pdf, shard_pages=shard_pages, min_pages=0))
+
+    data = make_pdf(len(PAGE_PARAGRAPHS))
+    assert len(pdf2md_shard.split_pdf(data)) == -(-len(PAGE_PARAGRAPHS) // shard_pages)
+    assert pdf2md_shard.recognize_pdf2md_json(data) == pdf2md_shard._recognize(data)
+
+
+@pytest.mark.parametrize("per_page", [True, False])
+def test_merge_shifts_page_and_paragraph_ids(per_page):
+    full = fake_result(list(range(len(PAGE_PARAGRAPHS))), per_page)
+    shards = [
+        (page_offset, fake_result(list(range(page_offset, min(page_offset + 3, len(PAGE_PARAGRAPHS)))), per_page))
+        for page_offset in range(0, len(PAGE_PARAGRAPHS), 3)
+    ]
+
+    merged = pdf2md_shard.merge_pdf2md_results(copy.deepcopy(shards))
+    assert merged == full
+    assert [item["page_id"] for item in merged["result"]["catalog"]["toc"]] == [1, 3, 4, 7, 8, 9, 11]
+    assert merged["result"]["total_page_number"] == len(PAGE_PARAGRAPHS)
+    assert merged["result"]["total_paragraph_count"] == sum(PAGE_PARAGRAPHS)
+
+
+def test_paragraph_id_per_page_ignores_pages_without_paragraphs():
+    # 每个分片只有一页有段落，无法判断编号方式时不改写 paragraph_id
+    shards = [(0, fake_result([0, 1], True)), (2, fake_result([2, 4, 5], True))]
+    merged = pdf2md_shard.merge_pdf2md_results(copy.deepcopy(shards))
+    assert [(item["page_id"], item["paragraph_id"]) for item in merged["result"]["detail"]] == [(1, 0), (1, 1), (1, 2), (3, 0), (3, 1)]
+
+    # 分片首页没有段落时，以首个有段落的页为准
+    assert pdf2md_shard._paragraph_id_per_page([fake_result([1, 2, 3], True)["result"]["detail"]])
+    assert not pdf2md_shard._paragraph_id_per_page([fake_result([1, 2, 3], False)["result"]["detail"]])
+    assert pdf2md_shard._paragraph_id_per_page([[], fake_result([0, 2], True)["result"]["detail"]])
@@ -0,0 +1,111 @@
+'''
+Author: longsion<xianglong_chen@intsig.net>
+Date: 2025-04-05 16:02:37
+LastEditors: longsion
+LastEditTime: 2025-04-05 18:11:52
+
+表格引擎：TableGrid.from_html 与原 BeautifulSoup 版本 html2list 在随机表格上结果一致
+'''
+
+import random
+import re
+
+import pytest
+
+from pkg.utils.table_engine import TableGrid
+
+CELL_TEXTS = ["a", "1,234", " b c ", "12.5", "", "x<b>y</b>", "&amp;", "中 文", "a<br>b", "c<!-- note -->d", "&nbsp;"]
+
+
+def bs4_html2list(html: str) -> list:
+    """
+    原 pkg.utils.transform.html2list(BeautifulSoup 解析后逐列展开合并单元格)
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'lxml')
+    table = []
+    nb_col = 0
+    tr_list = soup.find_all('tr')
+    for tr in tr_list:
+        td_th_list = tr.find_all(re.compile(r'(td|th)'))
+        table.append([])
+        for cell in td_th_list:
+            text = cell.get_text(separator=' ').replace(' ', '').replace(',', '')
+            if text == " ":
+                text = ""
+            table[-1].append({
+                'colspan': int(cell.attrs['colspan']) if 'colspan' in cell.attrs else 1,
+                'rowspan': int(cell.attrs['rowspan']) if 'rowspan' in cell.attrs else 1,
+                'text': text,
+            })
+        nb_col = max(nb_col, len(td_th_list))
+    nb_row = len(tr_list)
+
+    def add_cell(i_line, i_col, val, nb_line, nb_col):
+        while len(table) <= i_line:
+            table.append([])
+            nb_line += 1
+        while len(table[i_line]) < i_col:
+            table[i_line].append('')
+        table[i_line].insert(i_col, val)
+        return nb_line, max(nb_col, len(table[i_line]))
+
+    i_col = 0
+    while i_col < nb_col:
+        i_line = 0
+        while i_line < nb_row:
+            while i_col >= len(table[i_line]):
+                table[i_line].append('')
+            cell = table[i_line][i_col]
+            if type(cell) is not dict:
+                i_line += 1
+                continue
+            for i_colspan in range(i_col, i_col + cell['colspan']):
+                for i_rowspan in range(i_line, i_line + cell['rowspan']):
+                    if i_colspan == i_col and i_rowspan == i_line:
+                        continue
+                    nb_row, nb_col = add_cell(i_rowspan, i_colspan, "", nb_row, nb_col)
+            table[i_line][i_col] = cell['text']
+            i_line += 1
+        i_col += 1
+    return table
+
+
+def random_table(rnd: random.Random) -> str:
+    rows = []
+    for _ in range(rnd.randint(0, 6)):
+        cells = []
+        for _ in range(rnd.randint(0, 5)):
+            attrs = ""
+            if rnd.random() < 0.3:
+                attrs += f' colspan="{rnd.randint(0, 3)}"'
+            if rnd.random() < 0.3:
+                attrs += f' rowspan="{rnd.randint(0, 4)}"'
+            tag = rnd.choice(["td", "th"])
+            cells.append(f"<{tag}{attrs}>{rnd.choice(CELL_TEXTS)}</{tag}>")
+        rows.append("<tr>" + "".join(cells) + "</tr>")
+    return '<table border="1">' + "".join(rows) + "</table>"
+
+
+@pytest.mark.parametrize("html", [
+    "",
+    "<p>no table</p>",
+    "<table><tr><td colspan=\"2\" rowspan=\"2\">a</td><td>b</td></tr><tr><td>c</td></tr></table>",
+    # rowspan 超出表格、跨度为 0、跨度重叠
+    "<table><tr><td rowspan=\"3\">a</td><td colspan=\"0\" rowspan=\"2\">b</td></tr></table>",
+    "<table><tr><td colspan=\"3\">a</td></tr><tr><td rowspan=\"2\" colspan=\"2\">b</td><td>c</td></tr><tr><td>d</td></tr></table>",
+    # 嵌套表格
+    "<table><tr><td><table><tr><td>x</td></tr></table></td><td>y</td></tr></table>",
+])
+def test_from_html_matches_bs4(html):
+    pytest.importorskip("bs4")
+    assert TableGrid.from_html(html).rows == bs4_html2list(html)
+
+
+def test_from_html_matches_bs4_random():
+    pytest.importorskip("bs4")
+    rnd = random.Random(20250405)
+    for _ in range(3000):
+        html = random_table(rnd)
+        assert TableGrid.from_html(html).rows == bs4_html2list(html), html